@@ -12,6 +12,12 @@ import bpy
 import mathutils
 import sys
 import pickle
+import os
+
+# Shared CORTO GNC modules (server_api folder of the repository)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'server_api'))
+from corto_image_io import ImageWireBuffer
+import corto_protocol
 
 #### (1) STATIC PARAMETERS ####
 
@@ -23,6 +29,7 @@ sensor_size_y = 1536 #[pxl], Vertical resolution of the images
 n_channels = 1 #[-], Number of channels of the images
 bit_encoding = 8 #[-], Number of bit per pixel
 compression = 15 #[-], Compression factor
+image_dtype = 'float64' #[-], Data type of the transmitted pixels: float64 (as expected by NAVCAM_HF_1), float32, uint8, uint16
 
 #RENDERING ENGINE
 bpy.context.scene.render.engine = 'CYCLES'
@@ -44,6 +51,7 @@ specular_factor = 0 #Specularity value for the sun-light in Blender
 address = "0.0.0.0"
 port_M2B = 51001 #  Port from Matlab to Blender
 port_B2M = 30001 #  Port from Blender to Matlab
+tcp_protocol = 'raw' # 'raw': pixels only (NAVCAM_HF_1 models), 'framed': header + pixels (see server_api/corto_protocol.py)
 
 #### (2) SCENE SET UP ####
 CAM = bpy.data.objects["Camera"]
@@ -98,6 +106,9 @@ CAM.rotation_quaternion = [1, 0, 0, 0]
 SUN.rotation_quaternion = [1, 0, 0, 0]
 
 #### (4) FUNCTION DEFINITIONS ####
+# Preallocated readback/transmission buffers, reused at every step
+image_buffer = ImageWireBuffer(image_dtype)
+
 def Render(ii):
     name = '\{}.png'.format(str(int(ii)).zfill(6))
     bpy.context.scene.render.filepath = output_path + '/' + name
@@ -133,6 +144,7 @@ receiving_flag = 1
 ii = 0
 while receiving_flag:
     data, addr = r.recvfrom(512)
+    t_step0 = time.perf_counter()
     numOfValues = int(len(data) / 8)
     data = struct.unpack('>' + 'd' * numOfValues, data)
     n_bodies = len(data)/7-2 #Number of bodies apart from CAM and SUN
@@ -149,13 +161,19 @@ while receiving_flag:
     # Position all bodies in the scene
     PositionAll(PQ_SC,PQ_Bodies,PQ_Sun)
     # Take a picture
+    t_render0 = time.perf_counter()
     Render(ii)
-    # Read the pixels from the viewer node
-    pixels = bpy.data.images['Viewer Node'].pixels
-    img_reshaped_vec = pixels[:]
-    # Pack the RGBA image as vector and transmit over TCP
-    format_pack = '@' + str(len(img_reshaped_vec)) + 'd'
-    img_pack = struct.pack(format_pack,*img_reshaped_vec);
-    clientsocket.send(img_pack)
+    render_time = time.perf_counter() - t_render0
+    # Read the pixels from the viewer node (float32 buffer, no Python tuple)
+    image_buffer.read(bpy.data.images['Viewer Node'])
+    # Convert the RGBA image vector to the wire dtype and transmit over TCP without copies
+    image_buffer.pack()
+    if tcp_protocol == 'framed':
+        # Header with frame id, size, dtype and timings, then the pixels
+        width, height = image_buffer.size
+        corto_protocol.send_frame(clientsocket, ii, image_buffer.packed, width, height,
+                                  image_buffer.packed.size // (width*height), render_time, time.perf_counter() - t_step0)
+    else:
+        image_buffer.send(clientsocket)
     #continue on the iteration
     ii = ii + 1
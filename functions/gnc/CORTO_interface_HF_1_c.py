@@ -12,6 +12,14 @@ import bpy
 import mathutils
 import sys
 import pickle
+import os
+
+# Shared CORTO GNC modules (server_api folder of the repository)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'server_api'))
+from corto_image_io import ImageWireBuffer
+import corto_protocol
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rendering'))
+from async_writer import AsyncWriter
 
 #### (1) STATIC PARAMETERS ####
 
@@ -23,6 +31,7 @@ sensor_size_y = 1536 #[pxl], Vertical resolution of the images
 n_channels = 3 #[-], Number of channels of the images
 bit_encoding = 8 #[-], Number of bit per pixel
 compression = 15 #[-], Compression factor
+image_dtype = 'float64' #[-], Data type of the transmitted pixels: float64 (as expected by NAVCAM_HF_1), float32, uint8, uint16
 
 #RENDERING ENGINE
 bpy.context.scene.render.engine = 'CYCLES'
@@ -48,6 +57,9 @@ specular_factor = 0 #Specularity value for the sun-light in Blender
 address = "0.0.0.0"
 port_M2B = 51001 #  Port from Matlab to Blender
 port_B2M = 30001 #  Port from Blender to Matlab
+tcp_protocol = 'raw' # 'raw': pixels only (NAVCAM_HF_1 models), 'framed': header + pixels (see server_api/corto_protocol.py)
+readback_mode = 'disk' # 'disk': PNG saved in output_path and loaded back (display space), 'memory': pixels read from the Viewer Node, nothing written/loaded (linear space)
+log_images = False # 'memory' mode only: save a .npy copy of each transmitted image in output_path, in a background thread
 
 #### (2) SCENE SET UP ####
 CAM = bpy.data.objects["Camera"]
@@ -102,10 +114,37 @@ CAM.rotation_quaternion = [1, 0, 0, 0]
 SUN.rotation_quaternion = [1, 0, 0, 0]
 
 #### (4) FUNCTION DEFINITIONS ####
+# Preallocated readback/transmission buffers, reused at every step
+image_buffer = ImageWireBuffer(image_dtype)
+
+# Single image datablock reused by the 'disk' readback mode (images.load at every step leaks one image per step)
+img_read = None
+# Background writer of the 'memory' mode image log
+image_logger = AsyncWriter(1) if (readback_mode == 'memory' and log_images) else None
+
 def Render(ii):
     name = '\{}.png'.format(str(int(ii)).zfill(6))
     bpy.context.scene.render.filepath = output_path + '/' + name
-    bpy.ops.render.render(write_still=1)
+    bpy.ops.render.render(write_still=(readback_mode == 'disk'))
+    return
+
+def ReadRendered(ii):
+    # Read the rendered image pixels into image_buffer, according to readback_mode
+    global img_read
+    if readback_mode == 'memory':
+        image_buffer.read(bpy.data.images['Viewer Node'])
+        if image_logger is not None:
+            # The buffer is reused at the next step: the logger gets its own copy
+            image_logger.submit(np.save, output_path + '/' + '{}.npy'.format(str(int(ii)).zfill(6)),
+                                np.reshape(image_buffer.pixels, (image_buffer.size[1], image_buffer.size[0], -1)).copy())
+    else:
+        filepath = output_path + '/' + '\{}.png'.format(str(int(ii)).zfill(6))
+        if img_read is None:
+            img_read = bpy.data.images.load(filepath = filepath)
+        else:
+            img_read.filepath = filepath
+            img_read.reload() # Frees the previous pixels, memory stays flat
+        image_buffer.read(img_read) # float32 buffer, no Python tuple
     return
 
 # SETUP OBJECTS POSITIONS IN SCENE
@@ -140,31 +179,43 @@ print("Waiting for data...\n")
 
 receiving_flag = 1
 ii = 0
-while receiving_flag:
-    data, addr = r.recvfrom(512)
-    numOfValues = int(len(data) / 8)
-    data = struct.unpack('>' + 'd' * numOfValues, data)
-    n_bodies = len(data)/7-2 #Number of bodies apart from CAM and SUN
-    # Extract the PQ vectors from data received from cuborg
-    PQ_Sun = data[0:7]
-    PQ_SC = data[7:14]
-    PQ_Bodies = data[14:]
-    PQ_Bodies = np.reshape(PQ_Bodies,(int(n_bodies),7))
-    # Print the PQ vector info
-    print('SUN:   POS ' +  str(PQ_Sun[0:3]) + ' - Q ' + str(PQ_Sun[3:7]))
-    print('SC:    POS ' +  str(PQ_SC[0:3]) + ' - Q ' + str(PQ_SC[3:7]))
-    for jj in np.arange(0,n_bodies):
-        print('BODY (' + str(jj) + '):   POS: ' +  str(PQ_Bodies[int(jj),0:3]) + ' - Q ' + str(PQ_Bodies[int(jj),3:7]))
-    #Position all bodies in the scene
-    PositionAll(PQ_SC,PQ_Bodies,PQ_Sun)
-    #Take a picture
-    Render(ii)
-    # Read the pixels from the saved image
-    img_read = bpy.data.images.load(filepath = output_path + '/' + '\{}.png'.format(str(int(ii)).zfill(6)))
-    img_reshaped_vec = img_read.pixels[:]
-    # Pack the RGBA image as vector and transmit over TCP
-    format_pack = '@' + str(len(img_reshaped_vec)) + 'd'
-    img_pack = struct.pack(format_pack,*img_reshaped_vec);
-    clientsocket.send(img_pack)
-    #continue on the iteration
-    ii = ii + 1
+try:
+    while receiving_flag:
+        data, addr = r.recvfrom(512)
+        t_step0 = time.perf_counter()
+        numOfValues = int(len(data) / 8)
+        data = struct.unpack('>' + 'd' * numOfValues, data)
+        n_bodies = len(data)/7-2 #Number of bodies apart from CAM and SUN
+        # Extract the PQ vectors from data received from cuborg
+        PQ_Sun = data[0:7]
+        PQ_SC = data[7:14]
+        PQ_Bodies = data[14:]
+        PQ_Bodies = np.reshape(PQ_Bodies,(int(n_bodies),7))
+        # Print the PQ vector info
+        print('SUN:   POS ' +  str(PQ_Sun[0:3]) + ' - Q ' + str(PQ_Sun[3:7]))
+        print('SC:    POS ' +  str(PQ_SC[0:3]) + ' - Q ' + str(PQ_SC[3:7]))
+        for jj in np.arange(0,n_bodies):
+            print('BODY (' + str(jj) + '):   POS: ' +  str(PQ_Bodies[int(jj),0:3]) + ' - Q ' + str(PQ_Bodies[int(jj),3:7]))
+        #Position all bodies in the scene
+        PositionAll(PQ_SC,PQ_Bodies,PQ_Sun)
+        #Take a picture
+        t_render0 = time.perf_counter()
+        Render(ii)
+        render_time = time.perf_counter() - t_render0
+        # Read the pixels from the saved image or from memory
+        ReadRendered(ii)
+        # Convert the RGBA image vector to the wire dtype and transmit over TCP without copies
+        image_buffer.pack()
+        if tcp_protocol == 'framed':
+            # Header with frame id, size, dtype and timings, then the pixels
+            width, height = image_buffer.size
+            corto_protocol.send_frame(clientsocket, ii, image_buffer.packed, width, height,
+                                      image_buffer.packed.size // (width*height), render_time, time.perf_counter() - t_step0)
+        else:
+            image_buffer.send(clientsocket)
+        #continue on the iteration
+        ii = ii + 1
+finally:
+    # Write the image log entries still queued (and raise their errors) before exiting
+    if image_logger is not None:
+        image_logger.close()
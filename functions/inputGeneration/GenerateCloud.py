@@ -1,3 +1,6 @@
+import os
+import sys
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -14,11 +17,17 @@ theta_min = 45 # [deg]
 theta_max = 90 # [deg]
 phi_min = -120 # [deg]
 phi_max = 120 # [deg]
+output_format = 'txt' # 'txt' (Cloud_*.txt) or 'npy' (binary pose store, see rendering/pose_io.py)
+n_plot_max = 5000 # [-] Max number of camera positions displayed (0 to disable the plot)
+seed = None # [-] Integer seed for reproducible clouds (None: random, the entropy used is printed)
+stream_mode = False # If True, poses are generated and written in chunks: memory does not depend on nPoints
+chunk_size = 1000000 # [-] Number of poses per chunk (stream mode)
+n_workers = 1 # [-] Number of processes generating chunks in parallel (stream mode)
 
 ######[1]  (END) INPUT SECTION (END) [1]######
 
 # Define functions
-def GenerateRandP(min,max,nPoints):
+def GenerateRandP(min,max,nPoints,rng=None):
   '''
   This function generates nPoints random points uniformly distributed between 
   min and max
@@ -27,8 +36,12 @@ def GenerateRandP(min,max,nPoints):
       min: scalar, min value.
       max: scalar, max value.
       nPoints: scalar, number of points to generate.
+      rng: numpy Generator to draw from. If None, the global numpy.random state is used.
   '''
-  v_norm = rand(nPoints)
+  if rng is None:
+    v_norm = rand(nPoints)
+  else:
+    v_norm = rng.random(nPoints)
   v_rand = min + (v_norm * (max - min))
   return v_rand
 
@@ -47,30 +60,77 @@ def sph2cart(az, el, r):
     z = r * np.sin(el)
     return x, y, z
 
-def GenerateQSC_origin(camera_position):
+def RowNorm(v):
     '''
-    This function return a pointing quaternion to be used in Blender,
-    given a camera position and assuming target to be positioned in the origin
+    This function returns the euclidean norm of each row of v, keeping dimensions.
+    The row dot products use the same kernel as np.linalg.norm on a single vector,
+    such that batched and per-row results are bitwise identical.
 
     # Arguments
-        camera_position: Numpy-array of length 3. Camera position.
+        v: Numpy-array of shape (N,3).
+    '''
+    return np.sqrt(np.matmul(v[:,None,:], v[:,:,None])[:,0,:])
+
+def GenerateQSC_origin_batch(camera_positions):
+    '''
+    This function return the pointing quaternions to be used in Blender,
+    given N camera positions and assuming target to be positioned in the origin
+
+    # Arguments
+        camera_positions: Numpy-array of shape (N,3). Camera positions.
     '''
     target_position = np.array([0,0,0])
     # compute camera-boresight
-    camera_direction = camera_position - target_position
-    camera_direction = camera_direction / np.linalg.norm(camera_direction)
+    camera_direction = camera_positions - target_position
+    camera_direction = camera_direction / RowNorm(camera_direction)
     # compute camera-right
     camera_right = np.cross(np.array([0.0, 0.0, 1.0]), camera_direction)
-    camera_right = camera_right / np.linalg.norm(camera_right)
+    camera_right = camera_right / RowNorm(camera_right)
     # compute camera-up
     camera_up = np.cross(camera_direction, camera_right)
-    camera_up = camera_up / np.linalg.norm(camera_up)
-    # Generate the quaternion for Blender [w,xyz]
-    r_cam = R.from_matrix(np.transpose([camera_right,camera_up,camera_direction])) # ROTATION MUST ACCOUNT FOR THE FACT THAT THE CAMERA IS POINTING TOWARD -Z 
+    camera_up = camera_up / RowNorm(camera_up)
+    # Generate the quaternions for Blender [w,xyz]: look-at matrices have columns [right,up,boresight]
+    r_cam = R.from_matrix(np.stack([camera_right,camera_up,camera_direction], axis=2)) # ROTATION MUST ACCOUNT FOR THE FACT THAT THE CAMERA IS POINTING TOWARD -Z 
     r_cam = r_cam.as_quat()
-    r_blender = [r_cam[3],r_cam[0],r_cam[1],r_cam[2]] # BLENDER USES HAMILTON CONVENTION
+    r_blender = r_cam[:,[3,0,1,2]] # BLENDER USES HAMILTON CONVENTION
     return r_blender
 
+def GenerateQSC_origin(camera_position):
+    '''
+    This function return a pointing quaternion to be used in Blender,
+    given a camera position and assuming target to be positioned in the origin
+
+    # Arguments
+        camera_position: Numpy-array of length 3. Camera position.
+    '''
+    return list(GenerateQSC_origin_batch(np.reshape(camera_position,(1,3)))[0])
+
+def GenerateQBody_batch(rot_x, rot_y, rot_z):
+    '''
+    This function return the body quaternions to be used in Blender [w,xyz]
+    from N sets of 'xyz' Euler angles
+
+    # Arguments
+        rot_x, rot_y, rot_z: Numpy-arrays of length N. Euler angles. [deg]
+    '''
+    q = R.from_euler('xyz',np.column_stack([np.ravel(rot_x),np.ravel(rot_y),np.ravel(rot_z)]),degrees=True).as_quat()
+    return q[:,[3,0,1,2]]
+
+def BuildLABEL(ID, pos_Body, q_Body, pos_Cam, q_Cam, pos_Sun):
+    '''
+    This function assembles the (N,18) LABEL matrix exported for rendering in CORTO
+
+    # Arguments
+        ID: Numpy-array of length N. ID or ET.
+        pos_Body, pos_Cam, pos_Sun: Numpy-arrays of shape (N,3). Positions. [BU]
+        q_Body, q_Cam: Numpy-arrays of shape (N,4). Quaternions [w,xyz]. [-]
+    '''
+    # [0] ID or ET
+    # [1,2,3] Body pos [BU] and [4,5,6,7] orientation [-]
+    # [8,9,10] Camera pos [BU] and [11,12,13,14] orientation [-]
+    # [15,16,17] Sun pos [BU]
+    return np.column_stack([ID, pos_Body, q_Body, pos_Cam, q_Cam, pos_Sun]).astype(np.float64)
+
 def GenerateTimestamp():
     '''
     This function generates a univoque timestamp for saving purposes
@@ -79,69 +139,140 @@ def GenerateTimestamp():
     formatted_timestamp = timestamp.strftime("%Y_%m_%d_%H_%M_%S")
     return formatted_timestamp
 
-# Generate random distribution of camera positions in polar coordinates
-R_dist = GenerateRandP(R_min,R_max,nPoints) # [BU]
-theta_dist = GenerateRandP(theta_min,theta_max,nPoints) # [deg]
-phi_dist = GenerateRandP(phi_min,phi_max,nPoints) # [deg]
-# Transform from polar to cartesian coordinates
-[x_Cam_dist,y_Cam_dist,z_Cam_dist] = sph2cart(theta_dist*np.pi/180,phi_dist*np.pi/180,R_dist) # [BU]
-# Generate camera orientations according to camera positions
-q_Cam_dist = np.zeros((nPoints,4)) # [-]
-for ii in range (0,nPoints,1):
-  q_Cam_dist[ii,:] = GenerateQSC_origin(np.array([x_Cam_dist[ii],y_Cam_dist[ii],z_Cam_dist[ii]]))
-# Generate Body poses 
-x_Body_dist = np.zeros((nPoints,1)) # [BU]
-y_Body_dist = np.zeros((nPoints,1)) # [BU]
-z_Body_dist = np.zeros((nPoints,1)) # [BU]
-rot_Body_x_dist = np.zeros((nPoints,1)) # [deg]
-rot_Body_y_dist = np.zeros((nPoints,1)) # [deg]
-rot_Body_z_dist = GenerateRandP(0,360,nPoints) # [deg]
-q_Body_dist = np.zeros((nPoints,4)) # [-]
-
-for ii in range (0,nPoints,1):
-  r = R.from_euler('xyz',[rot_Body_x_dist[ii][0],rot_Body_y_dist[ii][0],rot_Body_z_dist[ii]],degrees=True)
-  q = r.as_quat()
-  q_Body_dist[ii,:] = [q[3],q[0],q[1],q[2]]
-# Generate Sun's positions (Assumed on Y-axis in this example)
-x_Sun_dist = np.zeros((nPoints,1)) # [BU]
-y_Sun_dist = np.ones((nPoints,1))*R_max*1e3 # [BU]
-z_Sun_dist = np.zeros((nPoints,1)) # [BU]
-# Generate output timestamp
-output_timestamp = GenerateTimestamp()
-
-# Display camera positions
-plt.figure()
-ax = plt.axes(projection='3d')
-ax.scatter(x_Cam_dist,y_Cam_dist,z_Cam_dist, c=theta_dist, cmap='viridis', linewidth=0.1);
-plt.axis('equal')
-plt.xlabel('X axis [BU]')
-plt.ylabel('Y axis [BU]')
-
-# Generate LABEL matrix for export as .txt
-LABEL = np.zeros((nPoints,18))
-for ii in range(0,nPoints,1):
-  # [0] ID or ET
-  LABEL[ii,0] = ii
-  # [1,2,3] Body pos [BU] and [4,5,6,7] orientation [-]
-  LABEL[ii,1] = x_Body_dist[ii]
-  LABEL[ii,2] = y_Body_dist[ii]
-  LABEL[ii,3] = z_Body_dist[ii] 
-  LABEL[ii,4] = q_Body_dist[ii,0]
-  LABEL[ii,5] = q_Body_dist[ii,1]
-  LABEL[ii,6] = q_Body_dist[ii,2] 
-  LABEL[ii,7] = q_Body_dist[ii,3] 
-  # [8,9,10] Camera pos [BU] and [11,12,13,14] orientation [-]
-  LABEL[ii,8] = x_Cam_dist[ii]
-  LABEL[ii,9] = y_Cam_dist[ii]
-  LABEL[ii,10] = z_Cam_dist[ii] 
-  LABEL[ii,11] = q_Cam_dist[ii,0]
-  LABEL[ii,12] = q_Cam_dist[ii,1]
-  LABEL[ii,13] = q_Cam_dist[ii,2] 
-  LABEL[ii,14] = q_Cam_dist[ii,3] 
-  # [15,16,17] Sun pos [BU]
-  LABEL[ii,15] = x_Sun_dist[ii]
-  LABEL[ii,16] = y_Sun_dist[ii]
-  LABEL[ii,17] = z_Sun_dist[ii] 
-
-# Export the LABEL matrix for rendering in CORTO
-np.savetxt('Cloud_' + output_timestamp + '.txt', LABEL)
\ No newline at end of file
+def GenerateCloudChunk(chunk_args):
+  '''
+  This function generates one chunk of the pose cloud as (n,18) LABEL matrix.
+  Each chunk draws from its own generator, seeded by a child of the run SeedSequence,
+  such that the cloud does not depend on how chunks are distributed among processes.
+
+  # Arguments
+      chunk_args: tuple (i0, n, chunk_seed, params). i0: index of the first pose,
+                  n: number of poses, chunk_seed: SeedSequence of the chunk,
+                  params: dict with R_min, R_max, theta_min, theta_max, phi_min, phi_max.
+  '''
+  (i0, n, chunk_seed, params) = chunk_args
+  rng = np.random.default_rng(chunk_seed)
+  # Camera positions and orientations
+  R_dist = GenerateRandP(params['R_min'],params['R_max'],n,rng) # [BU]
+  theta_dist = GenerateRandP(params['theta_min'],params['theta_max'],n,rng) # [deg]
+  phi_dist = GenerateRandP(params['phi_min'],params['phi_max'],n,rng) # [deg]
+  [x_Cam,y_Cam,z_Cam] = sph2cart(theta_dist*np.pi/180,phi_dist*np.pi/180,R_dist) # [BU]
+  pos_Cam = np.column_stack([x_Cam,y_Cam,z_Cam]) # [BU]
+  q_Cam = GenerateQSC_origin_batch(pos_Cam) # [-]
+  # Body poses
+  rot_Body_z = GenerateRandP(0,360,n,rng) # [deg]
+  q_Body = GenerateQBody_batch(np.zeros(n),np.zeros(n),rot_Body_z) # [-]
+  # Sun's positions (Assumed on Y-axis in this example)
+  pos_Sun = np.zeros((n,3)) # [BU]
+  pos_Sun[:,1] = params['R_max']*1e3
+  return BuildLABEL(i0+np.arange(n),np.zeros((n,3)),q_Body,pos_Cam,q_Cam,pos_Sun)
+
+def GenerateCloudStream(output_name,nPoints,params,seed=None,chunk_size=1000000,n_workers=1,output_format='txt'):
+  '''
+  This function generates nPoints poses in chunks of chunk_size and writes them to
+  output_name as they are produced. At most n_workers chunks are held in memory.
+  The output is deterministic for a given (seed, chunk_size), whatever n_workers.
+  Returns the path of the written file.
+
+  # Arguments
+      output_name: string, output path without extension.
+      nPoints: scalar, total number of poses.
+      params: dict with R_min, R_max, theta_min, theta_max, phi_min, phi_max.
+      seed: integer seed of the run. If None, fresh entropy is drawn and printed.
+      chunk_size: scalar, number of poses per chunk.
+      n_workers: scalar, number of processes generating chunks in parallel.
+      output_format: string, 'txt' or 'npy' (binary pose store).
+  '''
+  seed_seq = np.random.SeedSequence(seed)
+  print('Cloud seed (entropy):', seed_seq.entropy)
+  n_chunks = int(np.ceil(nPoints/chunk_size))
+  chunk_seeds = seed_seq.spawn(n_chunks)
+  chunks_args = [(kk*chunk_size, min(chunk_size, nPoints-kk*chunk_size), chunk_seeds[kk], params) for kk in range(n_chunks)]
+
+  if output_format == 'npy':
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','rendering'))
+    import pose_io
+    output_path = output_name + '.npy'
+    store = pose_io.create_pose_store(output_path, nPoints, source='GenerateCloud.py (seed entropy ' + str(seed_seq.entropy) + ')')
+  else:
+    output_path = output_name + '.txt'
+    file = open(output_path, 'wb')
+
+  pool = multiprocessing.Pool(n_workers) if n_workers > 1 else None
+  try:
+    # Chunks are processed in waves of n_workers to keep memory bounded, and written in order
+    for kk0 in range(0, n_chunks, max(1,n_workers)):
+      wave_args = chunks_args[kk0:kk0+max(1,n_workers)]
+      if pool is None:
+        wave = [GenerateCloudChunk(args) for args in wave_args]
+      else:
+        wave = pool.map(GenerateCloudChunk, wave_args)
+      for args, LABEL_chunk in zip(wave_args, wave):
+        if output_format == 'npy':
+          store[args[0]:args[0]+args[1]] = LABEL_chunk
+        else:
+          np.savetxt(file, LABEL_chunk)
+      print('Generated', min(nPoints,(kk0+len(wave_args))*chunk_size), 'of', nPoints, 'poses')
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+    if output_format == 'npy':
+      store.flush()
+      del store
+    else:
+      file.close()
+  return output_path
+
+if __name__ == '__main__':
+  # Generate output timestamp
+  output_timestamp = GenerateTimestamp()
+  if stream_mode:
+    params = {'R_min': R_min, 'R_max': R_max, 'theta_min': theta_min, 'theta_max': theta_max,
+              'phi_min': phi_min, 'phi_max': phi_max}
+    output_path = GenerateCloudStream('Cloud_' + output_timestamp,nPoints,params,seed,chunk_size,n_workers,output_format)
+    print('Cloud saved to:', output_path)
+  else:
+    # In-memory mode: draws from the global numpy.random state, seeded if requested
+    if seed is not None:
+      np.random.seed(seed)
+
+    # Generate random distribution of camera positions in polar coordinates
+    R_dist = GenerateRandP(R_min,R_max,nPoints) # [BU]
+    theta_dist = GenerateRandP(theta_min,theta_max,nPoints) # [deg]
+    phi_dist = GenerateRandP(phi_min,phi_max,nPoints) # [deg]
+    # Transform from polar to cartesian coordinates
+    [x_Cam_dist,y_Cam_dist,z_Cam_dist] = sph2cart(theta_dist*np.pi/180,phi_dist*np.pi/180,R_dist) # [BU]
+    # Generate camera orientations according to camera positions
+    pos_Cam_dist = np.column_stack([x_Cam_dist,y_Cam_dist,z_Cam_dist]) # [BU]
+    q_Cam_dist = GenerateQSC_origin_batch(pos_Cam_dist) # [-]
+    # Generate Body poses 
+    pos_Body_dist = np.zeros((nPoints,3)) # [BU]
+    rot_Body_x_dist = np.zeros((nPoints,1)) # [deg]
+    rot_Body_y_dist = np.zeros((nPoints,1)) # [deg]
+    rot_Body_z_dist = GenerateRandP(0,360,nPoints) # [deg]
+    q_Body_dist = GenerateQBody_batch(rot_Body_x_dist,rot_Body_y_dist,rot_Body_z_dist) # [-]
+    # Generate Sun's positions (Assumed on Y-axis in this example)
+    pos_Sun_dist = np.zeros((nPoints,3)) # [BU]
+    pos_Sun_dist[:,1] = R_max*1e3
+
+    # Display camera positions (subsampled, scatter plots do not scale to millions of points)
+    if n_plot_max > 0:
+      id_plot = np.arange(0,nPoints,max(1,nPoints//n_plot_max))
+      plt.figure()
+      ax = plt.axes(projection='3d')
+      ax.scatter(x_Cam_dist[id_plot],y_Cam_dist[id_plot],z_Cam_dist[id_plot], c=theta_dist[id_plot], cmap='viridis', linewidth=0.1);
+      plt.axis('equal')
+      plt.xlabel('X axis [BU]')
+      plt.ylabel('Y axis [BU]')
+
+    # Generate LABEL matrix for export
+    LABEL = BuildLABEL(np.arange(nPoints),pos_Body_dist,q_Body_dist,pos_Cam_dist,q_Cam_dist,pos_Sun_dist)
+
+    # Export the LABEL matrix for rendering in CORTO
+    if output_format == 'npy':
+      sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','rendering'))
+      import pose_io
+      pose_io.save_pose_store('Cloud_' + output_timestamp + '.npy', LABEL, source='GenerateCloud.py')
+    else:
+      np.savetxt('Cloud_' + output_timestamp + '.txt', LABEL)
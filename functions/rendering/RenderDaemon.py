@@ -0,0 +1,191 @@
+import bpy
+import os
+import sys
+import json
+import time
+import runpy
+import argparse
+import socket
+import threading
+import traceback
+import socketserver
+
+# Long-lived CORTO render daemon: Blender starts once and keeps the scenario loaded, render jobs (CORTO config
+# plus pose store, see render_jobs.make_job) are run by RenderFromTxt.py inside this process, hence a job for
+# the loaded scenario starts without the Blender startup and .blend loading time.
+# Usage:
+#   blender -b S6_Moon.blend -P RenderDaemon.py -- --spool /data/corto_spool [--port 51100]
+#   python render_jobs.py submit --spool /data/corto_spool -c ALL.txt --geometry Cloud.npy --output /data/run1 --wait
+# Jobs are taken from the spool folder (see render_jobs.py), in submission order. With --port, a control socket
+# on localhost accepts newline-terminated JSON requests ({"op": "submit", "job": {...}}, {"op": "status",
+# "job_id": ...}, {"op": "cancel", "job_id": ...}, {"op": "ping"}) and wakes the daemon up at once on submission.
+# Progress (frames done / total) is written in the status file of the job while it runs.
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import render_jobs
+
+RENDER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'RenderFromTxt.py')
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class RenderDaemon:
+    '''
+    Render job server running inside Blender. Jobs are rendered one at a time on the main thread (bpy).
+
+    # Arguments
+        spoolDir: string, spool folder (created if missing).
+        poll: scalar, polling period of the spool folder when idle [s].
+        statusPeriod: scalar, minimum period of the progress updates of the status file [s].
+    '''
+    def __init__(self, spoolDir: str, poll: float = 0.05, statusPeriod: float = 0.5):
+        self.spoolDir = render_jobs.make_spool(spoolDir)
+        self.poll = float(poll)
+        self.statusPeriod = float(statusPeriod)
+        self.blendFilePath = bpy.data.filepath # Loaded scenario
+        self.wakeup = threading.Event()
+        self.controlServer = None
+        self.currentJobID = None
+        self.nJobs = 0
+        self.tStart = time.time()
+
+    def startControlServer(self, port: int):
+        # Control socket on localhost, served by a background thread. Requests only touch the spool (no bpy)
+        daemon = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    reply = daemon.handleRequest(json.loads(self.rfile.readline().decode('utf-8')))
+                except Exception as exception:
+                    reply = {'error': str(exception)}
+                self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.controlServer = socketserver.ThreadingTCPServer(('127.0.0.1', int(port)), RequestHandler)
+        self.controlServer.daemon_threads = True
+        threading.Thread(target=self.controlServer.serve_forever, name='corto-daemon-control', daemon=True).start()
+        print('Render daemon control socket on 127.0.0.1:' + str(port))
+
+    def handleRequest(self, request: dict) -> dict:
+        op = request.get('op')
+        if op == 'submit':
+            jobID = render_jobs.submit_job(self.spoolDir, request['job'])
+            self.wakeup.set()
+            return {'job_id': jobID}
+        if op == 'status':
+            return render_jobs.job_status(self.spoolDir, request['job_id']) or {'error': 'Unknown job ' + str(request['job_id'])}
+        if op == 'cancel':
+            render_jobs.cancel_job(self.spoolDir, request['job_id']) # Raises (error reply) if not queued or running
+            return {'job_id': request['job_id']}
+        if op == 'ping':
+            return {'pid': os.getpid(), 'blend': self.blendFilePath, 'spool': self.spoolDir, 'current_job': self.currentJobID,
+                    'jobs_served': self.nJobs, 'uptime_s': time.time() - self.tStart}
+        return {'error': 'Unknown op ' + str(op)}
+
+    def writeStatus(self, status: dict):
+        render_jobs.write_json_atomic(os.path.join(self.spoolDir, 'status', status['job_id'] + '.json'), status)
+
+    def loadScenario(self, blendFilePath: str):
+        # Open another .blend file (or reload the current one): slow, the scene is loaded from scratch
+        print('Loading scenario:', blendFilePath)
+        bpy.ops.wm.open_mainfile(filepath=blendFilePath)
+        self.blendFilePath = bpy.data.filepath
+
+    def runJob(self, job: dict):
+        # Render one claimed job and record its final state
+        jobID = job['job_id']
+        tClaimed = time.time()
+        self.currentJobID = jobID
+        status = {'job_id': jobID, 'state': 'running', 'submitted': job.get('submitted'), 'started': tClaimed,
+                  'daemon_pid': os.getpid(), 'daemon_host': socket.gethostname(), 'config': job['config'], 'frames_done': 0, 'frames_total': None,
+                  'output': job.get('output', '')}
+        self.writeStatus(status)
+        lastWrite = [0.0]
+        cancelled = [False]
+
+        def progress(nDone, nTotal, outputFolder):
+            # Called by RenderFromTxt.py before the first frame and after each frame
+            if nDone == 0:
+                status['startup_s'] = time.time() - tClaimed # Claim to first frame: the job start latency
+            status.update({'frames_done': nDone, 'frames_total': nTotal, 'output': outputFolder})
+            if render_jobs.is_cancel_requested(self.spoolDir, jobID):
+                cancelled[0] = True
+                raise JobCancelled('Job ' + jobID + ' cancelled after ' + str(nDone) + ' frames')
+            if nDone == 0 or nDone == nTotal or time.time() - lastWrite[0] >= self.statusPeriod:
+                self.writeStatus(status)
+                lastWrite[0] = time.time()
+
+        argv = sys.argv
+        try:
+            blendFilePath = job.get('blend', '') or self.blendFilePath
+            status['warm'] = not(job.get('reload', False)) and (job.get('blend', '') == '' or
+                                                                os.path.abspath(blendFilePath) == os.path.abspath(self.blendFilePath or ''))
+            if not(status['warm']):
+                tLoad = time.time()
+                self.loadScenario(blendFilePath)
+                status['load_s'] = time.time() - tLoad
+            status['blend'] = self.blendFilePath
+            # RenderFromTxt.py reads its arguments from sys.argv, after '--'
+            sys.argv = [RENDER_SCRIPT, '--', '-c', job['config']]
+            if job.get('geometry', '') != '':
+                sys.argv += ['--geometry', job['geometry']]
+            if job.get('output', '') != '':
+                sys.argv += ['--output', job['output']]
+            sys.argv += list(job.get('args', []))
+            print('JOB', jobID, '- STARTED:', ' '.join(sys.argv[1:]))
+            runpy.run_path(RENDER_SCRIPT, init_globals={'PROGRESS_CALLBACK': progress}, run_name='__main__')
+            state = 'done'
+        except Exception:
+            state = 'cancelled' if cancelled[0] else 'failed'
+            if state == 'failed':
+                status['error'] = traceback.format_exc(limit=20)
+                print('JOB', jobID, '- FAILED:\n', status['error'])
+        finally:
+            sys.argv = argv
+            self.currentJobID = None
+        status.update({'state': state, 'finished': time.time(), 'elapsed_s': time.time() - tClaimed})
+        self.writeStatus(status)
+        render_jobs.finish_job(self.spoolDir, jobID, state)
+        if os.path.exists(os.path.join(self.spoolDir, 'cancel', jobID)):
+            os.remove(os.path.join(self.spoolDir, 'cancel', jobID))
+        self.nJobs += 1
+        print('JOB', jobID, '-', state.upper(), 'after', round(status['elapsed_s'], 3), 's -', status['frames_done'], 'frames')
+
+    def serve(self, maxJobs: int = 0):
+        # Serve jobs until interrupted (or until maxJobs jobs are served, if > 0)
+        for jobID in render_jobs.recover_orphan_jobs(self.spoolDir):
+            print('JOB', jobID, '- FAILED: left running by a terminated daemon')
+        print('CORTO render daemon ready - scenario:', self.blendFilePath, '- spool:', self.spoolDir)
+        try:
+            while maxJobs <= 0 or self.nJobs < maxJobs:
+                job = render_jobs.claim_next_job(self.spoolDir)
+                if job is None:
+                    self.wakeup.wait(self.poll)
+                    self.wakeup.clear()
+                    continue
+                self.runJob(job)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.controlServer is not None:
+                self.controlServer.shutdown()
+                self.controlServer.server_close()
+            print('CORTO render daemon stopped after', self.nJobs, 'jobs')
+
+
+if __name__ == '__main__':
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(description='CORTO render daemon (run inside Blender).')
+    parser.add_argument('--spool', required=True, help='Spool folder of the jobs')
+    parser.add_argument('--port', type=int, default=0, help='Control socket port on localhost (0: disabled)')
+    parser.add_argument('--poll', type=float, default=0.05, help='Polling period of the spool folder [s]')
+    parser.add_argument('--max-jobs', type=int, default=0, help='Exit after this number of jobs (0: never)')
+    args = parser.parse_args(argv)
+
+    daemon = RenderDaemon(args.spool, args.poll)
+    if args.port > 0:
+        daemon.startControlServer(args.port)
+    daemon.serve(args.max_jobs)
@@ -6,10 +6,21 @@ import os
 import time
 import math
 import sys
+import re
+import shutil
+import tempfile
 
 from random import randint
 from datetime import datetime
 
+# Helper modules living next to this script
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import pose_io
+import config_cache
+from async_writer import AsyncWriter
+from render_manifest import RenderManifest
+from stage_timer import StageTimer
+
 ######[1]  (START) INPUT SECTION (START) [1]######
 filenameext = 'C:\\devDir\\corto_PeterCdev\\input\\ALL.txt'
 #filenameext = 'ENTER THE PATH where your "ALL.txt" is saved '
@@ -51,14 +62,49 @@ if ('-c' in sys.argv) or ('--config' in sys.argv):
         if configExt == '.json':
             import json
             from pprint import pprint
+        elif configExt == '.txt':
+            print('Using .txt config mode from specified config file')
         else: 
-            raise Exception('\nExecution stopped: config. path does not point to a valid .json file.')
+            raise Exception('\nExecution stopped: config. path does not point to a valid .json or .txt file.')
 else:
     print('Using .txt config mode from default config file:', filenameext)
     configFilePath = filenameext
     configExt = '.txt'
-    time.sleep(1)
 
+def GetArgValues(flags, nValues):
+    # Return the nValues strings following one of the flags in sys.argv, None if the flag is absent
+    index = [id for id,x in enumerate(sys.argv) if x in flags]
+    if len(index) == 0:
+        return None
+    if len(index) != 1:
+        raise Exception('\nExecution stopped: multiple specifications of ' + '/'.join(flags) + ' argument detected.')
+    values = sys.argv[index[0]+1:index[0]+1+nValues]
+    if len(values) != nValues:
+        raise Exception('\nExecution stopped: ' + '/'.join(flags) + ' requires ' + str(nValues) + ' value(s).')
+    return values
+
+# Frames subset (used by RenderSharded.py): --range i0 i1 renders [i0, i1), --shard k N renders the
+# k-th of N contiguous blocks (or every N-th frame from k with --interleaved)
+frameRangeArg = GetArgValues(['--range'], 2)
+frameShardArg = GetArgValues(['--shard'], 2)
+shardInterleaved = '--interleaved' in sys.argv
+# Number of CPU threads used by Cycles (default: all)
+renderThreadsArg = GetArgValues(['--threads'], 1)
+# Output dataset folder, used as is (no timestamped subfolder)
+outputFolderArg = GetArgValues(['--output'], 1)
+# Resume the most recent timestamped dataset folder of the scenario instead of creating a new one
+resumeLatest = '--resume' in sys.argv
+# Geometry file (.txt config mode), used instead of the one named in the config next to the .blend file
+geometryFileArg = GetArgValues(['--geometry'], 1)
+# Progress callback(nDone, nTotal, outputFolder), defined when the script is run by the render daemon (RenderDaemon.py)
+PROGRESS_CALLBACK = globals().get('PROGRESS_CALLBACK', None)
+# Parse the config (and text geometry file) again instead of reusing the parsed-config cache (see config_cache.py)
+noConfigCache = '--no-config-cache' in sys.argv
+
+
+# Depth label output formats (scene_depthFormat): float32 .npy, compressed float32 .npz, float16 .npy, legacy text
+DEPTH_FORMATS = ['npy', 'npz', 'half', 'txt']
+DEPTH_FORMAT_DEFAULT = 'npy'
 
 ###### [2] PARSER FUNCTIONS DEFINITIONS [2]###### 
 
@@ -107,6 +153,7 @@ def read_parse_configJSON(configJSONfilePath):
     scene['labelDepth']  = SceneData['labelDepth'] 
     scene['labelID']     = SceneData['labelID'] 
     scene['labelSlopes'] = SceneData['labelSlopes'] 
+    scene['depthFormat'] = SceneData.get('depthFormat', DEPTH_FORMAT_DEFAULT)
 
     # BODY
     body['name'] = SceneData['scenarioName']
@@ -122,6 +169,9 @@ def read_parse_configJSON(configJSONfilePath):
 
     corto['savepath'] = os.path.normpath(BlenderOpts['savepath'])
     corto['redirect_output'] = BlenderOpts.get('redirect_output', False)
+    corto['writerThreads'] = BlenderOpts.get('writerThreads', 0)
+    corto['scratchpath'] = BlenderOpts.get('scratchpath', '')
+    corto['timing'] = BlenderOpts.get('timing', 1)
 
     # Handle invalid savepath specification defaulting to "output" folder
     if 'savepath' in BlenderOpts and os.path.isdir(os.path.normpath(BlenderOpts['savepath'])):
@@ -134,13 +184,14 @@ def read_parse_configJSON(configJSONfilePath):
         os.chdir(currentPath) # Return to script execution directory
         print(corto['savepath'])
 
-    # CAMERA, TARGET and ILLUMINATIONs
-    data['rStateCam']    = np.array(SceneData['rStateCam'])    
-    data['rTargetBody']  = np.array(SceneData['rTargetBody'])
-    data['rSun']         = np.array(SceneData['rSun'])         
-    data['qFromCAMtoIN'] = np.array(SceneData['qFromINtoCAM'])
-    data['qFromTFtoIN']  = np.array(SceneData['qFromINtoTF'])  
-    data['ID']           = np.arange(len(SceneData['rStateCam'])).flatten()
+    # CAMERA, TARGET and ILLUMINATIONs: inline lists or binary sidecar arrays (see pose_io.load_config_array)
+    configDir = os.path.dirname(os.path.abspath(configJSONfilePath))
+    data['rStateCam']    = pose_io.load_config_array(SceneData['rStateCam'], configDir, 'rStateCam')
+    data['rTargetBody']  = pose_io.load_config_array(SceneData['rTargetBody'], configDir, 'rTargetBody')
+    data['rSun']         = pose_io.load_config_array(SceneData['rSun'], configDir, 'rSun')
+    data['qFromCAMtoIN'] = pose_io.load_config_array(SceneData['qFromINtoCAM'], configDir, 'qFromINtoCAM')
+    data['qFromTFtoIN']  = pose_io.load_config_array(SceneData['qFromINtoTF'], configDir, 'qFromINtoTF')
+    data['ID']           = np.arange(data['rStateCam'].shape[0]).flatten()
 
     geometry['ii0'] = 0 # Initial index for rendering
 
@@ -212,9 +263,10 @@ def read_parse_configTXT(configTXTfilePath):
 ###### [1] SETUP FUNCTIONS DEFINITIONS [1]######
 
 def PositionAll(ii):
-    POS_BODY_ii = R_pos_BODY[ii,:]
+    # Positions are scaled per frame: pose arrays may be memory-mapped views, read lazily
+    POS_BODY_ii = R_pos_BODY[ii,:]*scale_BU
     OR_BODY_ii = R_q_BODY[ii,:]
-    POS_SC_ii = R_pos_SC[ii,:]
+    POS_SC_ii = R_pos_SC[ii,:]*scale_BU
     OR_SC_ii = R_q_SC[ii,:]
     POS_SUN_ii = R_pos_SUN[ii,:]
     # BODY position
@@ -263,10 +315,89 @@ def ApplyScattering(SG_name,POS_camera_ii, POS_SUN_ii, function, albedo):
 
 def Render(ii):
     name = '{}.png'.format(str(int(ii+1)).zfill(6))
-    bpy.context.scene.render.filepath = os.path.join(output_img_savepath,name)
-    bpy.ops.render.render(write_still = 1)    
+    if WRITER is None:
+        bpy.context.scene.render.filepath = os.path.join(output_img_savepath,name)
+    else:
+        # Async mode: render to local scratch, the writer moves the file to the dataset folder
+        bpy.context.scene.render.filepath = os.path.join(scratch_current_savepath,'img',name)
+    bpy.ops.render.render(write_still = 1) # Blocking: returns when Cycles and the compositor are done
+    # Readiness check: write_still is synchronous, a missing file means the render failed
+    if not(os.path.isfile(bpy.context.scene.render.filepath)):
+        raise Exception('Render of frame ' + str(ii) + ' did not produce ' + bpy.context.scene.render.filepath)
+    return
+
+def WaitViewerNode(timeout=5.0):
+    # Readiness check on the compositor Viewer Node used for labels: returns as soon as its buffer is
+    # allocated (normally already true when render() returns). No fixed delay is applied.
+    t0 = time.perf_counter()
+    while True:
+        if 'Viewer Node' in bpy.data.images:
+            z = bpy.data.images['Viewer Node']
+            if z.size[0] > 0 and z.size[1] > 0:
+                return z
+        if time.perf_counter() - t0 > timeout:
+            raise Exception('Viewer Node not ready after ' + str(timeout) + ' s. Check the compositor node tree.')
+        time.sleep(0.001)
+
+def RenderFrame(ii):
+    # Frame pipeline: each stage returns only once its work is complete. Stages are timed by TIMER
+    # [a] Position bodies, camera and Sun
+    with TIMER.stage('position'):
+        print('Position bodies')
+        PositionAll(ii)
+        #ApplyScattering(bpy.data.node_groups["ScatteringGroup_D1"],R_pos_SC[ii],R_pos_SUN[ii],scene['scattering'],albedo)
+    # [b] Depsgraph update: a single evaluation applies all the changes above
+    with TIMER.stage('depsgraph'):
+        bpy.context.view_layer.update()
+    # [c] Render and save image
+    with TIMER.stage('render'):
+        print('--------------Rendering---------------')
+        Render(ii)
+    # [d] Save labels
+    depthOutput = None
+    if scene['labelDepth'] == 1:
+        with TIMER.stage('depth'):
+            depthOutput = SaveDepth(ii)
+    # [e] Record the frame as completed. Async mode: hand off the frame outputs to the writer, which
+    # records it once they are all on disk, and move on to the next frame
+    with TIMER.stage('complete'):
+        if WRITER is not None:
+            HandOffFrame(ii, depthOutput) # Blocks if the writer queue is full
+        else:
+            MANIFEST.markDone(ii)
     return
 
+def HandOffFrame(ii, depthOutput):
+    # Detach the scratch folder holding the outputs of frame ii (rename is instantaneous) and
+    # queue the transfer of its content to the dataset folder
+    pending_savepath = os.path.join(scratch_savepath, 'frame_{num:06d}'.format(num=(ii+1)))
+    os.rename(scratch_current_savepath, pending_savepath)
+    MakeScratchDirs()
+    WRITER.submit(CompleteFrame, ii, pending_savepath, {'img': output_img_savepath, 'label': output_label_savepath}, depthOutput)
+
+def CompleteFrame(ii, pending_savepath, destinations, depthOutput):
+    # Writer job: all outputs of frame ii are written by the same job, then the frame is recorded
+    if depthOutput is not None:
+        # depthOutput = (file path, depth map). The buffer is allocated per frame and owned by the writer
+        WriteDepth(depthOutput[0], depthOutput[1], scene['depthFormat'])
+    MoveFrameOutputs(pending_savepath, destinations)
+    MANIFEST.markDone(ii)
+
+def MoveFrameOutputs(pending_savepath, destinations):
+    # Writer job: move every file of a detached scratch folder to its destination, keeping relative paths
+    for (subfolder, destination) in destinations.items():
+        source = os.path.join(pending_savepath, subfolder)
+        for (dirpath, _, filenames) in os.walk(source):
+            targetDir = os.path.join(destination, os.path.relpath(dirpath, source))
+            os.makedirs(targetDir, exist_ok=True)
+            for filename in filenames:
+                shutil.move(os.path.join(dirpath, filename), os.path.join(targetDir, filename))
+    shutil.rmtree(pending_savepath)
+
+def MakeScratchDirs():
+    os.makedirs(os.path.join(scratch_current_savepath, 'img'), exist_ok=True)
+    os.makedirs(os.path.join(scratch_current_savepath, 'label'), exist_ok=True)
+
 def MakeDir(path):
     try:
         os.mkdir(path)
@@ -280,22 +411,92 @@ def SetKeyframe(ii):
     bpy.context.scene.frame_current = ii
 
 def SaveDepth(ii):
-    """Obtains depth map from Blender render.
-    return: The depth map of the rendered camera view as a numpy array of size (H,W).
+    """Obtains depth map from Blender render and saves it in the configured scene['depthFormat'].
+    In async mode the depth map is only read: writing is left to the writer job of the frame.
+    return: (file path without extension, depth map of the rendered camera view as numpy array of size (H,W)).
     """
-    z = bpy.data.images['Viewer Node'] # Get output array from Blender 
-    height, width = z.size
+    z = WaitViewerNode() # Get output array from Blender 
+    width, height = z.size
     print("Got Depth map of size: ", z.size)
 
-    dmap = np.array(z.pixels, dtype=np.int16) # convert to numpy array
+    # Read float depth into a preallocated buffer (no Python float objects, no int16 truncation)
+    pixels = np.empty(width*height*4, dtype=np.float32)
+    z.pixels.foreach_get(pixels)
     # Reshape into image array as [H, W, Depth]
-    dmap = np.reshape(dmap, (height, width, 4))[:,:,0]
+    dmap = np.reshape(pixels, (height, width, 4))[:,:,0]
     
     dmap = np.rot90(dmap, k=2)
     dmap = np.fliplr(dmap)
     txtname = '{num:06d}'
-    np.savetxt(os.path.join(output_label_savepath, 'depth', txtname.format(num=(ii+1)) + '.txt'), dmap, delimiter=' ',fmt='%.5f')
-    return
+    depthFilePath = os.path.join(output_label_savepath, 'depth', txtname.format(num=(ii+1)))
+    if WRITER is None:
+        WriteDepth(depthFilePath, dmap, scene['depthFormat'])
+    return depthFilePath, dmap
+
+def WriteDepth(filePathNoExt, dmap, depthFormat):
+    # Write depth map to disk. Extension is appended according to the format
+    if depthFormat == 'npy':
+        np.save(filePathNoExt + '.npy', dmap.astype(np.float32, copy=False))
+    elif depthFormat == 'npz':
+        np.savez_compressed(filePathNoExt + '.npz', depth=dmap.astype(np.float32, copy=False))
+    elif depthFormat == 'half':
+        np.save(filePathNoExt + '.npy', dmap.astype(np.float16))
+    elif depthFormat == 'txt':
+        np.savetxt(filePathNoExt + '.txt', dmap, delimiter=' ',fmt='%.5f')
+    else:
+        raise Exception('Invalid depth format ' + str(depthFormat) + '. Supported: ' + str(DEPTH_FORMATS))
+
+def FindGeometryFile(folder, name):
+    # Return the first existing geometry file among the supported extensions (binary pose store first)
+    geometryExts = [pose_io.POSE_STORE_EXT] + pose_io.GEOMETRY_TXT_EXTS
+    for ext in geometryExts:
+        filePath = os.path.join(folder, name + ext)
+        if os.path.isfile(filePath):
+            return filePath
+    raise Exception('Geometry file ' + name + ' NOT FOUND in ' + folder + '. Supported extensions: ' + str(geometryExts))
+
+def GetFramesToRender(ii0, nFrames):
+    # Indices of the frames rendered by this process, according to --range/--shard arguments
+    frames = range(ii0, nFrames, 1)
+    if frameRangeArg is not None:
+        frames = range(max(ii0, int(frameRangeArg[0])), min(nFrames, int(frameRangeArg[1])), 1)
+    if frameShardArg is not None:
+        (shardID, nShards) = (int(frameShardArg[0]), int(frameShardArg[1]))
+        if not(0 <= shardID < nShards):
+            raise Exception('Invalid --shard ' + str(shardID) + ' ' + str(nShards))
+        if shardInterleaved:
+            frames = frames[shardID::nShards]
+        else:
+            (blockSize, blockRem) = divmod(len(frames), nShards)
+            start = shardID*blockSize + min(shardID, blockRem)
+            frames = frames[start:start + blockSize + (1 if shardID < blockRem else 0)]
+    return frames
+
+def FindLatestOutputFolder(savepath, prefix):
+    # Most recent timestamped dataset folder <prefix>_<timestamp> in savepath, None if there is none.
+    # Exact names only: the folders of scenarios extending the prefix (S5_Didymos_Milani for S5_Didymos) are skipped
+    if not(os.path.isdir(savepath)):
+        return None
+    folderPattern = re.compile(re.escape(prefix) + r'_\d{4}(_\d{2}){5}') # GenerateTimestamp() format
+    candidates = sorted([folder for folder in os.listdir(savepath)
+                         if folderPattern.fullmatch(folder) and os.path.isdir(os.path.join(savepath, folder))])
+    if len(candidates) == 0:
+        return None
+    return os.path.join(savepath, candidates[-1])
+
+def RemovePartialFrames(manifest, frames):
+    # Delete the image and depth files of frames of this process left incomplete by a previous run.
+    # Frames of other processes (shards) are never touched: they may be in progress
+    nRemoved = 0
+    for folder in [output_img_savepath, os.path.join(output_label_savepath, 'depth')]:
+        if not(os.path.isdir(folder)):
+            continue
+        for filename in os.listdir(folder):
+            (frameName, _) = os.path.splitext(filename)
+            if frameName.isdigit() and (int(frameName)-1) in frames and not(manifest.isDone(int(frameName)-1)):
+                os.remove(os.path.join(folder, filename))
+                nRemoved += 1
+    return nRemoved
 
 def GenerateTimestamp():
     timestamp = datetime.now()
@@ -306,20 +507,31 @@ def GenerateTimestamp():
 ##################### MAIN STARTS HERE ###########################
 if __name__ == '__main__': # Blender call makes this script to run as main
     try:
+        # Parse results are reused across launches while the config, its pose arrays and this code are unchanged
+        configCacheDir = None if noConfigCache else config_cache.cache_dir_for(configFilePath)
+        parserCodeFiles = [os.path.abspath(__file__), pose_io.__file__]
         if configExt == '.json':
             print('USING JSON config mode... ')
-            body, geometry, scene, corto, scenarioData = read_parse_configJSON(configFilePath)
+            body, geometry, scene, corto, scenarioData = config_cache.cached_call(
+                'json', [configFilePath], lambda: read_parse_configJSON(configFilePath), configCacheDir, parserCodeFiles)
             print('CONFIG file loading: COMPLETED')
-            time.sleep(1)
 
         elif configExt == '.txt':
             print('USING TXT config mode')
-            body, geometry, scene, corto = read_parse_configTXT(configFilePath)
+            body, geometry, scene, corto = config_cache.cached_call(
+                'txt', [configFilePath], lambda: read_parse_configTXT(configFilePath), configCacheDir, parserCodeFiles)
             print('CONFIG file loading: COMPLETED')
-            time.sleep(1)   
         else:
             raise Exception('Invalid configuration file extension. Supported: [.json, .txt]')
 
+        scene.setdefault('depthFormat', DEPTH_FORMAT_DEFAULT)
+        corto.setdefault('redirect_output', False)
+        corto.setdefault('writerThreads', 0) # Number of async writer threads. 0: synchronous writes
+        corto.setdefault('scratchpath', '') # Local folder for async mode. Empty: system temporary folder
+        corto.setdefault('timing', 1) # Per-stage timing trace and summary. 0: disabled
+        if scene['depthFormat'] not in DEPTH_FORMATS:
+            raise Exception('Invalid scene_depthFormat ' + str(scene['depthFormat']) + '. Supported: ' + str(DEPTH_FORMATS))
+
         ######[2]  SETUP OBJ PROPERTIES [2]######
         # PeterC dev. note: ideally scale_BU should be read from the Blender model, such that input units are allowed to be in the agreed SI units, i.e. km without modifications
         # Set object names
@@ -424,6 +636,10 @@ if __name__ == '__main__': # Blender call makes this script to run as main
         # Set the device_type
         bpy.context.preferences.addons["cycles"].preferences.compute_device_type = "CUDA"
 
+        if renderThreadsArg is not None:
+            bpy.context.scene.render.threads_mode = 'FIXED'
+            bpy.context.scene.render.threads = int(renderThreadsArg[0])
+
         ######[3]  EXTRACT DATA FROM CONFIG FILE [3]######
         try:
             print('DATA Loading: STARTED')
@@ -433,31 +649,29 @@ if __name__ == '__main__': # Blender call makes this script to run as main
                 HOW_MANY_FRAMES = len(ID_pose)
                 print(HOW_MANY_FRAMES)
                 # Body
-                R_pos_BODY = scenarioData['rTargetBody']*scale_BU # (BU) 
+                R_pos_BODY = scenarioData['rTargetBody'] # (BU, scaled in PositionAll) 
                 R_q_BODY = scenarioData['qFromTFtoIN'] #from_txt[:,4:8] # (-) 
                 # Camera
-                R_pos_SC = scenarioData['rStateCam']*scale_BU #from_txt[:,8:11]*scale_BU # (BU) 
+                R_pos_SC = scenarioData['rStateCam'] #from_txt[:,8:11] # (BU, scaled in PositionAll) 
                 R_q_SC = scenarioData['qFromCAMtoIN'] # from_txt[:,11:15] # (-) 
                 # Sun 
                 R_pos_SUN = scenarioData['rSun'] #from_txt[:,15:18] # (BU) 
             elif configExt == '.txt':
                     #I/O pathsSSSSS
                 home_path = bpy.path.abspath("//")
-                txt_path = os.path.join(home_path, geometry['name'] + '.txt')
-                n_rows = len(open(os.path.join(txt_path)).readlines())
-                n_col = 18 # HARDCODED: PeterC comment: SPLIT is critically dependend on this value!
-                HOW_MANY_FRAMES = n_rows
-                from_txt = np.zeros((n_rows,n_col))
-
-                file = open(os.path.join(txt_path),'r',newline = '')
-                ii=0
-                for line in file:
-                    fields = line.split(" ")
-                    for jj in range(0,n_col,1):
-                        from_txt[ii,jj] = float(fields[jj])
-                    ii = ii+1
-
-                file.close()
+                # Geometry file may be a .npy pose store (memory-mapped) or plain/compressed text
+                if geometryFileArg is not None:
+                    txt_path = os.path.abspath(geometryFileArg[0])
+                else:
+                    txt_path = FindGeometryFile(home_path, geometry['name'])
+                print('Geometry file:', txt_path)
+                if txt_path.lower().endswith(pose_io.POSE_STORE_EXT):
+                    from_txt = pose_io.load_geometry(txt_path) # Shape checked. Slices below are views, not copies
+                else:
+                    # Text geometry parsed once, then memory-mapped from the config cache
+                    from_txt = config_cache.cached_call('geometry', [txt_path], lambda: pose_io.load_geometry(txt_path),
+                                                        configCacheDir, [pose_io.__file__])
+                HOW_MANY_FRAMES = from_txt.shape[0]
                 # [0] ID or ET
                 # [1,2,3] Body pos [BU] and [4,5,6,7] orientation [-]
                 # [8,9,10] Camera pos [BU] and [11,12,13,14] orientation [-] # TO CHECK: WHICH QUATERNION CONVENTION?
@@ -466,10 +680,10 @@ if __name__ == '__main__': # Blender call makes this script to run as main
                 # ID
                 ID_pose = from_txt[:,0]
                 # Body
-                R_pos_BODY = from_txt[:,1:4]*scale_BU # (BU) 
+                R_pos_BODY = from_txt[:,1:4] # (BU, scaled in PositionAll) 
                 R_q_BODY = from_txt[:,4:8] # (-) 
                 # Camera
-                R_pos_SC = from_txt[:,8:11]*scale_BU # (BU) 
+                R_pos_SC = from_txt[:,8:11] # (BU, scaled in PositionAll) 
                 R_q_SC = from_txt[:,11:15] # (-) 
                 # Sun 
                 R_pos_SUN = from_txt[:,15:18] # (BU) 
@@ -484,10 +698,19 @@ if __name__ == '__main__': # Blender call makes this script to run as main
         ### CYCLIC RENDERINGS ###
         print('RENDERING routine: STARTED')
 
-        if corto['redirect_output'] == False:
-            output_timestamp = GenerateTimestamp()
-            output_folderName = body['name'] + '_' + output_timestamp
-            output_savepath = os.path.join(corto['savepath'],output_folderName)
+        if outputFolderArg is not None:
+            output_savepath = os.path.abspath(outputFolderArg[0])
+            output_img_savepath = os.path.join(output_savepath,'img')
+            output_label_savepath = os.path.join(output_savepath,'label')
+        elif corto['redirect_output'] == False:
+            output_savepath = None
+            if resumeLatest:
+                output_savepath = FindLatestOutputFolder(corto['savepath'], body['name'])
+                print('Resuming dataset folder:', output_savepath)
+            if output_savepath is None:
+                output_timestamp = GenerateTimestamp()
+                output_folderName = body['name'] + '_' + output_timestamp
+                output_savepath = os.path.join(corto['savepath'],output_folderName)
             output_img_savepath = os.path.join(output_savepath,'img')
             output_label_savepath = os.path.join(output_savepath,'label')
         else:
@@ -502,6 +725,26 @@ if __name__ == '__main__': # Blender call makes this script to run as main
         if not(os.path.isdir(output_img_savepath)):
             MakeDir(output_img_savepath)
 
+        # Frames before geometry['ii0'] are never touched: pose rows are sliced lazily from ii0 onward
+        FRAMES_OF_PROCESS = GetFramesToRender(geometry['ii0'], HOW_MANY_FRAMES)
+        # Completed frames manifest: one file per shard, all of them are read
+        MANIFEST = RenderManifest(output_savepath, tag=('shard_' + frameShardArg[0] if frameShardArg is not None else ''))
+        if MANIFEST.nDone() > 0:
+            print('Manifest found:', MANIFEST.nDone(), 'frames already completed. Partial frames removed:',
+                  RemovePartialFrames(MANIFEST, set(FRAMES_OF_PROCESS)))
+
+        # Async writer stage (optional)
+        if corto['writerThreads'] > 0:
+            WRITER = AsyncWriter(corto['writerThreads'])
+            scratch_savepath = tempfile.mkdtemp(prefix='corto_', dir=(corto['scratchpath'] if corto['scratchpath'] != '' else None))
+            scratch_current_savepath = os.path.join(scratch_savepath, 'current')
+            MakeScratchDirs()
+            label_base_path = os.path.join(scratch_current_savepath, 'label') # Compositor outputs go to scratch too
+            print('Async writer: ENABLED with', corto['writerThreads'], 'threads. Scratch folder:', scratch_savepath)
+        else:
+            WRITER = None
+            label_base_path = output_label_savepath
+
         try:
             if scene['labelDepth'] == 1 or scene['labelID'] == 1 or scene['labelSlopes'] == 1:
                 MakeDir(output_label_savepath)
@@ -509,43 +752,56 @@ if __name__ == '__main__': # Blender call makes this script to run as main
                     MakeDir(os.path.join(output_label_savepath,'depth'))
                 if scene['labelID'] == 1:
                     MakeDir(os.path.join(output_label_savepath,'IDmask'))
-                    bpy.data.scenes["Scene"].node_tree.nodes["MaskOutput"].base_path = output_label_savepath
+                    bpy.data.scenes["Scene"].node_tree.nodes["MaskOutput"].base_path = label_base_path
                     bpy.data.scenes["Scene"].node_tree.nodes['MaskOutput'].file_slots[0].path="\IDmask\Mask_1\######" 
                     bpy.data.scenes["Scene"].node_tree.nodes['MaskOutput'].file_slots[1].path="\IDmask\Mask_1_shadow\######" 
                     bpy.data.scenes["Scene"].node_tree.nodes['MaskOutput'].file_slots[2].path="\IDmask\Mask_2\######"
                     bpy.data.scenes["Scene"].node_tree.nodes['MaskOutput'].file_slots[3].path="\IDmask\Mask_2_shadow\######"
                 if scene['labelSlopes'] == 1:
                     MakeDir(os.path.join(output_label_savepath,'slopes'))
-                    bpy.data.scenes["Scene"].node_tree.nodes["SlopeOutput"].base_path = output_label_savepath
+                    bpy.data.scenes["Scene"].node_tree.nodes["SlopeOutput"].base_path = label_base_path
                     bpy.data.scenes["Scene"].node_tree.nodes['SlopeOutput'].file_slots[0].path="\slopes\######" 
         except:
             print('Scene labels assignments failed: SKIPPING')
 
         ## Cyclic rendering
         SetKeyframe(1)
-        print('RENDERING of', HOW_MANY_FRAMES, ': STARTING...')
-        time.sleep(0.5)
-        for ii in range(0, HOW_MANY_FRAMES,1):
-            SetKeyframe(ii+1)
-            print('---------------Preparing for case: ',ii,'---------------')
-            print('Position bodies')
-            PositionAll(ii)
-            bpy.context.view_layer.update()
-            if ii<geometry['ii0']:
-                print('--------------Not rendering---------------')
-            else:
-                bpy.context.view_layer.update()
-                print('Apply scattering body')
-                #ApplyScattering(bpy.data.node_groups["ScatteringGroup_D1"],R_pos_SC[ii],R_pos_SUN[ii],scene['scattering'],albedo)
-                bpy.context.view_layer.update()
-                time.sleep(2) # For contingency
-                print('--------------Rendering---------------')
-                Render(ii)
-                if scene['labelDepth'] == 1:
-                    SaveDepth(ii)
+        # Per-stage timing trace, written in the dataset folder
+        TIMER = StageTimer(os.path.join(output_savepath, 'timing'), tag=('shard_' + frameShardArg[0] if frameShardArg is not None else ''),
+                           enabled=(corto['timing'] == 1))
+
+        # Completed frames are skipped without touching the scene
+        FRAMES_TO_RENDER = [ii for ii in FRAMES_OF_PROCESS if not(MANIFEST.isDone(ii))]
+        print('RENDERING of', len(FRAMES_TO_RENDER), 'of', HOW_MANY_FRAMES, 'frames: STARTING...')
+        try:
+            # Inside the try: a job cancelled before its first frame (RenderDaemon.py) still releases the resources below
+            if PROGRESS_CALLBACK is not None:
+                PROGRESS_CALLBACK(0, len(FRAMES_TO_RENDER), output_savepath)
+            for (nRendered, ii) in enumerate(FRAMES_TO_RENDER):
+                TIMER.startFrame(ii)
+                SetKeyframe(ii+1)
+                print('---------------Preparing for case: ',ii,'---------------')
+                RenderFrame(ii)
+                TIMER.endFrame()
+                if PROGRESS_CALLBACK is not None:
+                    PROGRESS_CALLBACK(nRendered + 1, len(FRAMES_TO_RENDER), output_savepath)
 
                 # ADD SCENE FIGURE DISPLAY AND UPDATING AFTER EACH RENDERING  
                 # MAKE IT OPTIONAL  
+        finally:
+            try:
+                if WRITER is not None:
+                    # Wait for all pending writes. Writer errors are raised here unless the loop already failed
+                    print('Waiting for async writer to complete', WRITER.pending(), 'pending jobs...')
+                    with TIMER.stage('drain'):
+                        WRITER.close(raiseErrors=(sys.exc_info()[0] is None))
+                    shutil.rmtree(scratch_savepath, ignore_errors=True)
+            finally:
+                # Manifest flushed and timing trace written even when the writer failed
+                try:
+                    MANIFEST.close()
+                finally:
+                    TIMER.close()
     except Exception as errInst:
         print('Error occurred during RenderFromTxt execution from Blender:\n', errInst.args)
         raise ('Error occurred during RenderFromTxt execution from Blender:\n', errInst.args)
\ No newline at end of file
@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import multiprocessing
+
+from datetime import datetime
+
+# Orchestrator for multi-process rendering of a geometry file.
+# Run with a plain Python interpreter (not inside Blender), e.g.:
+#   python RenderSharded.py --blender /opt/blender/blender --blend S6_Moon.blend -c ALL.txt -n 8 --output /data/S6_Moon_run1
+# N headless Blender workers run RenderFromTxt.py on disjoint subsets of the pose rows (--shard k N) with a
+# fixed thread budget each. All workers write in the same dataset folder: images and labels are named after
+# the global pose index, hence frame numbering is consistent without any renaming.
+
+RENDER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'RenderFromTxt.py')
+
+
+def GenerateTimestamp():
+    timestamp = datetime.now()
+    formatted_timestamp = timestamp.strftime("%Y_%m_%d_%H_%M_%S")
+    return formatted_timestamp
+
+
+def BuildWorkerCommand(blenderExe, blendFilePath, configFilePath, shardID, nShards, interleaved, nThreads, outputFolder, extraArgs):
+    '''
+    This function returns the command line of one headless Blender worker
+
+    # Arguments
+        blenderExe: string, path to the Blender executable.
+        blendFilePath: string, scenario .blend file.
+        configFilePath: string, .txt or .json CORTO config file.
+        shardID, nShards: scalars, index of the worker and number of workers.
+        interleaved: bool, if True the worker renders every nShards-th frame, else a contiguous block.
+        nThreads: scalar, number of Cycles threads of the worker.
+        outputFolder: string, dataset folder shared by all workers.
+        extraArgs: list of strings, additional arguments forwarded to RenderFromTxt.py.
+    '''
+    # --python-exit-code: a Python error in the worker must give a non-zero exit code
+    command = [blenderExe, '-b', blendFilePath, '--python-exit-code', '1', '-P', RENDER_SCRIPT, '--',
+               '-c', configFilePath,
+               '--shard', str(shardID), str(nShards),
+               '--threads', str(nThreads),
+               '--output', outputFolder]
+    if interleaved:
+        command.append('--interleaved')
+    return command + list(extraArgs)
+
+
+def CountFiles(folder):
+    nFiles = 0
+    for (_, _, filenames) in os.walk(folder):
+        nFiles += len(filenames)
+    return nFiles
+
+
+def RunShards(blenderExe, blendFilePath, configFilePath, nShards, outputFolder, nThreads=0, interleaved=False, extraArgs=()):
+    '''
+    This function launches nShards Blender workers, waits for their completion and writes a
+    dataset_shards.json summary in the output folder. Returns the list of worker exit codes.
+
+    # Arguments
+        see BuildWorkerCommand. nThreads = 0 splits the available CPUs evenly among workers.
+    '''
+    if nThreads <= 0:
+        nThreads = max(1, multiprocessing.cpu_count() // nShards)
+    outputFolder = os.path.abspath(outputFolder)
+    logsFolder = os.path.join(outputFolder, 'logs')
+    os.makedirs(logsFolder, exist_ok=True)
+    # Created here once, such that workers do not race on folder creation
+    os.makedirs(os.path.join(outputFolder, 'img'), exist_ok=True)
+
+    workers = []
+    for shardID in range(nShards):
+        command = BuildWorkerCommand(blenderExe, os.path.abspath(blendFilePath), os.path.abspath(configFilePath),
+                                     shardID, nShards, interleaved, nThreads, outputFolder, extraArgs)
+        logFile = open(os.path.join(logsFolder, 'shard_{:03d}.log'.format(shardID)), 'w')
+        print('Launching shard', shardID, 'of', nShards, ':', ' '.join(command))
+        workers.append({'id': shardID, 'command': command, 'log': logFile, 't0': time.time(),
+                        'process': subprocess.Popen(command, stdout=logFile, stderr=subprocess.STDOUT)})
+
+    exitCodes = []
+    summary = {'blend': blendFilePath, 'config': configFilePath, 'nShards': nShards, 'threadsPerShard': nThreads,
+               'interleaved': interleaved, 'shards': []}
+    for worker in workers:
+        exitCode = worker['process'].wait()
+        worker['log'].close()
+        elapsed = time.time() - worker['t0']
+        print('Shard', worker['id'], 'terminated with exit code', exitCode, 'after', round(elapsed, 1), 's')
+        exitCodes.append(exitCode)
+        summary['shards'].append({'id': worker['id'], 'exitCode': exitCode, 'elapsed_s': elapsed,
+                                  'command': worker['command']})
+
+    summary['nImages'] = CountFiles(os.path.join(outputFolder, 'img'))
+    with open(os.path.join(outputFolder, 'dataset_shards.json'), 'w') as summaryFile:
+        json.dump(summary, summaryFile, indent=2)
+    print('Dataset folder:', outputFolder, '- images:', summary['nImages'])
+    return exitCodes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a CORTO geometry file with N parallel headless Blender workers.')
+    parser.add_argument('--blender', default='blender', help='Blender executable')
+    parser.add_argument('--blend', required=True, help='Scenario .blend file')
+    parser.add_argument('-c', '--config', required=True, help='CORTO config file (.txt or .json)')
+    parser.add_argument('-n', '--shards', type=int, default=2, help='Number of Blender workers')
+    parser.add_argument('--threads', type=int, default=0, help='Cycles threads per worker (0: CPUs/shards)')
+    parser.add_argument('--interleaved', action='store_true', help='Interleaved instead of contiguous shards')
+    parser.add_argument('--output', default='', help='Dataset folder (default: ./CORTO_<timestamp>)')
+    (args, extraArgs) = parser.parse_known_args()
+
+    outputFolder = args.output if args.output != '' else os.path.join(os.getcwd(), 'CORTO_' + GenerateTimestamp())
+    exitCodes = RunShards(args.blender, args.blend, args.config, args.shards, outputFolder,
+                          args.threads, args.interleaved, extraArgs)
+    sys.exit(0 if all(code == 0 for code in exitCodes) else 1)
@@ -0,0 +1,81 @@
+import queue
+import threading
+import traceback
+
+
+class AsyncWriter:
+    '''
+    Background writer stage for the rendering loop: write jobs (callables) are put in a
+    bounded queue and drained by a pool of threads, such that disk/network I/O overlaps
+    with rendering. When the queue is full, submit() blocks (backpressure).
+    Jobs must not touch bpy: only numpy buffers and files are handed off.
+    The first error raised by a job is re-raised in the submitting thread at the next
+    submit(), check() or close() call.
+
+    # Arguments
+        nThreads: scalar, number of writer threads.
+        maxQueue: scalar, max number of pending jobs. Defaults to 4 jobs per thread.
+    '''
+    def __init__(self, nThreads: int = 2, maxQueue: int = 0):
+        if nThreads < 1:
+            raise Exception('AsyncWriter requires at least one thread.')
+        self.jobs = queue.Queue(maxsize=maxQueue if maxQueue > 0 else 4*nThreads)
+        self.errors = []
+        self.errorsLock = threading.Lock()
+        self.nCompleted = 0
+        self.closed = False
+        self.threads = [threading.Thread(target=self._worker, name='CORTOwriter_' + str(id), daemon=True)
+                        for id in range(nThreads)]
+        for thread in self.threads:
+            thread.start()
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None: # Stop sentinel
+                    return
+                (func, args, kwargs) = job
+                func(*args, **kwargs)
+                with self.errorsLock:
+                    self.nCompleted += 1
+            except Exception as exceptInstance:
+                with self.errorsLock:
+                    self.errors.append((exceptInstance, traceback.format_exc()))
+            finally:
+                self.jobs.task_done()
+
+    def check(self):
+        # Re-raise the first writer error, if any
+        with self.errorsLock:
+            if len(self.errors) > 0:
+                (exceptInstance, trace) = self.errors[0]
+                raise Exception('ERROR occurred in async writer: ' + str(exceptInstance) + '\n' + trace)
+
+    def pending(self) -> int:
+        return self.jobs.qsize()
+
+    def submit(self, func, *args, **kwargs):
+        if self.closed:
+            raise Exception('AsyncWriter already closed.')
+        self.check()
+        self.jobs.put((func, args, kwargs))
+
+    def close(self, raiseErrors: bool = True):
+        # Wait for the queue to drain, stop the threads and surface errors
+        if not(self.closed):
+            self.closed = True
+            for _ in self.threads:
+                self.jobs.put(None)
+            for thread in self.threads:
+                thread.join()
+        if raiseErrors:
+            self.check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, excTraceback):
+        # Do not mask an exception raised in the with-block
+        self.close(raiseErrors=(excType is None))
+        return False
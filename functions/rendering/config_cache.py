@@ -0,0 +1,237 @@
+import os
+import json
+import stat
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# Parsed-config cache of RenderFromTxt.py and testingInterfaces.py. Parsing a config (.txt, .json with inline pose
+# lists) or a text geometry file is done once: the normalized result (dictionaries as JSON, arrays as .npy files,
+# memory-mapped at load) is stored in an entry keyed by a SHA-256 hash of:
+#   - the content of the input files (config file, geometry file) and of the parser code files;
+#   - the kind of parse and CONFIG_CACHE_VERSION.
+# Memory-mapped arrays of the result (binary sidecar arrays of the JSON config) are not copied: the entry stores
+# their file, offset, dtype, shape and order, and maps the file again at load. The entry records these files and
+# the folders named in the result (e.g. savepath): on load, a file whose size or modification time changed, or a
+# folder that disappeared, discards the entry and the inputs are parsed again.
+# Content hashes are memoized by (path, size, modification time) in <cache folder>/file_hashes.json, hence a launch
+# on unchanged inputs only stats the files and memory-maps the arrays.
+# Cache folder: $CORTO_CONFIG_CACHE if set ('0' disables the cache), else .corto_cache next to the config file
+# (system temporary folder if not writable). Only the CONFIG_CACHE_MAX_ENTRIES most recently used entries are kept.
+
+CONFIG_CACHE_VERSION = 1
+CONFIG_CACHE_ENV = 'CORTO_CONFIG_CACHE'
+CONFIG_CACHE_FOLDER = '.corto_cache'
+CONFIG_CACHE_MAX_ENTRIES = 16
+HASH_CHUNK_SIZE = 1 << 22
+ENTRY_FILE = 'entry.json'
+HASHES_FILE = 'file_hashes.json'
+
+
+def cache_dir_for(configFilePath: str):
+    # Cache folder of a config file, None if the cache is disabled or no folder is writable
+    envDir = os.environ.get(CONFIG_CACHE_ENV, '')
+    if envDir.lower() in ['0', 'off', 'none']:
+        return None
+    if envDir != '':
+        candidates = [envDir]
+    else:
+        candidates = [os.path.join(os.path.dirname(os.path.abspath(configFilePath)), CONFIG_CACHE_FOLDER),
+                      os.path.join(tempfile.gettempdir(), 'corto_config_cache')]
+    for cacheDir in candidates:
+        try:
+            os.makedirs(cacheDir, exist_ok=True)
+        except OSError:
+            continue
+        if os.access(cacheDir, os.W_OK):
+            return os.path.abspath(cacheDir)
+    return None
+
+
+def file_fingerprint(path: str):
+    # [size, modification time] of a file, 'dir' for a folder, None if missing
+    try:
+        fileStat = os.stat(path)
+    except OSError:
+        return None
+    if stat.S_ISDIR(fileStat.st_mode):
+        return 'dir'
+    return [fileStat.st_size, fileStat.st_mtime_ns]
+
+
+def _write_json_atomic(filePath: str, content):
+    tmpFilePath = filePath + '.tmp' + str(os.getpid())
+    with open(tmpFilePath, 'w') as file:
+        json.dump(content, file)
+    os.replace(tmpFilePath, filePath)
+
+
+def _file_offset(array: np.memmap) -> int:
+    # Offset in its file of the first element of a memory-mapped array (possibly a view of another memmap)
+    root = array
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    return root.offset + array.__array_interface__['data'][0] - root.__array_interface__['data'][0]
+
+
+def _pack(value, arrays: dict, dependencies: dict):
+    # JSON-serializable copy of a parse result: arrays are replaced by references to the .npy files of the entry,
+    # contiguous memory-mapped arrays by references to their own file
+    if isinstance(value, np.ndarray):
+        if isinstance(value, np.memmap) and value.filename is not None:
+            filePath = os.path.abspath(value.filename)
+            dependencies[filePath] = file_fingerprint(filePath)
+            if value.size > 0 and (value.flags.c_contiguous or value.flags.f_contiguous):
+                return {'__memmap__': filePath, 'offset': _file_offset(value), 'dtype': value.dtype.str,
+                        'shape': list(value.shape), 'order': 'C' if value.flags.c_contiguous else 'F'}
+        name = 'array' + str(len(arrays))
+        arrays[name] = value
+        return {'__ndarray__': name}
+    if isinstance(value, dict):
+        return {'__dict__': [[key, _pack(item, arrays, dependencies)] for (key, item) in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return {'__tuple__' if isinstance(value, tuple) else '__list__': [_pack(item, arrays, dependencies) for item in value]}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, str) and os.path.isabs(value) and os.path.isdir(value):
+        dependencies[value] = 'dir'
+    return value
+
+
+def _unpack(value, entryDir: str):
+    if not(isinstance(value, dict)):
+        return value
+    if '__ndarray__' in value:
+        return np.load(os.path.join(entryDir, value['__ndarray__'] + '.npy'), mmap_mode='r')
+    if '__memmap__' in value:
+        return np.memmap(value['__memmap__'], dtype=np.dtype(value['dtype']), mode='r', offset=value['offset'],
+                         shape=tuple(value['shape']), order=value['order'])
+    if '__dict__' in value:
+        return {key: _unpack(item, entryDir) for (key, item) in value['__dict__']}
+    if '__tuple__' in value:
+        return tuple(_unpack(item, entryDir) for item in value['__tuple__'])
+    return [_unpack(item, entryDir) for item in value['__list__']]
+
+
+class ConfigCache:
+    '''
+    Content-addressed cache of parse results (tuples, dictionaries and numpy arrays), see above.
+
+    # Arguments
+        cacheDir: string, cache folder (see cache_dir_for).
+        maxEntries: scalar, number of most recently used entries kept.
+    '''
+    def __init__(self, cacheDir: str, maxEntries: int = CONFIG_CACHE_MAX_ENTRIES):
+        self.cacheDir = cacheDir
+        self.maxEntries = int(maxEntries)
+        self.hashesFilePath = os.path.join(cacheDir, HASHES_FILE)
+        self.hashes = {}
+        self.hashesChanged = False
+        try:
+            with open(self.hashesFilePath, 'r') as file:
+                self.hashes = json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    def fileHash(self, filePath: str) -> str:
+        # SHA-256 of the content of a file, memoized by path, size and modification time
+        filePath = os.path.abspath(filePath)
+        fingerprint = file_fingerprint(filePath)
+        if fingerprint is None or fingerprint == 'dir':
+            return str(fingerprint)
+        memo = self.hashes.get(filePath)
+        if memo is not None and memo[0] == fingerprint:
+            return memo[1]
+        sha = hashlib.sha256()
+        with open(filePath, 'rb') as file:
+            for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+                sha.update(chunk)
+        self.hashes[filePath] = [fingerprint, sha.hexdigest()]
+        self.hashesChanged = True
+        return sha.hexdigest()
+
+    def key(self, kind: str, inputFiles, codeFiles=()) -> str:
+        sha = hashlib.sha256(('corto-config-cache ' + str(CONFIG_CACHE_VERSION) + ' ' + kind).encode('utf-8'))
+        for filePath in list(inputFiles) + list(codeFiles):
+            sha.update(self.fileHash(filePath).encode('utf-8'))
+        if self.hashesChanged:
+            # Concurrent writers (e.g. shards) may drop each other's memos: only costs a hash on the next launch
+            _write_json_atomic(self.hashesFilePath, self.hashes)
+            self.hashesChanged = False
+        return sha.hexdigest()[:32]
+
+    def load(self, key: str):
+        # Cached result, None if missing or stale
+        entryDir = os.path.join(self.cacheDir, key)
+        try:
+            with open(os.path.join(entryDir, ENTRY_FILE), 'r') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if entry.get('version') != CONFIG_CACHE_VERSION:
+            return None
+        for (path, fingerprint) in entry['dependencies'].items():
+            if file_fingerprint(path) != fingerprint:
+                print('Config cache: ' + path + ' changed, entry discarded.')
+                return None
+        os.utime(entryDir) # Most recently used
+        return _unpack(entry['result'], entryDir)
+
+    def store(self, key: str, result):
+        # Written in a temporary folder renamed at the end: concurrent launches never read partial entries
+        arrays = {}
+        dependencies = {}
+        packed = _pack(result, arrays, dependencies)
+        entryDir = os.path.join(self.cacheDir, key)
+        tmpDir = entryDir + '.tmp' + str(os.getpid())
+        os.makedirs(tmpDir, exist_ok=True)
+        try:
+            for (name, array) in arrays.items():
+                np.save(os.path.join(tmpDir, name + '.npy'), array)
+            with open(os.path.join(tmpDir, ENTRY_FILE), 'w') as file:
+                json.dump({'version': CONFIG_CACHE_VERSION, 'created': time.time(), 'dependencies': dependencies,
+                           'result': packed}, file)
+            if os.path.isdir(entryDir):
+                shutil.rmtree(entryDir, ignore_errors=True) # Stale entry
+            os.rename(tmpDir, entryDir)
+        except OSError:
+            # Entry written meanwhile by another launch (or cache folder not usable): keep going without it
+            shutil.rmtree(tmpDir, ignore_errors=True)
+        self.prune()
+
+    def prune(self):
+        # Remove the least recently used entries beyond maxEntries
+        entries = [os.path.join(self.cacheDir, name) for name in os.listdir(self.cacheDir)
+                   if os.path.isfile(os.path.join(self.cacheDir, name, ENTRY_FILE))]
+        entries.sort(key=lambda entryDir: os.stat(entryDir).st_mtime, reverse=True)
+        for entryDir in entries[self.maxEntries:]:
+            shutil.rmtree(entryDir, ignore_errors=True)
+
+
+def cached_call(kind: str, inputFiles, function, cacheDir: str, codeFiles=()):
+    '''
+    This function returns function() for the given inputs, from the cache if an up-to-date entry exists.
+    The result (tuple/list/dictionary nesting of JSON values and numpy arrays) is stored on a cache miss.
+    Cached arrays are read-only memory maps.
+
+    # Arguments
+        kind: string, kind of parse (part of the key, e.g. 'txt', 'json', 'geometry').
+        inputFiles: list of strings, files read by function (content part of the key).
+        function: function without arguments parsing the inputs.
+        cacheDir: string, cache folder (see cache_dir_for). None: function() is called, no caching.
+        codeFiles: list of strings, source files of the parser (a code change invalidates the entries).
+    '''
+    if cacheDir is None:
+        return function()
+    cache = ConfigCache(cacheDir)
+    key = cache.key(kind, inputFiles, codeFiles)
+    result = cache.load(key)
+    if result is not None:
+        print('Parsed ' + kind + ' input ' + ', '.join(os.path.basename(filePath) for filePath in inputFiles) +
+              ' loaded from cache ' + os.path.join(cacheDir, key))
+        return result
+    result = function()
+    cache.store(key, result)
+    return result
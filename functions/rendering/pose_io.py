@@ -0,0 +1,317 @@
+import os
+import sys
+import gzip
+import bz2
+import lzma
+import json
+import base64
+import numpy as np
+
+# Geometry (pose) files layout, one row per acquisition:
+# [0] ID or ET
+# [1,2,3] Body pos [BU] and [4,5,6,7] orientation [-] (W-XYZ)
+# [8,9,10] Camera pos [BU] and [11,12,13,14] orientation [-] (W-XYZ)
+# [15,16,17] Sun pos [BU]
+GEOMETRY_NCOLS = 18
+GEOMETRY_COLUMNS = ['ID',
+                    'body_x', 'body_y', 'body_z', 'body_qw', 'body_qx', 'body_qy', 'body_qz',
+                    'cam_x', 'cam_y', 'cam_z', 'cam_qw', 'cam_qx', 'cam_qy', 'cam_qz',
+                    'sun_x', 'sun_y', 'sun_z']
+
+# Transparent decompression of geometry files based on their extension
+_TEXT_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open, '.lzma': lzma.open}
+# Extensions searched (in order) when a geometry file is specified by name only
+GEOMETRY_TXT_EXTS = ['.txt', '.txt.gz', '.txt.bz2', '.txt.xz']
+
+# Binary pose store: (N, 18) float64 .npy array (memory-mappable) + small JSON header next to it
+POSE_STORE_EXT = '.npy'
+POSE_STORE_META_EXT = '.meta.json'
+POSE_STORE_FORMAT = 'corto-pose-store'
+POSE_STORE_VERSION = 1
+# Rows converted at once from text, bounds memory use of the converter
+CONVERT_CHUNK_ROWS = 100000
+
+# Pose arrays of the JSON config (SceneData). Each one is either an inline nested list or a reference to binary
+# data, loaded without per-number Python objects:
+#   "rSun": "rSun.npy"                                                  .npy file (memory-mapped)
+#   "rSun": {"file": "rSun.npy"}                                        same, optional "shape" check
+#   "rSun": {"file": "poses.bin", "dtype": "<f8", "shape": [N, 3], "offset": 0, "order": "C"}
+#                                                                       raw binary file (memory-mapped)
+#   "rSun": {"base64": "...", "dtype": "<f8", "shape": [N, 3]}          base64 block inside the JSON
+# Relative paths are relative to the folder of the config file. "order": "F" reads column-major data
+# (e.g. MATLAB fwrite of the N x 3 matrix) without transposing it in memory.
+CONFIG_ARRAYS_DTYPE = '<f8'
+
+
+def open_text(filePath: str):
+    '''
+    This function opens a (possibly compressed) text file for reading
+
+    # Arguments
+        filePath: string, path to the file. Supported compressions: .gz, .bz2, .xz, .lzma
+    '''
+    (_, fileExt) = os.path.splitext(filePath)
+    opener = _TEXT_OPENERS.get(fileExt.lower(), open)
+    return opener(filePath, 'rt')
+
+
+def load_geometry_txt(txtFilePath: str, dtype=np.float64) -> np.ndarray:
+    '''
+    This function loads a geometry .txt file in a single pass as a (N, 18) typed array
+
+    # Arguments
+        txtFilePath: string, path to the geometry file (optionally compressed).
+        dtype: numpy dtype of the output array.
+    '''
+    if not(os.path.isfile(txtFilePath)):
+        raise Exception('Geometry file NOT FOUND: ' + txtFilePath)
+
+    with open_text(txtFilePath) as file:
+        try:
+            poses = np.loadtxt(file, dtype=dtype, ndmin=2)
+        except ValueError as exceptInstance:
+            # numpy reports the offending row and column in the message
+            raise Exception('Malformed geometry file ' + txtFilePath + ': ' + str(exceptInstance))
+
+    if poses.size == 0:
+        raise Exception('Geometry file ' + txtFilePath + ' does not contain any pose.')
+    if poses.shape[1] != GEOMETRY_NCOLS:
+        raise Exception('Geometry file ' + txtFilePath + ' has ' + str(poses.shape[1]) +
+                        ' columns, expected ' + str(GEOMETRY_NCOLS) + '.')
+    return poses
+
+
+def pose_store_meta_path(storePath: str) -> str:
+    # Header file associated to a pose store: Cloud_X.npy -> Cloud_X.meta.json
+    return os.path.splitext(storePath)[0] + POSE_STORE_META_EXT
+
+
+def create_pose_store(storePath: str, nPoses: int, units: str = 'BU', quatConvention: str = 'WXYZ',
+                      source: str = '') -> np.memmap:
+    '''
+    This function creates an empty pose store on disk and returns it memory-mapped for writing
+
+    # Arguments
+        storePath: string, path of the .npy file to create.
+        nPoses: scalar, number of rows (poses) of the store.
+        units: string, units of the position columns.
+        quatConvention: string, order of the quaternion components (scalar first for Blender).
+        source: string, optional description of the data origin (e.g. converted .txt file).
+    '''
+    meta = {'format': POSE_STORE_FORMAT,
+            'version': POSE_STORE_VERSION,
+            'nPoses': int(nPoses),
+            'columns': GEOMETRY_COLUMNS,
+            'dtype': '<f8',
+            'units': units,
+            'quaternion': quatConvention,
+            'source': source}
+    with open(pose_store_meta_path(storePath), 'w') as metaFile:
+        json.dump(meta, metaFile, indent=2)
+    return np.lib.format.open_memmap(storePath, mode='w+', dtype='<f8', shape=(int(nPoses), GEOMETRY_NCOLS))
+
+
+def save_pose_store(storePath: str, poses: np.ndarray, **metaKwargs) -> None:
+    '''
+    This function saves a (N, 18) pose array as binary pose store
+
+    # Arguments
+        storePath: string, path of the .npy file to create.
+        poses: numpy array of shape (N, 18).
+        metaKwargs: header entries forwarded to create_pose_store (units, quatConvention, source).
+    '''
+    poses = np.asarray(poses)
+    if poses.ndim != 2 or poses.shape[1] != GEOMETRY_NCOLS:
+        raise Exception('Pose array must have shape (N, ' + str(GEOMETRY_NCOLS) + '), got ' + str(poses.shape))
+    store = create_pose_store(storePath, poses.shape[0], **metaKwargs)
+    store[:] = poses
+    store.flush()
+    del store
+
+
+def open_pose_store(storePath: str):
+    '''
+    This function opens a pose store read-only and memory-mapped. Rows are only read from
+    disk when sliced, hence opening is instantaneous regardless of the number of poses.
+    Returns the (N, 18) memmap and the header dictionary.
+
+    # Arguments
+        storePath: string, path of the .npy file.
+    '''
+    if not(os.path.isfile(storePath)):
+        raise Exception('Pose store NOT FOUND: ' + storePath)
+    metaPath = pose_store_meta_path(storePath)
+    if os.path.isfile(metaPath):
+        with open(metaPath, 'r') as metaFile:
+            meta = json.load(metaFile)
+        if meta.get('format') != POSE_STORE_FORMAT or meta.get('version', 0) > POSE_STORE_VERSION:
+            raise Exception('Unsupported pose store header: ' + metaPath)
+    else:
+        # Bare .npy without header: assume the default convention of the .txt geometry files
+        meta = {'format': POSE_STORE_FORMAT, 'version': POSE_STORE_VERSION, 'units': 'BU', 'quaternion': 'WXYZ'}
+
+    poses = np.load(storePath, mmap_mode='r')
+    if poses.ndim != 2 or poses.shape[1] != GEOMETRY_NCOLS:
+        raise Exception('Pose store ' + storePath + ' has shape ' + str(poses.shape) +
+                        ', expected (N, ' + str(GEOMETRY_NCOLS) + ').')
+    meta['nPoses'] = poses.shape[0]
+    return poses, meta
+
+
+def load_geometry(filePath: str) -> np.ndarray:
+    '''
+    This function loads geometry poses from either a pose store (memory-mapped) or a text file
+
+    # Arguments
+        filePath: string, path to a .npy pose store or to a (compressed) .txt geometry file.
+    '''
+    if filePath.lower().endswith(POSE_STORE_EXT):
+        poses, meta = open_pose_store(filePath)
+        if meta['quaternion'] != 'WXYZ':
+            raise Exception('Pose store ' + filePath + ' uses quaternion convention ' + str(meta['quaternion']) +
+                            ', only WXYZ (Blender) is supported.')
+        return poses
+    return load_geometry_txt(filePath)
+
+
+def count_text_rows(filePath: str) -> int:
+    # Count non-empty lines of a (possibly compressed) text file without parsing them
+    nRows = 0
+    with open_text(filePath) as file:
+        for line in file:
+            if line.strip() != '' and not(line.lstrip().startswith('#')):
+                nRows += 1
+    return nRows
+
+
+def convert_txt_to_store(txtFilePath: str, storePath: str = None) -> str:
+    '''
+    This function converts a Cloud_*.txt geometry file into a pose store, in chunks of
+    CONVERT_CHUNK_ROWS rows such that memory use does not depend on the file size.
+    Returns the path of the created store.
+
+    # Arguments
+        txtFilePath: string, path to the (compressed) .txt geometry file.
+        storePath: string, output .npy path. Defaults to the input path with .npy extension.
+    '''
+    if storePath is None:
+        storePath = txtFilePath
+        for ext in reversed(GEOMETRY_TXT_EXTS):
+            if storePath.lower().endswith(ext):
+                storePath = storePath[:-len(ext)]
+                break
+        storePath = storePath + POSE_STORE_EXT
+
+    nRows = count_text_rows(txtFilePath)
+    if nRows == 0:
+        raise Exception('Geometry file ' + txtFilePath + ' does not contain any pose.')
+    store = create_pose_store(storePath, nRows, source=os.path.basename(txtFilePath))
+
+    with open_text(txtFilePath) as file:
+        row0 = 0
+        while row0 < nRows:
+            try:
+                chunk = np.loadtxt(file, dtype=np.float64, ndmin=2, max_rows=CONVERT_CHUNK_ROWS)
+            except ValueError as exceptInstance:
+                raise Exception('Malformed geometry file ' + txtFilePath + ' (chunk starting at pose ' +
+                                str(row0) + '): ' + str(exceptInstance))
+            if chunk.size == 0:
+                raise Exception('Geometry file ' + txtFilePath + ' ended after ' + str(row0) + ' of ' + str(nRows) + ' poses.')
+            if chunk.shape[1] != GEOMETRY_NCOLS:
+                raise Exception('Geometry file ' + txtFilePath + ' has ' + str(chunk.shape[1]) +
+                                ' columns, expected ' + str(GEOMETRY_NCOLS) + '.')
+            store[row0:row0+chunk.shape[0]] = chunk
+            row0 += chunk.shape[0]
+    store.flush()
+    del store
+    return storePath
+
+
+def load_config_array(value, configDir: str = '', name: str = 'array') -> np.ndarray:
+    '''
+    This function returns a pose array of the JSON config, given inline or as binary sidecar (see above).
+    Sidecar files are memory-mapped read-only, base64 blocks are decoded in a single buffer.
+
+    # Arguments
+        value: JSON value of the array (nested list, .npy path or dictionary).
+        configDir: string, folder of the config file (base of relative paths).
+        name: string, name of the array (error messages).
+    '''
+    if isinstance(value, list):
+        return np.asarray(value, dtype=np.float64)
+    if isinstance(value, str):
+        value = {'file': value}
+    if not(isinstance(value, dict)):
+        raise Exception('Invalid config array ' + name + ': expected a list, a .npy path or a {"file"/"base64": ...} dictionary.')
+
+    shape = tuple(value['shape']) if 'shape' in value else None
+    dtype = np.dtype(value.get('dtype', CONFIG_ARRAYS_DTYPE))
+    if 'base64' in value:
+        if shape is None:
+            raise Exception('Config array ' + name + ': base64 data requires its "shape".')
+        array = np.frombuffer(base64.b64decode(value['base64']), dtype=dtype)
+    elif 'file' in value:
+        filePath = os.path.join(configDir, value['file'])
+        if not(os.path.isfile(filePath)):
+            raise Exception('Config array ' + name + ': file NOT FOUND: ' + filePath)
+        if filePath.lower().endswith(POSE_STORE_EXT):
+            array = np.load(filePath, mmap_mode='r')
+            if shape is not None and array.shape != shape:
+                raise Exception('Config array ' + name + ' has shape ' + str(array.shape) + ', expected ' + str(shape))
+            return array
+        if shape is None:
+            raise Exception('Config array ' + name + ': raw binary file ' + filePath + ' requires its "shape".')
+        offset = int(value.get('offset', 0))
+        if os.path.getsize(filePath) < offset + int(np.prod(shape))*dtype.itemsize:
+            raise Exception('Config array ' + name + ': raw binary file ' + filePath + ' is too small for shape ' + str(shape) +
+                            ' of ' + str(dtype))
+        array = np.memmap(filePath, dtype=dtype, mode='r', offset=offset, shape=(int(np.prod(shape)),))
+    else:
+        raise Exception('Invalid config array ' + name + ': expected a "file" or "base64" entry.')
+
+    if array.size != int(np.prod(shape)):
+        raise Exception('Config array ' + name + ' has ' + str(array.size) + ' values, expected shape ' + str(shape))
+    return array.reshape(shape, order=value.get('order', 'C'))
+
+
+def save_config_arrays(configFilePath: str, outputFilePath: str = None, fields=None) -> str:
+    '''
+    This function converts the inline pose arrays of a JSON config into .npy sidecar files (next to the output
+    config) and writes the config referencing them. Returns the path of the written config.
+
+    # Arguments
+        configFilePath: string, path of the JSON config with inline arrays.
+        outputFilePath: string, path of the converted config. Defaults to the input path (overwritten).
+        fields: list of SceneData entries to convert. Defaults to all the nested list entries.
+    '''
+    if outputFilePath is None:
+        outputFilePath = configFilePath
+    with open(configFilePath, 'r') as configFile:
+        config = json.load(configFile)
+    (outputDir, outputName) = os.path.split(os.path.abspath(outputFilePath))
+    prefix = os.path.splitext(outputName)[0]
+    sceneData = config['SceneData']
+    if fields is None:
+        fields = [key for (key, value) in sceneData.items() if isinstance(value, list) and len(value) > 0 and isinstance(value[0], list)]
+    for key in fields:
+        sidecarName = prefix + '_' + key + POSE_STORE_EXT
+        np.save(os.path.join(outputDir, sidecarName), np.asarray(sceneData[key], dtype=CONFIG_ARRAYS_DTYPE))
+        sceneData[key] = {'file': sidecarName}
+    with open(outputFilePath, 'w') as configFile:
+        json.dump(config, configFile, indent=2)
+    return outputFilePath
+
+
+if __name__ == '__main__':
+    # Converter usage: python pose_io.py Cloud_A.txt [Cloud_B.txt.gz ...]
+    #                  python pose_io.py --json-sidecar CONFIG.json [CONVERTED_CONFIG.json]
+    if len(sys.argv) < 2:
+        print('Usage: python pose_io.py <geometry.txt> [<geometry.txt> ...]')
+        print('       python pose_io.py --json-sidecar <config.json> [<output config.json>]')
+        sys.exit(1)
+    if sys.argv[1] == '--json-sidecar':
+        print('Config with sidecar arrays saved to:', save_config_arrays(*sys.argv[2:4]))
+        sys.exit(0)
+    for txtFilePath in sys.argv[1:]:
+        print('Converting', txtFilePath, '...')
+        print('Pose store saved to:', convert_txt_to_store(txtFilePath))
@@ -0,0 +1,291 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import itertools
+
+# Job spool of the CORTO render daemon (RenderDaemon.py). Pure Python: used by the daemon inside Blender and by
+# the submitters (scripts, MATLAB via system calls, ...) alike.
+# A job is a JSON file (see make_job) moved through the folders of the spool:
+#   incoming/<job id>.json   submitted, waiting for the daemon (claimed in job id order)
+#   running/<job id>.json    being rendered
+#   done/, failed/, cancelled/   terminated
+#   status/<job id>.json     state and progress, rewritten atomically by the daemon
+#   cancel/<job id>          cancellation request, checked by the daemon after each frame
+# Moves are os.rename within the spool, hence a job is claimed by one daemon only, even with several daemons
+# (e.g. one per scenario) serving the same spool.
+# The status of a running job records the pid and host of its daemon: a job left in running/ by a daemon that died
+# is moved to failed/ when a daemon starts on that host (recover_orphan_jobs), or by a submitter waiting for it.
+
+SPOOL_FOLDERS = ['incoming', 'running', 'done', 'failed', 'cancelled', 'status', 'cancel']
+JOB_STATES = ['queued', 'running', 'done', 'failed', 'cancelled']
+FINAL_STATES = ['done', 'failed', 'cancelled']
+# Running jobs without daemon pid yet (just claimed) are only considered orphaned after this delay [s]
+ORPHAN_GRACE_S = 60.0
+_jobCounter = itertools.count()
+
+
+def make_spool(spoolDir: str) -> str:
+    spoolDir = os.path.abspath(spoolDir)
+    for folder in SPOOL_FOLDERS:
+        os.makedirs(os.path.join(spoolDir, folder), exist_ok=True)
+    return spoolDir
+
+
+def write_json_atomic(filePath: str, content: dict):
+    # Readers never see a partially written file
+    tmpFilePath = filePath + '.tmp' + str(os.getpid())
+    with open(tmpFilePath, 'w') as file:
+        json.dump(content, file, indent=2)
+    os.replace(tmpFilePath, filePath)
+
+
+def read_json(filePath: str):
+    # None if the file does not exist (e.g. moved meanwhile)
+    try:
+        with open(filePath, 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def new_job_id() -> str:
+    # Sortable by submission time, unique across processes
+    return time.strftime('%Y%m%d_%H%M%S') + '_{:06d}_{:06d}_{:03d}'.format(
+        int(time.time()*1e6) % 1000000, os.getpid() % 1000000, next(_jobCounter) % 1000)
+
+
+def make_job(configFilePath: str, blendFilePath: str = '', geometryFilePath: str = '', outputFolder: str = '',
+             extraArgs=(), reload: bool = False, jobID: str = None) -> dict:
+    '''
+    This function returns a job description of the render daemon.
+
+    # Arguments
+        configFilePath: string, CORTO config file (.txt or .json) of RenderFromTxt.py.
+        blendFilePath: string, scenario .blend file. Empty: the scenario loaded by the daemon.
+        geometryFilePath: string, pose store or geometry file (.txt config mode). Empty: next to the .blend file.
+        outputFolder: string, dataset folder. Empty: timestamped folder in the savepath of the config.
+        extraArgs: list of strings, additional arguments of RenderFromTxt.py (e.g. ['--threads', '8', '--resume']).
+        reload: bool, if True the .blend file is reloaded before the job (pristine scene, slower start).
+        jobID: string, job id (default: new_job_id()).
+    '''
+    return {'job_id': jobID if jobID is not None else new_job_id(),
+            'config': os.path.abspath(configFilePath),
+            'blend': os.path.abspath(blendFilePath) if blendFilePath != '' else '',
+            'geometry': os.path.abspath(geometryFilePath) if geometryFilePath != '' else '',
+            'output': os.path.abspath(outputFolder) if outputFolder != '' else '',
+            'args': [str(arg) for arg in extraArgs], 'reload': bool(reload),
+            'submitted': time.time()}
+
+
+def submit_job(spoolDir: str, job: dict) -> str:
+    # Queue a job (see make_job) in the spool. Returns its id
+    spoolDir = make_spool(spoolDir)
+    jobID = job['job_id']
+    write_json_atomic(os.path.join(spoolDir, 'status', jobID + '.json'), {'job_id': jobID, 'state': 'queued',
+                                                                          'submitted': job['submitted']})
+    write_json_atomic(os.path.join(spoolDir, 'incoming', jobID + '.json'), job)
+    return jobID
+
+
+def claim_next_job(spoolDir: str):
+    # Move the oldest queued job to running/ and return it, None if there is none (or another daemon took it)
+    incomingDir = os.path.join(spoolDir, 'incoming')
+    for fileName in sorted(os.listdir(incomingDir)):
+        if not(fileName.endswith('.json')):
+            continue
+        runningFilePath = os.path.join(spoolDir, 'running', fileName)
+        try:
+            os.rename(os.path.join(incomingDir, fileName), runningFilePath)
+        except OSError:
+            continue
+        os.utime(runningFilePath) # Claim time (see ORPHAN_GRACE_S)
+        return read_json(runningFilePath)
+    return None
+
+
+def finish_job(spoolDir: str, jobID: str, state: str):
+    # Move the job file of a terminated job to the folder of its final state
+    os.replace(os.path.join(spoolDir, 'running', jobID + '.json'), os.path.join(spoolDir, state, jobID + '.json'))
+
+
+def job_status(spoolDir: str, jobID: str):
+    return read_json(os.path.join(spoolDir, 'status', jobID + '.json'))
+
+
+def cancel_job(spoolDir: str, jobID: str):
+    # Queued jobs are cancelled at once, running jobs after their current frame. Raises for other jobs
+    try:
+        os.replace(os.path.join(spoolDir, 'incoming', jobID + '.json'), os.path.join(spoolDir, 'cancelled', jobID + '.json'))
+    except FileNotFoundError:
+        markerFilePath = os.path.join(spoolDir, 'cancel', jobID)
+        if not(os.path.isfile(os.path.join(spoolDir, 'running', jobID + '.json'))):
+            raise Exception('Job ' + jobID + ' is not queued or running: cannot cancel it.')
+        open(markerFilePath, 'w').close()
+        if not(os.path.isfile(os.path.join(spoolDir, 'running', jobID + '.json'))):
+            # Terminated meanwhile: the daemon may have cleared the cancel folder already
+            os.remove(markerFilePath)
+            raise Exception('Job ' + jobID + ' terminated before it could be cancelled.')
+        return
+    status = job_status(spoolDir, jobID) or {'job_id': jobID}
+    status.update({'state': 'cancelled', 'finished': time.time()})
+    write_json_atomic(os.path.join(spoolDir, 'status', jobID + '.json'), status)
+
+
+def is_cancel_requested(spoolDir: str, jobID: str) -> bool:
+    return os.path.exists(os.path.join(spoolDir, 'cancel', jobID))
+
+
+def is_process_alive(pid: int) -> bool:
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, int(pid)) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not(handle):
+            return False
+        exitCode = ctypes.c_ulong()
+        success = kernel32.GetExitCodeProcess(handle, ctypes.byref(exitCode))
+        kernel32.CloseHandle(handle)
+        return bool(success) and exitCode.value == 259 # STILL_ACTIVE
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def is_orphan_job(spoolDir: str, jobID: str) -> bool:
+    # True if the job is in running/ but its daemon (on this host) is not alive anymore
+    runningFilePath = os.path.join(spoolDir, 'running', jobID + '.json')
+    try:
+        claimAge = time.time() - os.path.getmtime(runningFilePath)
+    except OSError:
+        return False
+    status = job_status(spoolDir, jobID) or {}
+    if status.get('state') != 'running' or 'daemon_pid' not in status:
+        return claimAge > ORPHAN_GRACE_S
+    if status.get('daemon_host', socket.gethostname()) != socket.gethostname():
+        return False # Daemon on another host sharing the spool: cannot be checked from here
+    return not(is_process_alive(status['daemon_pid']))
+
+
+def fail_orphan_job(spoolDir: str, jobID: str) -> dict:
+    # Move an orphaned running job to failed/. Returns its final status
+    status = job_status(spoolDir, jobID) or {'job_id': jobID}
+    status.update({'state': 'failed', 'finished': time.time(),
+                   'error': 'Render daemon (pid ' + str(status.get('daemon_pid')) + ') terminated during the job.'})
+    write_json_atomic(os.path.join(spoolDir, 'status', jobID + '.json'), status)
+    finish_job(spoolDir, jobID, 'failed')
+    if os.path.exists(os.path.join(spoolDir, 'cancel', jobID)):
+        os.remove(os.path.join(spoolDir, 'cancel', jobID))
+    return status
+
+
+def recover_orphan_jobs(spoolDir: str) -> list:
+    # Fail the running jobs of dead daemons (called when a daemon starts). Returns their ids
+    recovered = []
+    for fileName in sorted(os.listdir(os.path.join(spoolDir, 'running'))):
+        jobID = fileName[:-len('.json')]
+        if not(fileName.endswith('.json')) or not(is_orphan_job(spoolDir, jobID)):
+            continue
+        try:
+            fail_orphan_job(spoolDir, jobID)
+        except FileNotFoundError:
+            continue # Recovered meanwhile by another process
+        recovered.append(jobID)
+    return recovered
+
+
+def wait_job(spoolDir: str, jobID: str, timeout: float = None, poll: float = 0.5, callback=None) -> dict:
+    '''
+    This function waits until a job terminates and returns its final status.
+
+    # Arguments
+        spoolDir: string, spool folder.
+        jobID: string, job id.
+        timeout: scalar, maximum waiting time [s] (None: no limit). Raises on timeout.
+        poll: scalar, polling period of the status file [s].
+        callback: optional function called with the status at every poll (e.g. progress display).
+    '''
+    t0 = time.time()
+    while True:
+        status = job_status(spoolDir, jobID)
+        if status is not None and status['state'] == 'running' and is_orphan_job(spoolDir, jobID):
+            try:
+                status = fail_orphan_job(spoolDir, jobID)
+            except FileNotFoundError:
+                continue # Terminated (or recovered) meanwhile: read the final status
+        if callback is not None and status is not None:
+            callback(status)
+        if status is not None and status['state'] in FINAL_STATES:
+            return status
+        if timeout is not None and time.time() - t0 > timeout:
+            raise Exception('Render job ' + jobID + ' not terminated after ' + str(timeout) + ' s.')
+        time.sleep(poll)
+
+
+def send_daemon_request(port: int, request: dict, host: str = '127.0.0.1', timeout: float = 10.0) -> dict:
+    # One request to the control socket of a daemon (newline-terminated JSON), returns its reply
+    with socket.create_connection((host, int(port)), timeout=timeout) as sock:
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        reply = b''
+        while not(reply.endswith(b'\n')):
+            chunk = sock.recv(65536)
+            if chunk == b'':
+                break
+            reply += chunk
+    return json.loads(reply.decode('utf-8'))
+
+
+def print_status(status: dict):
+    progress = ''
+    if status.get('frames_total'):
+        progress = ' - ' + str(status['frames_done']) + '/' + str(status['frames_total']) + ' frames'
+    print('Job', status['job_id'], '-', status['state'] + progress + (' - ' + status['error'] if status.get('error') else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Submit and monitor jobs of the CORTO render daemon (RenderDaemon.py).')
+    parser.add_argument('command', choices=['submit', 'status', 'wait', 'cancel'])
+    parser.add_argument('--spool', required=True, help='Spool folder of the daemon')
+    parser.add_argument('--job', default='', help='Job id (status, wait, cancel)')
+    parser.add_argument('-c', '--config', default='', help='CORTO config file (.txt or .json)')
+    parser.add_argument('--blend', default='', help='Scenario .blend file (default: the one loaded by the daemon)')
+    parser.add_argument('--geometry', default='', help='Pose store or geometry file (default: next to the .blend file)')
+    parser.add_argument('--output', default='', help='Dataset folder')
+    parser.add_argument('--reload', action='store_true', help='Reload the .blend file before the job')
+    parser.add_argument('--port', type=int, default=0, help='Control port of the daemon, to wake it up at once (0: spool only)')
+    parser.add_argument('--wait', action='store_true', help='submit: wait for the job to terminate')
+    parser.add_argument('--timeout', type=float, default=None, help='wait: maximum waiting time [s] (default: no limit)')
+    (args, extraArgs) = parser.parse_known_args()
+
+    if args.command == 'submit':
+        if args.config == '':
+            raise Exception('submit requires -c/--config')
+        job = make_job(args.config, args.blend, args.geometry, args.output, extraArgs, args.reload)
+        if args.port > 0:
+            jobID = send_daemon_request(args.port, {'op': 'submit', 'job': job})['job_id']
+        else:
+            jobID = submit_job(args.spool, job)
+        print(jobID)
+        if not(args.wait):
+            sys.exit(0)
+        args.job = jobID
+    if args.job == '':
+        raise Exception(args.command + ' requires --job')
+    if args.command == 'cancel':
+        cancel_job(args.spool, args.job)
+        sys.exit(0)
+    if args.command == 'status':
+        status = job_status(args.spool, args.job)
+        if status is None:
+            raise Exception('Unknown job ' + args.job)
+        print_status(status)
+        sys.exit(0)
+    status = wait_job(args.spool, args.job, timeout=args.timeout, callback=print_status)
+    sys.exit(0 if status['state'] == 'done' else 1)
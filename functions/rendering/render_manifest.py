@@ -0,0 +1,68 @@
+import os
+import glob
+import threading
+
+MANIFEST_PREFIX = 'render_manifest'
+MANIFEST_EXT = '.log'
+
+
+class RenderManifest:
+    '''
+    On-disk record of the completed frames of a dataset, used to resume interrupted runs.
+    Each process appends the index of a frame to its own manifest file once ALL the outputs of
+    that frame are on disk. One line is written with a single os.write() on an O_APPEND file
+    and fsync'ed, hence a crash leaves at most a truncated last line, which is discarded.
+    Completed frames are the union of all the manifest files in the dataset folder (one per shard).
+
+    # Arguments
+        datasetFolder: string, dataset (output) folder.
+        tag: string, manifest name suffix of this process (e.g. shard id). Empty for single-process runs.
+        fsync: bool, if True each record is flushed to disk before markDone() returns.
+    '''
+    def __init__(self, datasetFolder: str, tag: str = '', fsync: bool = True):
+        self.datasetFolder = datasetFolder
+        self.fsync = fsync
+        self.filePath = os.path.join(datasetFolder, MANIFEST_PREFIX + ('_' + tag if tag != '' else '') + MANIFEST_EXT)
+        self.lock = threading.Lock()
+        os.makedirs(datasetFolder, exist_ok=True)
+        self._dropTruncatedRecord()
+        self.completed = self._readAll()
+        self.fd = os.open(self.filePath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def _dropTruncatedRecord(self):
+        # Remove a partial last line left by a crash, such that the next record starts on a new line
+        if not(os.path.isfile(self.filePath)):
+            return
+        with open(self.filePath, 'rb+') as file:
+            content = file.read()
+            if len(content) > 0 and not(content.endswith(b'\n')):
+                file.truncate(content.rfind(b'\n') + 1)
+
+    def _readAll(self):
+        completed = set()
+        for filePath in glob.glob(os.path.join(self.datasetFolder, MANIFEST_PREFIX + '*' + MANIFEST_EXT)):
+            with open(filePath, 'rb') as file:
+                for line in file.read().split(b'\n')[:-1]: # Last element: empty or truncated record
+                    if line.strip() != b'':
+                        completed.add(int(line))
+        return completed
+
+    def isDone(self, ii: int) -> bool:
+        return ii in self.completed
+
+    def nDone(self) -> int:
+        return len(self.completed)
+
+    def markDone(self, ii: int):
+        # Thread-safe: called from the async writer threads as well
+        with self.lock:
+            os.write(self.fd, b'%d\n' % ii)
+            if self.fsync:
+                os.fsync(self.fd)
+            self.completed.add(ii)
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
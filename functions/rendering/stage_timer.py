@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+import numpy as np
+
+from contextlib import contextmanager
+
+try:
+    import resource # Not available on Windows
+except ImportError:
+    resource = None
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def get_current_rss_mb() -> float:
+    # Current resident set size of the process [MB]. NaN if it cannot be measured on this platform
+    try:
+        with open('/proc/self/statm', 'r') as statmFile: # Linux: sizes in pages
+            return int(statmFile.read().split()[1]) * _PAGE_SIZE / 1024.0**2
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil # Optional, used on macOS and Windows
+        return psutil.Process().memory_info().rss / 1024.0**2
+    except Exception:
+        return float('nan')
+
+
+def get_peak_rss_mb() -> float:
+    # Peak resident set size of the process [MB]. NaN if it cannot be measured on this platform
+    if resource is not None:
+        peakRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kB, macOS bytes
+        return peakRSS / (1024.0**2 if sys.platform == 'darwin' else 1024.0)
+    try:
+        import psutil # Optional, only used on Windows
+        return psutil.Process().memory_info().peak_wset / 1024.0**2
+    except Exception:
+        return float('nan')
+
+
+class StageTimer:
+    '''
+    Lightweight per-frame, per-stage instrumentation of the rendering loop. Each stage records its
+    wall time (time.perf_counter) and the current RSS of the process when it starts and ends. One CSV row
+    per stage is streamed to the trace file, hence memory only holds the durations needed by the summary.
+    The trace is appended to (resumed runs keep the rows of the interrupted ones, see the run column) and
+    each run writes its own summary file. Overhead is a few tens of microseconds per stage.
+
+    # Arguments
+        traceFolder: string, folder of the trace files. Nothing is written if empty.
+        tag: string, suffix of the trace files (e.g. shard id).
+        enabled: bool, if False all methods are no-ops.
+    '''
+    def __init__(self, traceFolder: str = '', tag: str = '', enabled: bool = True):
+        self.enabled = enabled
+        self.durations = {} # stage name -> list of durations [s]
+        self.frameDurations = []
+        self.frameID = None
+        self.frameT0 = None
+        self.frameRSS0 = None
+        self.runID = time.strftime('%Y_%m_%d_%H_%M_%S')
+        self.runT0 = None
+        self.runT1 = None
+        self.traceFile = None
+        self.summaryPath = None
+        if enabled and traceFolder != '':
+            os.makedirs(traceFolder, exist_ok=True)
+            suffix = ('_' + tag if tag != '' else '')
+            tracePath = os.path.join(traceFolder, 'trace' + suffix + '.csv')
+            newTrace = not(os.path.isfile(tracePath)) or os.path.getsize(tracePath) == 0
+            self.traceFile = open(tracePath, 'a', buffering=1024*1024)
+            if newTrace:
+                self.traceFile.write('run,frame,stage,t_start_s,duration_s,rss_start_mb,rss_end_mb\n')
+            self.summaryPath = os.path.join(traceFolder, 'summary' + suffix + '_' + self.runID + '.json')
+
+    def _record(self, stageName, t0, t1, rss0):
+        self.durations.setdefault(stageName, []).append(t1 - t0)
+        if self.traceFile is not None:
+            self.traceFile.write('%s,%s,%s,%.6f,%.6f,%.1f,%.1f\n' % (self.runID, self.frameID, stageName, t0 - self.runT0, t1 - t0,
+                                                                    rss0, get_current_rss_mb()))
+
+    def startFrame(self, frameID):
+        if not(self.enabled):
+            return
+        self.frameID = frameID
+        self.frameRSS0 = get_current_rss_mb()
+        self.frameT0 = time.perf_counter()
+        if self.runT0 is None:
+            self.runT0 = self.frameT0
+
+    def endFrame(self):
+        if not(self.enabled) or self.frameT0 is None:
+            return
+        t1 = time.perf_counter()
+        self.frameDurations.append(t1 - self.frameT0)
+        self._record('frame', self.frameT0, t1, self.frameRSS0)
+        self.runT1 = t1
+        self.frameT0 = None
+
+    @contextmanager
+    def stage(self, stageName: str):
+        if not(self.enabled):
+            yield
+            return
+        if self.runT0 is None:
+            self.runT0 = time.perf_counter()
+        rss0 = get_current_rss_mb()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(stageName, t0, time.perf_counter(), rss0)
+
+    def summary(self) -> dict:
+        # Mean, p50, p95 and max per stage [s], throughput [frames/s]
+        stats = {}
+        for (stageName, values) in list(self.durations.items()):
+            values = np.asarray(values)
+            stats[stageName] = {'count': int(values.size),
+                                'mean_s': float(values.mean()),
+                                'p50_s': float(np.percentile(values, 50)),
+                                'p95_s': float(np.percentile(values, 95)),
+                                'max_s': float(values.max()),
+                                'total_s': float(values.sum())}
+        nFrames = len(self.frameDurations)
+        wallTime = (self.runT1 - self.runT0) if (self.runT1 is not None and self.runT0 is not None) else 0.0
+        return {'run': self.runID,
+                'frames': nFrames,
+                'wall_time_s': wallTime,
+                'throughput_fps': (nFrames / wallTime) if wallTime > 0 else 0.0,
+                'peak_rss_mb': get_peak_rss_mb(),
+                'stages': stats}
+
+    def printSummary(self, summary: dict = None):
+        if summary is None:
+            summary = self.summary()
+        print('TIMING SUMMARY:', summary['frames'], 'frames in', round(summary['wall_time_s'], 2), 's,',
+              round(summary['throughput_fps'], 4), 'frames/s, peak RSS', round(summary['peak_rss_mb'], 1), 'MB')
+        print('{:<12s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('stage', 'count', 'mean [s]', 'p50 [s]', 'p95 [s]', 'max [s]'))
+        for (stageName, stats) in summary['stages'].items():
+            print('{:<12s} {:>8d} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f}'.format(
+                stageName, stats['count'], stats['mean_s'], stats['p50_s'], stats['p95_s'], stats['max_s']))
+
+    def close(self):
+        # Flush the trace, write the JSON summary and print it
+        if not(self.enabled):
+            return
+        summary = self.summary()
+        if self.traceFile is not None:
+            self.traceFile.close()
+            self.traceFile = None
+            with open(self.summaryPath, 'w') as summaryFile:
+                json.dump(summary, summaryFile, indent=2)
+        self.printSummary(summary)
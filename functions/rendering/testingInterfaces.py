@@ -14,6 +14,11 @@ from pprint import pprint
 from random import randint
 from datetime import datetime
 
+# Helper modules living next to this script
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import pose_io
+import config_cache
+
 
 filenameext = 'DEFAULT TXT CONFIG PATH'
 
@@ -122,13 +127,14 @@ def read_parse_configJSON(configJSONfilePath):
         os.chdir(currentPath) # Return to script execution directory
         print(corto['savepath'])
             
-    # CAMERA, TARGET and ILLUMINATION
-    scenarioData['rStateCam']    = np.array(SceneData['rStateCam'])    
-    scenarioData['rTargetBody']  = np.array(SceneData['rTargetBody'])
-    scenarioData['rSun']         = np.array(SceneData['rSun'])         
-    scenarioData['qFromCAMtoIN'] = np.array(SceneData['qFromCAMtoIN'])
-    scenarioData['qFromTFtoIN']  = np.array(SceneData['qFromTFtoIN'])  
-    scenarioData['ID'] = np.arange(len(SceneData['rStateCam'])).flatten()
+    # CAMERA, TARGET and ILLUMINATION: inline lists or binary sidecar arrays (see pose_io.load_config_array)
+    configDir = os.path.dirname(os.path.abspath(configJSONfilePath))
+    scenarioData['rStateCam']    = pose_io.load_config_array(SceneData['rStateCam'], configDir, 'rStateCam')
+    scenarioData['rTargetBody']  = pose_io.load_config_array(SceneData['rTargetBody'], configDir, 'rTargetBody')
+    scenarioData['rSun']         = pose_io.load_config_array(SceneData['rSun'], configDir, 'rSun')
+    scenarioData['qFromCAMtoIN'] = pose_io.load_config_array(SceneData['qFromCAMtoIN'], configDir, 'qFromCAMtoIN')
+    scenarioData['qFromTFtoIN']  = pose_io.load_config_array(SceneData['qFromTFtoIN'], configDir, 'qFromTFtoIN')
+    scenarioData['ID'] = np.arange(scenarioData['rStateCam'].shape[0]).flatten()
 
     geometry['ii0'] = 0 # Initial index for rendering
 
@@ -150,7 +156,9 @@ def read_parse_configJSON(configJSONfilePath):
 
 if __name__ == '__main__':
     configJSONfilePath = os.path.abspath('c:\\Users\\pietr\\OneDrive - Politecnico di Milano\\PoliMi - LM\MATLABwideCodes\\MATLABcodes\\testHarnesses\\InputConfig2CORTO_20240301_2150\\CORTO_CONFIG.json')
-    body, geometry, scene, corto, scenarioData = read_parse_configJSON(configJSONfilePath)
+    body, geometry, scene, corto, scenarioData = config_cache.cached_call(
+        'json', [configJSONfilePath], lambda: read_parse_configJSON(configJSONfilePath),
+        config_cache.cache_dir_for(configJSONfilePath), [os.path.abspath(__file__), pose_io.__file__])
     scale_BU = 1
     # ID
     ID_pose = scenarioData['ID']
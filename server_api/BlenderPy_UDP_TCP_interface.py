@@ -0,0 +1,464 @@
+# General purpose CORTO GNC render server, configured by BlenderPy_UDP_TCP_CONFIG.yml.
+# It replaces the CORTO_interface_HF_1_* scripts (hard-coded parameters) with a single server whose behavior is
+# selected by Server_params.mode:
+#   'ack'    (HF_1_a): the image is saved in output_path, an acknowledgement (step counter) is sent back.
+#   'viewer' (HF_1_b): the image is read from the compositor Viewer Node and transmitted (linear space).
+#   'disk'   (HF_1_c/d): the image is saved in output_path, loaded back and transmitted (display space).
+# Usage (scene settings are applied once at startup):
+#   blender -b model.blend -P server_api/BlenderPy_UDP_TCP_interface.py -- -c server_api/BlenderPy_UDP_TCP_CONFIG.yml [-m viewer]
+# Each request is a UDP datagram of big-endian doubles [PQ_Sun, PQ_SC, PQ_Body_1, ..., PQ_Body_N], 7 values each
+# (position, quaternion WXYZ), or a batched datagram of K such poses (see corto_protocol.py), rendered back to back.
+# Replies are sent over TCP, one per pose, either raw ('raw') or framed ('framed', see corto_protocol.py).
+# With Server_params.pipeline, a receiver thread decodes and queues the incoming poses and a sender thread
+# transmits frame k while the main (bpy) thread renders frame k+1; replies keep the order of the poses.
+
+import os
+import sys
+import time
+import queue
+import pickle
+import socket
+import threading
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import bpy
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'rendering'))
+from corto_image_io import ImageWireBuffer
+from corto_server_config import load_server_config, normalize_server_mode
+from corto_render_cache import RenderCache
+from corto_shm_transport import ShmFrameRing
+from corto_image_shaping import shaper_from_config
+from corto_render_budget import controller_from_config
+from async_writer import AsyncWriter
+import corto_protocol
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'BlenderPy_UDP_TCP_CONFIG.yml')
+N_ZFILLS = 6 # Number of digits used in the image name
+
+
+def parse_pose_request(data: bytes, nBodies: int):
+    '''
+    This function decodes a pose request datagram, single or batched. Returns (requestID, poses): requestID is None
+    for single-pose datagrams, poses a (K, 7*(nBodies + 2)) array of rows [PQ_Sun, PQ_SC, PQ_Body_1, ..., PQ_Body_N].
+
+    # Arguments
+        data: bytes, big-endian doubles [PQ_Sun, PQ_SC, PQ_Body_1, ..., PQ_Body_N], or a batched request.
+        nBodies: scalar, number of bodies expected by the server.
+    '''
+    return corto_protocol.decode_pose_datagram(data, nBodies)
+
+
+class BlenderGncServer:
+    '''
+    CORTO GNC render server running inside Blender. Scene, camera, engine and light settings are
+    applied once at construction; each step only positions the objects, renders and replies.
+
+    # Arguments
+        config: dict, as returned by corto_server_config.load_server_config.
+    '''
+    def __init__(self, config: dict):
+        self.config = config
+        self.camParams = config['Camera_params']
+        self.engineParams = config['RenderingEngine_params']
+        self.modelParams = config['BlenderModel_params']
+        self.serverParams = config['Server_params']
+        self.mode = normalize_server_mode(self.serverParams['mode'])
+        self.dummyOutput = bool(self.serverParams['DUMMY_OUTPUT'])
+        self.disableCaching = bool(self.serverParams['disable_caching'])
+        self.outputPath = self.serverParams['output_path']
+        self.nBodies = int(self.modelParams['num_bodies'])
+
+        self.scene = bpy.context.scene
+        self.camera = bpy.data.objects[self.modelParams['camera_name']]
+        self.sun = bpy.data.objects[self.modelParams['light_names'][0]]
+        self.bodies = [bpy.data.objects[name] for name in self.modelParams['bodies_names']]
+
+        # Readback buffers and shaper (channels, binning and ROI of the transmitted image). The pipelined mode
+        # alternates two sets, such that the payload of step ii stays valid while step ii + 1 is rendered
+        self.pipeline = bool(self.serverParams['pipeline'])
+        self.bufferSlots = [(ImageWireBuffer(self.serverParams['image_dtype']), shaper_from_config(self.camParams))
+                            for _ in range(2 if self.pipeline else 1)]
+        (self.imageBuffer, self.shaper) = self.bufferSlots[0]
+        self.imgRead = None # Single image datablock reused by the 'disk' mode
+        self.appliedPoses = {} # Object name -> last applied PQ, to skip unchanged objects
+        self.imageLogger = AsyncWriter(1) if (self.mode == 'viewer' and self.serverParams['log_images']) else None
+        self.dummyPixels = None
+        self.payload = None # Reply payload of the last step
+        # Render cache ('ack' mode excluded: the client reads the image file written at each step)
+        self.renderCache = None
+        if float(self.serverParams['render_cache_mb']) > 0 and self.mode != 'ack':
+            self.renderCache = RenderCache(float(self.serverParams['render_cache_mb'])*1024**2,
+                                           self.serverParams['cache_position_tolerance'],
+                                           self.serverParams['cache_quaternion_tolerance'],
+                                           settings=[self.camParams, self.engineParams, self.modelParams,
+                                                     self.mode, self.serverParams['image_dtype']])
+        # Shared memory ring of the 'shm' transport, sized for RGBA frames of the configured resolution
+        self.shmRing = None
+        if self.serverParams['transport'] == 'shm':
+            frameBytes = int(self.camParams['sensor_size_x'])*int(self.camParams['sensor_size_y'])*4*self.imageBuffer.wireDtype.itemsize
+            self.shmRing = ShmFrameRing(self.serverParams['shm_name'], int(self.serverParams['shm_slots']), frameBytes, create=True)
+        # Real-time mode: render quality adapted to the target frame period
+        self.renderBudget = controller_from_config(self.engineParams)
+        self.renderSettingsExtra = b'' # Reply header block with the settings of the frame being rendered
+        if self.outputPath != '':
+            os.makedirs(self.outputPath, exist_ok=True)
+        self.applySettings()
+
+    def applySettings(self):
+        # Static camera, engine, light and output settings (once per server run)
+        scene = self.scene
+        scene.render.engine = self.engineParams['render_engine']
+        if scene.render.engine == 'CYCLES':
+            scene.cycles.device = self.engineParams['device']
+            scene.cycles.samples = int(self.engineParams['samples'])
+            scene.cycles.diffuse_bounces = int(self.engineParams['diffuse_bounces'])
+            if hasattr(scene.cycles, 'tile_size'): # Blender >= 3.0
+                scene.cycles.tile_size = int(self.engineParams['tile_size'])
+        if hasattr(scene.render, 'tile_x'): # Blender < 3.0
+            scene.render.tile_x = int(self.engineParams['tile_size'])
+            scene.render.tile_y = int(self.engineParams['tile_size'])
+
+        self.camera.data.type = 'PERSP'
+        self.camera.data.lens_unit = 'FOV'
+        self.camera.data.angle = self.camParams['FOV_x'] * np.pi / 180
+        self.camera.data.clip_start = self.camParams['clip_start']
+        self.camera.data.clip_end = self.camParams['clip_end']
+        scene.render.pixel_aspect_x = 1
+        scene.render.pixel_aspect_y = 1
+        scene.render.resolution_x = int(self.camParams['sensor_size_x'])
+        scene.render.resolution_y = int(self.camParams['sensor_size_y'])
+        scene.render.resolution_percentage = 100
+
+        self.sun.data.type = 'SUN'
+        self.sun.data.energy = self.modelParams['sun_energy']
+        self.sun.data.specular_factor = self.modelParams['specular_factor']
+        bpy.data.worlds["World"].node_tree.nodes["Background"].inputs[0].default_value = (0, 0, 0, 1)
+
+        nChannels = int(self.camParams['n_channels'])
+        if nChannels == 1:
+            scene.render.image_settings.color_mode = 'BW'
+        elif nChannels == 3:
+            scene.render.image_settings.color_mode = 'RGB'
+        elif nChannels == 4:
+            scene.render.image_settings.color_mode = 'RGBA'
+        scene.render.image_settings.color_depth = str(self.camParams['bit_encoding'])
+        scene.render.image_settings.compression = int(self.camParams['compression'])
+
+        for obj in [self.camera, self.sun] + self.bodies:
+            obj.rotation_mode = 'QUATERNION'
+        self.sun.location = [0, 0, 0] # Because in Blender it is indifferent where the sun is located
+        if self.renderBudget is not None:
+            self.applyRenderSettings(self.renderBudget.settings())
+
+    def applyRenderSettings(self, settings: dict):
+        # Quality settings of the real-time mode (see corto_render_budget.py)
+        scene = self.scene
+        if scene.render.engine == 'CYCLES':
+            scene.cycles.samples = int(settings['samples'])
+            if hasattr(scene.cycles, 'adaptive_threshold'): # Blender >= 2.90
+                scene.cycles.use_adaptive_sampling = True
+                scene.cycles.adaptive_threshold = float(settings['adaptive_threshold'])
+        scene.render.resolution_percentage = int(settings['resolution_percentage'])
+        self.renderSettingsExtra = corto_protocol.pack_render_settings_extra(settings['samples'], settings['adaptive_threshold'],
+                                                                             settings['resolution_percentage'], settings['level'])
+
+    def setPose(self, obj, PQ, setLocation: bool = True):
+        # Apply PQ to obj, unless it is unchanged since the last step (caching enabled)
+        PQ = np.asarray(PQ, dtype=np.float64)
+        if not(self.disableCaching):
+            lastPQ = self.appliedPoses.get(obj.name)
+            if lastPQ is not None and np.array_equal(lastPQ, PQ):
+                return False
+        if setLocation:
+            obj.location = PQ[0:3]
+        obj.rotation_quaternion = PQ[3:7]
+        self.appliedPoses[obj.name] = PQ.copy()
+        return True
+
+    def positionAll(self, PQ_Sun, PQ_SC, PQ_Bodies):
+        # Returns the number of objects actually updated
+        nUpdated = int(self.setPose(self.sun, PQ_Sun, setLocation=False))
+        nUpdated += int(self.setPose(self.camera, PQ_SC))
+        for (body, PQ_Body) in zip(self.bodies, PQ_Bodies):
+            nUpdated += int(self.setPose(body, PQ_Body))
+        return nUpdated
+
+    def imagePath(self, ii: int, ext: str = '.png') -> str:
+        return os.path.join(self.outputPath, str(int(ii)).zfill(N_ZFILLS) + ext)
+
+    def render(self, ii: int):
+        # Only 'ack' and 'disk' need the PNG on disk; 'viewer' keeps the image in memory
+        if self.outputPath != '':
+            self.scene.render.filepath = self.imagePath(ii)
+        bpy.ops.render.render(write_still=(self.mode != 'viewer'))
+
+    def readImage(self, ii: int):
+        # Read the rendered pixels into the float32 buffer of imageBuffer
+        if self.mode == 'viewer':
+            self.imageBuffer.read(bpy.data.images['Viewer Node'])
+            if self.imageLogger is not None:
+                # The buffer is reused at the next step: the logger gets its own copy
+                width, height = self.imageBuffer.size
+                self.imageLogger.submit(np.save, self.imagePath(ii, '.npy'),
+                                        np.reshape(self.imageBuffer.pixels, (height, width, -1)).copy())
+        else:
+            filepath = self.imagePath(ii)
+            if self.imgRead is None:
+                self.imgRead = bpy.data.images.load(filepath = filepath)
+            else:
+                self.imgRead.filepath = filepath
+                self.imgRead.reload() # Frees the previous pixels, memory stays flat
+            self.imageBuffer.read(self.imgRead)
+
+    def readDummyImage(self):
+        # Black RGBA image of the configured size (DUMMY_OUTPUT: communication tests without rendering)
+        width = int(self.camParams['sensor_size_x'])
+        height = int(self.camParams['sensor_size_y'])
+        if self.dummyPixels is None:
+            self.dummyPixels = np.zeros(width*height*4, dtype=np.float32)
+        self.imageBuffer.pixels = self.dummyPixels
+        self.imageBuffer.size = (width, height)
+
+    def step(self, ii: int, PQ_Sun, PQ_SC, PQ_Bodies) -> float:
+        # Position, render and read back one frame (or take it from the render cache). Returns the render time [s]
+        (self.imageBuffer, self.shaper) = self.bufferSlots[ii % len(self.bufferSlots)]
+        if self.renderCache is not None:
+            cacheKey = self.renderCache.key(np.concatenate((PQ_Sun, PQ_SC, np.ravel(PQ_Bodies)))) + self.renderSettingsExtra
+            self.payload = self.renderCache.get(cacheKey)
+            if self.payload is not None:
+                return 0.0
+        self.positionAll(PQ_Sun, PQ_SC, PQ_Bodies)
+        t_render0 = time.perf_counter()
+        if self.dummyOutput:
+            if self.mode != 'ack':
+                self.readDummyImage()
+            renderTime = time.perf_counter() - t_render0
+        else:
+            self.render(ii)
+            renderTime = time.perf_counter() - t_render0
+            if self.mode != 'ack':
+                self.readImage(ii)
+        self.payload = self.packPayload()
+        if self.renderCache is not None and not(self.dummyOutput):
+            self.renderCache.put(cacheKey, *self.payload)
+        if self.renderBudget is not None and not(self.dummyOutput) and self.renderBudget.update(renderTime):
+            # Settings of the next frames
+            settings = self.renderBudget.settings()
+            print('REAL-TIME: render time', round(renderTime*1e3, 1), 'ms - quality level', settings['level'], '- samples',
+                  settings['samples'], '- adaptive threshold', settings['adaptive_threshold'], '- resolution',
+                  str(settings['resolution_percentage']) + '%')
+            self.applyRenderSettings(settings)
+        return renderTime
+
+    def packPayload(self):
+        # Shape the read pixels and convert them to the wire dtype: (pixels, width, height, channels, extra), or None
+        # in 'ack' mode. extra: appended reply header blocks. pixels is a view on the reused wire buffer: it must be
+        # sent before the next step (pipelined mode: before the step after the next one)
+        if self.mode == 'ack':
+            return None
+        width, height = self.imageBuffer.size
+        if self.shaper.isIdentity():
+            self.imageBuffer.pack()
+            return self.imageBuffer.packed, width, height, 4, self.renderSettingsExtra
+        shaped = self.shaper.apply(self.imageBuffer.pixels, width, height)
+        self.imageBuffer.pack(shaped)
+        extra = self.renderSettingsExtra
+        if self.shaper.roiCrop:
+            (colOffset, rowOffset, _, _) = self.shaper.roi
+            extra += corto_protocol.pack_roi_extra(colOffset, rowOffset, width // self.shaper.binning,
+                                                  height // self.shaper.binning, self.shaper.binning)
+        return self.imageBuffer.packed, shaped.shape[1], shaped.shape[0], shaped.shape[2], extra
+
+    def replyPayload(self):
+        # Payload of the last step: (pixels, width, height, channels, extra), or None in 'ack' mode
+        return self.payload
+
+    def stats(self) -> dict:
+        return {'render_cache': self.renderCache.stats() if self.renderCache is not None else None,
+                'render_budget': self.renderBudget.stats() if self.renderBudget is not None else None}
+
+    def reply(self, clientsocket, ii: int, payload, renderTime: float, stepTime: float, batchExtra: bytes = b'') -> int:
+        # Send the reply of step ii (payload: replyPayload() of the step) over TCP. Returns the number of bytes sent.
+        # batchExtra: BAT1 block of batched requests
+        tcpProtocol = self.serverParams['tcp_protocol']
+        if payload is None:
+            if tcpProtocol == 'framed':
+                return corto_protocol.send_frame(clientsocket, ii, None, renderTime=renderTime, stepTime=stepTime, extra=batchExtra)
+            data_string = pickle.dumps(np.double(ii))
+            clientsocket.sendall(data_string)
+            return len(data_string)
+        if self.shmRing is not None:
+            # Pixels in the shared memory ring, sequence number in the reply header
+            (pixels, width, height, channels, extra) = payload
+            seq = self.shmRing.write(pixels)
+            return corto_protocol.send_shm_notice(clientsocket, ii, seq, pixels, width, height, channels, renderTime, stepTime, extra + batchExtra)
+        if tcpProtocol == 'framed':
+            (pixels, width, height, channels, extra) = payload
+            return corto_protocol.send_frame(clientsocket, ii, pixels, width, height, channels, renderTime, stepTime, extra + batchExtra)
+        return self.imageBuffer.send(clientsocket, payload[0])
+
+    def serve(self):
+        # Open the UDP (poses) and TCP (replies) sockets and serve requests until the client disconnects
+        address = self.serverParams['address']
+        r = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        r.bind((address, int(self.serverParams['port_M2B'])))
+        s.bind((address, int(self.serverParams['port_B2M'])))
+        s.listen(5)
+        print('CORTO GNC server (mode: ' + self.mode + ', protocol: ' + self.serverParams['tcp_protocol'] +
+              ') waiting for the client on port ' + str(self.serverParams['port_B2M']) + '...')
+        clientsocket = None
+        try:
+            (clientsocket, clientAddress) = s.accept()
+            print('Client connected:', clientAddress, '- waiting for data...\n')
+            if self.pipeline:
+                nSteps = self.servePipelined(r, clientsocket)
+            else:
+                nSteps = self.serveSerial(r, clientsocket)
+            print('Client disconnected after', nSteps, 'steps')
+        except KeyboardInterrupt:
+            # SIGINT (e.g. the benchmark stopping a --fake-server): release the resources below
+            print('Server interrupted')
+        finally:
+            if self.renderCache is not None:
+                print('RENDER CACHE:', self.renderCache.stats())
+            if self.renderBudget is not None:
+                print('REAL-TIME:', self.renderBudget.stats())
+            if self.imageLogger is not None:
+                self.imageLogger.close()
+            if clientsocket is not None:
+                clientsocket.close()
+            s.close()
+            r.close()
+            self.close()
+
+    def printPoses(self, PQ_Sun, PQ_SC, PQ_Bodies):
+        print('SUN:   POS ' + str(PQ_Sun[0:3]) + ' - Q ' + str(PQ_Sun[3:7]))
+        print('SC:    POS ' + str(PQ_SC[0:3]) + ' - Q ' + str(PQ_SC[3:7]))
+        for jj in range(self.nBodies):
+            print('BODY (' + str(jj) + '):   POS: ' + str(PQ_Bodies[jj, 0:3]) + ' - Q ' + str(PQ_Bodies[jj, 3:7]))
+
+    def serveSerial(self, r, clientsocket) -> int:
+        # Receive, render and reply one pose at a time. Returns the number of steps served
+        ii = 0
+        try:
+            while True:
+                data, addr = r.recvfrom(corto_protocol.UDP_MAX_PAYLOAD)
+                t_step0 = time.perf_counter()
+                try:
+                    requestID, poses = parse_pose_request(data, self.nBodies)
+                except Exception as exception:
+                    print('Request rejected:', exception)
+                    continue
+                nPoses = poses.shape[0]
+                if requestID is not None:
+                    print('BATCH', requestID, '-', nPoses, 'poses')
+                for kk in range(nPoses):
+                    PQ_Sun, PQ_SC, PQ_Bodies = corto_protocol.split_poses(poses[kk], self.nBodies)
+                    self.printPoses(PQ_Sun, PQ_SC, PQ_Bodies)
+                    renderTime = self.step(ii, PQ_Sun, PQ_SC, PQ_Bodies)
+                    # Streamed: each reply leaves as soon as its pose is rendered
+                    batchExtra = corto_protocol.pack_batch_extra(requestID, kk, nPoses) if requestID is not None else b''
+                    self.reply(clientsocket, ii, self.replyPayload(), renderTime, time.perf_counter() - t_step0, batchExtra)
+                    ii = ii + 1
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        return ii
+
+    def servePipelined(self, r, clientsocket) -> int:
+        '''
+        This function serves the client with three stages running concurrently: a receiver thread (recvfrom and
+        decoding of the next poses), the calling thread (positioning, rendering and readback, bpy) and a sender
+        thread (transmission). The reply of step ii is sent while step ii + 1 is rendered, and is handed to the
+        sender only after the reply of step ii - 1 has been sent, hence replies keep the order of the steps.
+        Returns the number of steps served.
+
+        # Arguments
+            r: bound UDP socket (poses).
+            clientsocket: connected TCP socket (replies).
+        '''
+        poseQueue = queue.Queue()
+        stopEvent = threading.Event()
+
+        def receive():
+            r.settimeout(0.2) # Check stopEvent periodically
+            while not(stopEvent.is_set()):
+                try:
+                    data, addr = r.recvfrom(corto_protocol.UDP_MAX_PAYLOAD)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                t_step0 = time.perf_counter()
+                try:
+                    requestID, poses = parse_pose_request(data, self.nBodies)
+                except Exception as exception:
+                    print('Request rejected:', exception)
+                    continue
+                poseQueue.put((requestID, poses, t_step0))
+
+        def send(ii, payload, renderTime, t_step0, batchExtra):
+            return self.reply(clientsocket, ii, payload, renderTime, time.perf_counter() - t_step0, batchExtra)
+
+        receiver = threading.Thread(target=receive, name='corto-receiver', daemon=True)
+        receiver.start()
+        sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix='corto-sender')
+        pendingReply = None
+        ii = 0
+        nSent = 0
+        try:
+            while True:
+                (requestID, poses, t_step0) = poseQueue.get()
+                nPoses = poses.shape[0]
+                if requestID is not None:
+                    print('BATCH', requestID, '-', nPoses, 'poses')
+                for kk in range(nPoses):
+                    PQ_Sun, PQ_SC, PQ_Bodies = corto_protocol.split_poses(poses[kk], self.nBodies)
+                    self.printPoses(PQ_Sun, PQ_SC, PQ_Bodies)
+                    renderTime = self.step(ii, PQ_Sun, PQ_SC, PQ_Bodies)
+                    if pendingReply is not None:
+                        pendingReply.result() # Reply ii - 1 sent: its buffers are reused at step ii + 1
+                        nSent += 1
+                    batchExtra = corto_protocol.pack_batch_extra(requestID, kk, nPoses) if requestID is not None else b''
+                    pendingReply = sender.submit(send, ii, self.replyPayload(), renderTime, t_step0, batchExtra)
+                    ii = ii + 1
+        except (ConnectionResetError, BrokenPipeError):
+            pendingReply = None
+        finally:
+            stopEvent.set()
+            if pendingReply is not None:
+                try:
+                    pendingReply.result()
+                    nSent += 1
+                except (ConnectionResetError, BrokenPipeError):
+                    pass
+            sender.shutdown()
+            receiver.join()
+        return nSent
+
+    def close(self):
+        # Release the resources shared with other processes
+        if self.shmRing is not None:
+            self.shmRing.close()
+            self.shmRing = None
+
+
+if __name__ == '__main__':
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(description='CORTO GNC render server (run inside Blender).')
+    parser.add_argument('-c', '--config', default=DEFAULT_CONFIG_PATH, help='Server config file (.yml or .json)')
+    parser.add_argument('-m', '--mode', default=None, help='Override Server_params.mode (ack, viewer, disk or a, b, c, d)')
+    parser.add_argument('--protocol', default=None, help='Override Server_params.tcp_protocol (raw or framed)')
+    args = parser.parse_args(argv)
+
+    overrides = {'Server_params': {}}
+    if args.mode is not None:
+        overrides['Server_params']['mode'] = args.mode
+    if args.protocol is not None:
+        overrides['Server_params']['tcp_protocol'] = args.protocol
+    server = BlenderGncServer(load_server_config(args.config, overrides))
+    server.serve()
@@ -0,0 +1,350 @@
+# Multi-client CORTO GNC render server, for several GNC clients (e.g. Monte Carlo runs) against one warm Blender.
+# Network I/O runs on an asyncio event loop in a background thread: it accepts up to max_clients TCP clients
+# and queues their pose requests. Rendering stays on the main thread (bpy is not thread-safe), which pops the
+# requests according to Server_params.queue_policy:
+#   'fifo':   every request is rendered, in arrival order (queue_size bounds the pending requests).
+#   'latest': a new request of a client replaces its pending one (real-time runs: no stale states rendered).
+# Requests and replies use the framed messages of corto_protocol.py on port_B2M. A batched request (K poses) is
+# queued as one request: its poses are rendered back to back and each reply is streamed as soon as it is ready.
+# A dropped request is answered by a reply without payload (one per pose for batched requests).
+# With Server_params.pipeline (and a renderer supporting it), the reply of step ii is written by the network
+# thread while step ii + 1 is rendered. Queue depth, served and dropped counters are printed every stats_period seconds.
+# Usage:
+#   blender -b model.blend -P server_api/corto_async_server.py -- -c server_api/BlenderPy_UDP_TCP_CONFIG.yml [-p latest]
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+import collections
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from corto_server_config import load_server_config, QUEUE_POLICIES
+import corto_protocol
+
+
+class RenderRequest:
+    # poses: (K, pose values) array, K = 1 for single requests
+    __slots__ = ('clientID', 'requestID', 'poses', 'tReceived', 'batched')
+
+    def __init__(self, clientID: int, requestID: int, poses: np.ndarray, tReceived: float, batched: bool = False):
+        self.clientID = clientID
+        self.requestID = requestID
+        self.poses = poses
+        self.tReceived = tReceived
+        self.batched = batched
+
+    def batchExtra(self, index: int) -> bytes:
+        # BAT1 block of the reply to pose index (empty for single requests)
+        if not(self.batched):
+            return b''
+        return corto_protocol.pack_batch_extra(self.requestID, index, self.poses.shape[0])
+
+
+class RenderRequestQueue:
+    '''
+    Thread-safe queue of render requests between the network thread and the render (main) thread.
+
+    # Arguments
+        policy: string, 'fifo' or 'latest' (only the newest pending request of each client is kept).
+        maxSize: scalar, maximum number of pending requests (0: unbounded). When full, new requests are dropped.
+    '''
+    def __init__(self, policy: str = 'fifo', maxSize: int = 0):
+        if policy not in QUEUE_POLICIES:
+            raise Exception('Invalid queue policy ' + str(policy) + '. Supported: ' + str(QUEUE_POLICIES))
+        self.policy = policy
+        self.maxSize = int(maxSize)
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.nReceived = 0
+        self.nServed = 0
+        self.nDropped = 0
+        self.nCancelled = 0 # Pending requests of disconnected clients
+        self.maxDepth = 0
+
+    def put(self, request: RenderRequest) -> list:
+        # Queue a request. Returns the requests dropped because of it (to be answered without payload)
+        with self.condition:
+            self.nReceived += 1
+            dropped = []
+            if self.policy == 'latest':
+                superseded = [pending for pending in self.pending if pending.clientID == request.clientID]
+                for pending in superseded:
+                    self.pending.remove(pending)
+                dropped.extend(superseded)
+            if self.maxSize > 0 and len(self.pending) >= self.maxSize:
+                dropped.append(request)
+            else:
+                self.pending.append(request)
+                self.maxDepth = max(self.maxDepth, len(self.pending))
+                self.condition.notify()
+            self.nDropped += len(dropped)
+            return dropped
+
+    def get(self, timeout: float = None):
+        # Next request to render, or None if the queue is closed (or on timeout)
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.pending) > 0 or self.closed, timeout)
+            if len(self.pending) == 0:
+                return None
+            return self.pending.popleft()
+
+    def markServed(self):
+        with self.condition:
+            self.nServed += 1
+
+    def removeClient(self, clientID: int):
+        with self.condition:
+            cancelled = [pending for pending in self.pending if pending.clientID == clientID]
+            for pending in cancelled:
+                self.pending.remove(pending)
+            self.nCancelled += len(cancelled)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def depth(self) -> int:
+        with self.condition:
+            return len(self.pending)
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {'policy': self.policy, 'depth': len(self.pending), 'max_depth': self.maxDepth,
+                    'received': self.nReceived, 'served': self.nServed, 'dropped': self.nDropped,
+                    'cancelled': self.nCancelled}
+
+
+class AsyncGncServer:
+    '''
+    asyncio front end of a render server. The renderer must provide nBodies, step(ii, PQ_Sun, PQ_SC, PQ_Bodies)
+    returning the render time, and replyPayload() returning (pixels, width, height, channels, extra) or None
+    (e.g. BlenderPy_UDP_TCP_interface.BlenderGncServer). If renderer.pipeline is True, the payload of a step must
+    stay valid during the next step.
+
+    # Arguments
+        renderer: render server, called from the thread running serve() only.
+        config: dict, as returned by corto_server_config.load_server_config.
+    '''
+    def __init__(self, renderer, config: dict):
+        self.renderer = renderer
+        self.serverParams = config['Server_params']
+        self.queue = RenderRequestQueue(self.serverParams['queue_policy'], self.serverParams['queue_size'])
+        self.maxClients = int(self.serverParams['max_clients'])
+        self.statsPeriod = float(self.serverParams['stats_period'])
+        self.clients = {} # Client id -> asyncio StreamWriter (accessed on the event loop only)
+        self.nextClientID = 0
+        self.nInvalid = 0
+        self.loop = None
+        self.thread = None
+        self.ready = threading.Event()
+        self.startError = None
+        self.stopLock = threading.Lock()
+        self.stopped = False
+
+    def start(self):
+        # Start the event loop thread and wait until the TCP server is listening
+        self.thread = threading.Thread(target=self._runLoop, name='corto-network', daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.startError is not None:
+            raise self.startError
+
+    def _runLoop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            tcpServer = self.loop.run_until_complete(asyncio.start_server(
+                self._handleClient, self.serverParams['address'], int(self.serverParams['port_B2M'])))
+        except Exception as exception:
+            self.startError = exception
+            self.ready.set()
+            return
+        statsTask = self.loop.create_task(self._printStatsPeriodically()) if self.statsPeriod > 0 else None
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            # Close the listening socket and the client connections before closing the loop
+            tcpServer.close()
+            if statsTask is not None:
+                statsTask.cancel()
+            for writer in list(self.clients.values()):
+                writer.close() # The client handler then ends on EOF
+            self.loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(self.loop), return_exceptions=True))
+            self.loop.run_until_complete(tcpServer.wait_closed())
+            self.loop.close()
+
+    async def _handleClient(self, reader, writer):
+        if len(self.clients) >= self.maxClients:
+            print('Connection refused: max_clients (' + str(self.maxClients) + ') reached')
+            writer.close()
+            return
+        clientID = self.nextClientID
+        self.nextClientID += 1
+        self.clients[clientID] = writer
+        print('Client', clientID, 'connected:', writer.get_extra_info('peername'))
+        try:
+            while True:
+                request = await self._readRequest(reader, clientID)
+                for droppedRequest in self.queue.put(request):
+                    for kk in range(droppedRequest.poses.shape[0]):
+                        await self._sendReply(droppedRequest, None, 0.0, time.perf_counter() - droppedRequest.tReceived, kk)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as exception:
+            print('Client', clientID, 'error:', exception)
+        finally:
+            del self.clients[clientID]
+            self.queue.removeClient(clientID)
+            writer.close()
+            print('Client', clientID, 'disconnected')
+
+    async def _readRequest(self, reader, clientID: int) -> RenderRequest:
+        # Next single (b'CRTQ') or batched (b'CRTB') request of the stream
+        magic = await reader.readexactly(4)
+        if magic == corto_protocol.BATCH_MAGIC:
+            header = corto_protocol.unpack_batch_header(magic + await reader.readexactly(corto_protocol.BATCH_HEADER_SIZE - 4))
+            if header['header_size'] > corto_protocol.BATCH_HEADER_SIZE:
+                await reader.readexactly(header['header_size'] - corto_protocol.BATCH_HEADER_SIZE)
+            payload = await reader.readexactly(8*header['n_poses']*header['pose_values'])
+            poses = np.frombuffer(payload, dtype='<f8').reshape(header['n_poses'], header['pose_values'])
+            return RenderRequest(clientID, header['request_id'], poses, time.perf_counter(), batched=True)
+        header = corto_protocol.unpack_request_header(magic + await reader.readexactly(corto_protocol.REQUEST_HEADER_SIZE - 4))
+        if header['header_size'] > corto_protocol.REQUEST_HEADER_SIZE:
+            await reader.readexactly(header['header_size'] - corto_protocol.REQUEST_HEADER_SIZE)
+        payload = await reader.readexactly(8*header['n_values'])
+        return RenderRequest(clientID, header['request_id'], np.frombuffer(payload, dtype='<f8').reshape(1, -1), time.perf_counter())
+
+    async def _sendReply(self, request: RenderRequest, payload, renderTime: float, stepTime: float, index: int = 0):
+        # Framed reply to pose index of request (payload None: no image)
+        writer = self.clients.get(request.clientID)
+        if writer is None:
+            return
+        batchExtra = request.batchExtra(index)
+        if payload is None:
+            writer.write(corto_protocol.pack_header(request.requestID, 0, 0, 0, None, 0, renderTime, stepTime, batchExtra))
+        elif getattr(self.renderer, 'shmRing', None) is not None:
+            # Pixels in the shared memory ring of the renderer, sequence number in the reply header
+            (pixels, width, height, channels, extra) = payload
+            seq = self.renderer.shmRing.write(pixels)
+            writer.write(corto_protocol.pack_shm_notice(request.requestID, seq, pixels, width, height, channels, renderTime, stepTime, extra + batchExtra))
+        else:
+            (pixels, width, height, channels, extra) = payload
+            payloadView = memoryview(pixels).cast('B')
+            writer.write(corto_protocol.pack_header(request.requestID, width, height, channels, pixels.dtype,
+                                                    payloadView.nbytes, renderTime, stepTime, extra + batchExtra))
+            writer.write(payloadView)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def _printStatsPeriodically(self):
+        while True:
+            await asyncio.sleep(self.statsPeriod)
+            self.printStats()
+
+    def stats(self) -> dict:
+        stats = self.queue.stats()
+        stats['clients'] = len(self.clients)
+        stats['invalid'] = self.nInvalid
+        if hasattr(self.renderer, 'stats'):
+            stats.update(self.renderer.stats())
+        return stats
+
+    def printStats(self):
+        stats = self.stats()
+        print('QUEUE (' + stats['policy'] + '): clients', stats['clients'], '- depth', stats['depth'],
+              '(max', str(stats['max_depth']) + ') - received', stats['received'], '- served', stats['served'],
+              '- dropped', stats['dropped'], '- cancelled', stats['cancelled'], '- invalid', stats['invalid'])
+        if stats.get('render_cache') is not None:
+            cacheStats = stats['render_cache']
+            print('RENDER CACHE: entries', cacheStats['entries'], '-', round(cacheStats['bytes']/1024**2, 1), 'MB - hits',
+                  cacheStats['hits'], '- misses', cacheStats['misses'], '- hit rate', round(cacheStats['hit_rate'], 3),
+                  '- evictions', cacheStats['evictions'])
+        if stats.get('render_budget') is not None:
+            budgetStats = stats['render_budget']
+            print('REAL-TIME: target', round(budgetStats['target_period']*1e3, 1), 'ms - frames', budgetStats['frames'],
+                  '- missed', budgetStats['missed'], '- quality level', budgetStats['level'], '/', budgetStats['n_levels'] - 1,
+                  '- samples', budgetStats['samples'], '- resolution', str(budgetStats['resolution_percentage']) + '%')
+
+    def serve(self):
+        # Render loop, on the calling (main) thread. Runs until interrupted
+        self.start()
+        print('CORTO async GNC server listening on port', self.serverParams['port_B2M'],
+              '(queue policy: ' + self.queue.policy + ', max clients: ' + str(self.maxClients) + ')')
+        pipeline = bool(getattr(self.renderer, 'pipeline', False)) # Renderer payloads valid for two steps
+        pendingReply = None
+        ii = 0
+        try:
+            while True:
+                request = self.queue.get()
+                if request is None:
+                    break
+                for kk in range(request.poses.shape[0]):
+                    try:
+                        PQ_Sun, PQ_SC, PQ_Bodies = corto_protocol.split_poses(request.poses[kk], self.renderer.nBodies)
+                    except Exception as exception:
+                        print('Client', request.clientID, 'request', request.requestID, 'rejected:', exception)
+                        self.nInvalid += 1
+                        payload, renderTime = None, 0.0
+                    else:
+                        renderTime = self.renderer.step(ii, PQ_Sun, PQ_SC, PQ_Bodies)
+                        payload = self.renderer.replyPayload()
+                        ii = ii + 1
+                    # Wait for the previous reply to be handed to the transport: its payload buffer is reused by the
+                    # next step. Without pipeline, wait for this reply as well
+                    if pendingReply is not None:
+                        pendingReply.result()
+                    pendingReply = asyncio.run_coroutine_threadsafe(self._sendReply(request, payload, renderTime,
+                                                                                    time.perf_counter() - request.tReceived, kk), self.loop)
+                    if not(pipeline):
+                        pendingReply.result()
+                        pendingReply = None
+                self.queue.markServed()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if pendingReply is not None:
+                pendingReply.result()
+            self.stop()
+            if hasattr(self.renderer, 'close'):
+                self.renderer.close()
+
+    def stop(self):
+        # Idempotent: called by serve() on exit and possibly by the owner of the server
+        with self.stopLock:
+            if self.stopped:
+                return
+            self.stopped = True
+        self.queue.close()
+        if self.loop is not None and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+        self.printStats()
+
+
+if __name__ == '__main__':
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(description='CORTO multi-client GNC render server (run inside Blender).')
+    parser.add_argument('-c', '--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'BlenderPy_UDP_TCP_CONFIG.yml'),
+                        help='Server config file (.yml or .json)')
+    parser.add_argument('-m', '--mode', default=None, help='Override Server_params.mode (ack, viewer, disk or a, b, c, d)')
+    parser.add_argument('-p', '--policy', default=None, help='Override Server_params.queue_policy (fifo or latest)')
+    args = parser.parse_args(argv)
+
+    overrides = {'Server_params': {'tcp_protocol': 'framed'}}
+    if args.mode is not None:
+        overrides['Server_params']['mode'] = args.mode
+    if args.policy is not None:
+        overrides['Server_params']['queue_policy'] = args.policy
+    config = load_server_config(args.config, overrides)
+
+    from BlenderPy_UDP_TCP_interface import BlenderGncServer # Requires bpy
+    AsyncGncServer(BlenderGncServer(config), config).serve()
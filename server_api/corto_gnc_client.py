@@ -0,0 +1,359 @@
+# Stand-in GNC client of the CORTO GNC servers, and closed-loop latency benchmark.
+# It replays a pose trajectory (Cloud_*.txt geometry file or .npy pose store, see functions/rendering/pose_io.py)
+# with the same protocols used by the Simulink NAVCAM_HF_1 models, and measures per-step round-trip latency,
+# throughput and payload size. Run with a plain Python interpreter, e.g.:
+#   python server_api/corto_gnc_client.py -c server_api/BlenderPy_UDP_TCP_CONFIG.yml -g Cloud.txt -n 500 --report out/report
+# Against a server started with the Blender stand-in (no Blender needed, e.g. on CI):
+#   python server_api/corto_gnc_client.py -c server_api/BlenderPy_UDP_TCP_CONFIG.yml -g Cloud.txt --fake-server
+# Request protocols:
+#   'udp': big-endian doubles in a UDP datagram to port_M2B, reply on the TCP connection to port_B2M
+#          (BlenderPy_UDP_TCP_interface.py and CORTO_interface_HF_1_* scripts).
+#   'tcp': framed requests and replies on the TCP connection (corto_async_server.py).
+# With --batch K, K poses are sent per (batched) request and the replies are received as they are streamed back.
+
+import os
+import sys
+import json
+import time
+import pickle
+import socket
+import argparse
+import signal
+import platform
+import subprocess
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'rendering'))
+from corto_server_config import load_server_config
+from corto_image_io import get_wire_dtype
+from corto_image_shaping import shaper_from_config
+import corto_protocol
+import pose_io
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_BPY_DIR = os.path.join(SERVER_DIR, 'fake_bpy')
+LATENCY_PERCENTILES = [50, 90, 95, 99]
+
+
+def sun_track_quaternion(rSun: np.ndarray) -> np.ndarray:
+    '''
+    This function returns the Sun light orientation used by RenderFromTxt.py, i.e.
+    mathutils.Vector(rSun/|rSun|).to_track_quat('Z', 'Y'), for N Sun positions at once (N, 4), WXYZ.
+
+    # Arguments
+        rSun: (N, 3) array, Sun positions.
+    '''
+    vec = np.atleast_2d(np.asarray(rSun, dtype=np.float64))
+    vec = vec / np.linalg.norm(vec, axis=1, keepdims=True)
+    # Rotation of +Z onto vec (axis normal to both), as in Blender vec_to_quat
+    nor = np.stack((-vec[:, 1], vec[:, 0], np.zeros(vec.shape[0])), axis=1)
+    norLength = np.linalg.norm(nor, axis=1)
+    aligned = np.abs(vec[:, 0]) + np.abs(vec[:, 1]) <= 1e-4
+    nor[aligned] = [1.0, 0.0, 0.0]
+    nor[~aligned] /= norLength[~aligned, None]
+    angle = 0.5*np.arccos(np.clip(vec[:, 2], -1.0, 1.0))
+    q = np.concatenate((np.cos(angle)[:, None], nor*np.sin(angle)[:, None]), axis=1)
+    # Roll about vec such that the local +Y axis points up (towards +Z, in the plane of vec and +Z)
+    (q0, q1, q2, q3) = q.T
+    yAxis = np.stack((2*(q1*q2 - q0*q3), 1 - 2*(q1**2 + q3**2), 2*(q2*q3 + q0*q1)), axis=1)
+    up = np.array([0.0, 0.0, 1.0]) - vec*vec[:, 2:3]
+    angle = np.zeros(vec.shape[0])
+    hasUp = np.linalg.norm(up, axis=1) > 1e-9 # vec along Z: no roll
+    angle[hasUp] = np.arctan2(np.sum(np.cross(yAxis, up)*vec, axis=1), np.sum(yAxis*up, axis=1))[hasUp]
+    roll = np.concatenate((np.cos(0.5*angle)[:, None], vec*np.sin(0.5*angle)[:, None]), axis=1)
+    return quaternion_product(roll, q)
+
+
+def quaternion_product(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # Hamilton product of (N, 4) WXYZ quaternions
+    return np.stack((a[:, 0]*b[:, 0] - a[:, 1]*b[:, 1] - a[:, 2]*b[:, 2] - a[:, 3]*b[:, 3],
+                     a[:, 0]*b[:, 1] + a[:, 1]*b[:, 0] + a[:, 2]*b[:, 3] - a[:, 3]*b[:, 2],
+                     a[:, 0]*b[:, 2] + a[:, 2]*b[:, 0] + a[:, 3]*b[:, 1] - a[:, 1]*b[:, 3],
+                     a[:, 0]*b[:, 3] + a[:, 3]*b[:, 0] + a[:, 1]*b[:, 2] - a[:, 2]*b[:, 1]), axis=1)
+
+
+def load_trajectory(geometryFilePath: str, scaleBU: float = 1.0, nBodies: int = 1) -> np.ndarray:
+    '''
+    This function converts a geometry file (18 columns, see README.md) into pose requests. Returns an
+    (N, 7*(nBodies + 2)) array of rows [PQ_Sun, PQ_SC, PQ_Body, ...]; the body pose is repeated for nBodies > 1.
+
+    # Arguments
+        geometryFilePath: string, .txt (optionally compressed) or .npy pose store.
+        scaleBU: scalar, scale of the positions (scale_BU of the CORTO config).
+        nBodies: scalar, number of bodies expected by the server.
+    '''
+    geometry = np.asarray(pose_io.load_geometry(geometryFilePath), dtype=np.float64)
+    nPoses = geometry.shape[0]
+    PQ_Sun = np.zeros((nPoses, 7))
+    PQ_Sun[:, 3:7] = sun_track_quaternion(geometry[:, 15:18])
+    PQ_SC = np.concatenate((geometry[:, 8:11]*scaleBU, geometry[:, 11:15]), axis=1)
+    PQ_Body = np.concatenate((geometry[:, 1:4]*scaleBU, geometry[:, 4:8]), axis=1)
+    return np.concatenate([PQ_Sun, PQ_SC] + [PQ_Body]*nBodies, axis=1)
+
+
+class GncClient:
+    '''
+    Client of a CORTO GNC server.
+
+    # Arguments
+        config: dict, server config (as returned by corto_server_config.load_server_config).
+        requestProtocol: string, 'udp' or 'tcp' (see the header of this file).
+        host: string, server address.
+    '''
+    def __init__(self, config: dict, requestProtocol: str = 'udp', host: str = '127.0.0.1'):
+        self.config = config
+        self.serverParams = config['Server_params']
+        self.requestProtocol = requestProtocol
+        self.host = host
+        self.framed = (requestProtocol == 'tcp' or self.serverParams['tcp_protocol'] == 'framed')
+        self.mode = self.serverParams['mode']
+        self.receiveBuffer = None
+        self.shmRing = None
+        self.tcp = None
+        self.udp = None
+
+    def connect(self, timeout: float = 30.0):
+        # Retry until the server listens (it may still be loading the scene)
+        t0 = time.time()
+        while True:
+            try:
+                self.tcp = socket.create_connection((self.host, int(self.serverParams['port_B2M'])), timeout=timeout)
+                break
+            except OSError:
+                if time.time() - t0 > timeout:
+                    raise Exception('CORTO server not reachable on ' + self.host + ':' + str(self.serverParams['port_B2M']))
+                time.sleep(0.2)
+        self.tcp.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.requestProtocol == 'udp':
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.serverParams['transport'] == 'shm':
+            from corto_shm_transport import ShmFrameRing
+            self.shmRing = ShmFrameRing(self.serverParams['shm_name'])
+
+    def rawReplySize(self) -> int:
+        # Bytes of a raw (unframed) reply, from the server config
+        if self.mode == 'ack':
+            return len(pickle.dumps(np.double(0)))
+        camParams = self.config['Camera_params']
+        shaper = shaper_from_config(camParams)
+        nPixels = (int(camParams['sensor_size_x']) // shaper.binning)*(int(camParams['sensor_size_y']) // shaper.binning)
+        return nPixels*shaper.nChannels()*get_wire_dtype(self.serverParams['image_dtype']).itemsize
+
+    def request(self, requestID: int, poses: np.ndarray):
+        '''
+        This function sends one pose request and waits for the reply. Returns (header, payload, nBytes):
+        header is None for raw replies, payload the received pixels (or acknowledgement).
+
+        # Arguments
+            requestID: scalar, request id (framed requests only).
+            poses: 1D array [PQ_Sun, PQ_SC, PQ_Body_1, ..., PQ_Body_N].
+        '''
+        if self.requestProtocol == 'udp':
+            self.udp.sendto(np.asarray(poses, dtype='>f8').tobytes(), (self.host, int(self.serverParams['port_M2B'])))
+        else:
+            corto_protocol.send_request(self.tcp, requestID, poses)
+        return self.receiveReply()
+
+    def requestBatch(self, requestID: int, poses: np.ndarray):
+        '''
+        This generator sends K poses in one batched request and yields (header, payload, nBytes) for each reply,
+        in pose order, as soon as it is received. payload is valid until the next reply is read (shared-memory
+        transport: while the frame is current in the ring, the server does not wait for the client within a batch).
+
+        # Arguments
+            requestID: scalar, id of the batched request.
+            poses: (K, 7*(nBodies + 2)) array of pose requests.
+        '''
+        poses = np.atleast_2d(poses)
+        if self.requestProtocol == 'udp':
+            if poses.shape[0] > corto_protocol.max_batch_datagram(poses.shape[1]):
+                raise Exception('Batch of ' + str(poses.shape[0]) + ' poses exceeds a UDP datagram (max ' +
+                                str(corto_protocol.max_batch_datagram(poses.shape[1])) + '): use the tcp protocol.')
+            self.udp.sendto(corto_protocol.pack_batch_request(requestID, poses), (self.host, int(self.serverParams['port_M2B'])))
+        else:
+            corto_protocol.send_batch_request(self.tcp, requestID, poses)
+        for kk in range(poses.shape[0]):
+            yield self.receiveReply()
+
+    def receiveReply(self):
+        # Next reply on the TCP connection: (header, payload, nBytes), header None for raw replies
+        if not(self.framed):
+            nBytes = self.rawReplySize()
+            if self.receiveBuffer is None or len(self.receiveBuffer) < nBytes:
+                self.receiveBuffer = bytearray(nBytes)
+            payload = corto_protocol.recv_exact(self.tcp, nBytes, self.receiveBuffer)
+            return None, payload, nBytes
+        header, payload = corto_protocol.recv_frame(self.tcp, self.receiveBuffer)
+        if payload is not None and (self.receiveBuffer is None or len(self.receiveBuffer) < header['payload_size']):
+            self.receiveBuffer = bytearray(header['payload_size']) # Reused by the next replies
+        seq = corto_protocol.shm_seq(header)
+        if seq is not None:
+            payload = self.shmRing.read(seq, header['dtype_name'])
+        return header, payload, header['header_size'] + (header['payload_size'] if seq is None else 0)
+
+    def close(self):
+        if self.shmRing is not None:
+            self.shmRing.close()
+        if self.tcp is not None:
+            self.tcp.close()
+        if self.udp is not None:
+            self.udp.close()
+
+
+def run_benchmark(client: GncClient, requests: np.ndarray, nWarmup: int = 5, batchSize: int = 1) -> dict:
+    '''
+    This function replays the pose requests (closed loop) and returns the per-step records: latency [s], reply
+    bytes, server render and step times [s] (framed replies only, NaN otherwise), samples and resolution scale [%]
+    (real-time mode only, NaN otherwise). With batchSize > 1 the poses are
+    sent in batched requests and the latency of a step is the time from the request to the arrival of its reply.
+
+    # Arguments
+        client: connected GncClient.
+        requests: (N, 7*(nBodies + 2)) array of pose requests.
+        nWarmup: scalar, number of initial steps excluded from the statistics (rounded up to whole batches).
+        batchSize: scalar, number of poses per request. 1: single-pose requests.
+    '''
+    nSteps = requests.shape[0]
+    records = {'latency_s': np.empty(nSteps), 'reply_bytes': np.empty(nSteps, dtype=np.int64),
+               'render_time_s': np.full(nSteps, np.nan), 'step_time_s': np.full(nSteps, np.nan),
+               'samples': np.full(nSteps, np.nan), 'resolution_percentage': np.full(nSteps, np.nan)}
+    tStart = None
+    nWarmupSteps = nSteps
+    for ii in range(0, nSteps, batchSize):
+        if tStart is None and ii >= nWarmup:
+            tStart = time.perf_counter()
+            nWarmupSteps = ii
+        t0 = time.perf_counter()
+        if batchSize == 1:
+            replies = [client.request(ii, requests[ii])]
+        else:
+            replies = client.requestBatch(ii // batchSize, requests[ii:ii + batchSize])
+        for (kk, (header, payload, nBytes)) in enumerate(replies):
+            records['latency_s'][ii + kk] = time.perf_counter() - t0
+            records['reply_bytes'][ii + kk] = nBytes
+            if header is not None:
+                records['render_time_s'][ii + kk] = header['render_time']
+                records['step_time_s'][ii + kk] = header['step_time']
+                settings = corto_protocol.render_settings(header)
+                if settings is not None:
+                    records['samples'][ii + kk] = settings['samples']
+                    records['resolution_percentage'][ii + kk] = settings['resolution_percentage']
+    wallTime = (time.perf_counter() - tStart) if tStart is not None else 0.0
+    return {'records': records, 'n_warmup': nWarmupSteps, 'wall_time_s': wallTime}
+
+
+def summarize(run: dict) -> dict:
+    # Percentile report of a benchmark run (warmup steps excluded)
+    records = {name: values[run['n_warmup']:] for (name, values) in run['records'].items()}
+    nSteps = records['latency_s'].size
+    summary = {'steps': int(nSteps), 'warmup_steps': int(run['n_warmup']), 'wall_time_s': run['wall_time_s'],
+               'throughput_steps_s': (nSteps / run['wall_time_s']) if run['wall_time_s'] > 0 else 0.0,
+               'throughput_MB_s': (float(records['reply_bytes'].sum()) / 1024**2 / run['wall_time_s']) if run['wall_time_s'] > 0 else 0.0,
+               'reply_bytes_mean': float(records['reply_bytes'].mean()) if nSteps > 0 else 0.0}
+    for name in ['latency_s', 'render_time_s', 'step_time_s']:
+        values = records[name][np.isfinite(records[name])]
+        if values.size == 0:
+            continue
+        stats = {'mean': float(values.mean()), 'min': float(values.min()), 'max': float(values.max())}
+        for percentile in LATENCY_PERCENTILES:
+            stats['p' + str(percentile)] = float(np.percentile(values, percentile))
+        summary[name] = stats
+    reported = np.isfinite(records['samples'])
+    if np.any(reported):
+        # Real-time mode: render settings used by the server
+        summary['render_settings'] = {'samples_mean': float(records['samples'][reported].mean()),
+                                      'samples_min': float(records['samples'][reported].min()),
+                                      'resolution_percentage_mean': float(records['resolution_percentage'][reported].mean()),
+                                      'resolution_percentage_min': float(records['resolution_percentage'][reported].min())}
+    return summary
+
+
+def write_report(reportPath: str, summary: dict, run: dict, metadata: dict):
+    # <reportPath>.json (summary and run metadata) and <reportPath>.csv (per-step records)
+    reportDir = os.path.dirname(os.path.abspath(reportPath))
+    os.makedirs(reportDir, exist_ok=True)
+    with open(reportPath + '.json', 'w') as reportFile:
+        json.dump({'metadata': metadata, 'summary': summary}, reportFile, indent=2)
+    names = list(run['records'].keys())
+    table = np.column_stack([np.arange(run['records']['latency_s'].size)] + [run['records'][name] for name in names])
+    np.savetxt(reportPath + '.csv', table, delimiter=',', header='step,' + ','.join(names), comments='',
+               fmt=['%d'] + ['%.9g']*len(names))
+
+
+def print_summary(summary: dict):
+    print('BENCHMARK:', summary['steps'], 'steps in', round(summary['wall_time_s'], 3), 's -',
+          round(summary['throughput_steps_s'], 2), 'steps/s -', round(summary['throughput_MB_s'], 2), 'MB/s -',
+          int(summary['reply_bytes_mean']), 'bytes/reply')
+    for name in ['latency_s', 'render_time_s', 'step_time_s']:
+        if name in summary:
+            stats = summary[name]
+            print('{:<14s}'.format(name), ' '.join('{}={:.3f}ms'.format(key, value*1e3) for (key, value) in stats.items()))
+    if 'render_settings' in summary:
+        print('{:<14s}'.format('render_settings'), ' '.join('{}={:.1f}'.format(key, value) for (key, value) in summary['render_settings'].items()))
+
+
+def launch_fake_server(configFilePath: str, server: str = 'udp', extraArgs=()) -> subprocess.Popen:
+    # Start a server on the bpy stand-in (fake_bpy/bpy.py) in a separate Python process
+    script = os.path.join(SERVER_DIR, 'corto_async_server.py' if server == 'tcp' else 'BlenderPy_UDP_TCP_interface.py')
+    bootstrap = ('import sys, runpy; sys.path.insert(0, ' + repr(FAKE_BPY_DIR) + '); '
+                 'sys.argv = [' + repr(script) + ', "--"] + sys.argv[1:]; runpy.run_path(' + repr(script) + ', run_name="__main__")')
+    return subprocess.Popen([sys.executable, '-c', bootstrap, '-c', configFilePath] + list(extraArgs),
+                            stdout=subprocess.DEVNULL)
+
+
+def stop_fake_server(serverProcess: subprocess.Popen, timeout: float = 5.0):
+    # SIGINT first, such that the server releases its resources (e.g. the shared memory ring)
+    if serverProcess.poll() is None and os.name == 'posix':
+        serverProcess.send_signal(signal.SIGINT)
+        try:
+            serverProcess.wait(timeout)
+        except subprocess.TimeoutExpired:
+            pass
+    if serverProcess.poll() is None:
+        serverProcess.terminate()
+        serverProcess.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a pose trajectory against a CORTO GNC server and report latencies.')
+    parser.add_argument('-c', '--config', default=os.path.join(SERVER_DIR, 'BlenderPy_UDP_TCP_CONFIG.yml'), help='Server config file (.yml or .json)')
+    parser.add_argument('-g', '--geometry', required=True, help='Trajectory: geometry .txt file or .npy pose store')
+    parser.add_argument('-n', '--steps', type=int, default=0, help='Number of steps (0: whole trajectory)')
+    parser.add_argument('--warmup', type=int, default=5, help='Initial steps excluded from the statistics')
+    parser.add_argument('--scale', type=float, default=1.0, help='Scale of the trajectory positions (scale_BU)')
+    parser.add_argument('--batch', type=int, default=1, help='Poses per request (batched requests if > 1)')
+    parser.add_argument('--protocol', default='udp', choices=['udp', 'tcp'], help='Request protocol')
+    parser.add_argument('--host', default='127.0.0.1', help='Server address')
+    parser.add_argument('--report', default='', help='Report path without extension (.json and .csv are written)')
+    parser.add_argument('--fake-server', action='store_true', help='Start the server on the bpy stand-in (no Blender)')
+    args, serverArgs = parser.parse_known_args()
+
+    overrides = {'Server_params': {'tcp_protocol': 'framed'}} if args.protocol == 'tcp' else None
+    config = load_server_config(args.config, overrides)
+    requests = load_trajectory(args.geometry, args.scale, int(config['BlenderModel_params']['num_bodies']))
+    if args.steps > 0:
+        requests = requests[np.arange(args.steps) % requests.shape[0]] # Wrap around short trajectories
+
+    serverProcess = launch_fake_server(args.config, args.protocol, serverArgs) if args.fake_server else None
+    client = GncClient(config, args.protocol, args.host)
+    try:
+        client.connect()
+        run = run_benchmark(client, requests, args.warmup, max(args.batch, 1))
+    finally:
+        client.close()
+        if serverProcess is not None:
+            stop_fake_server(serverProcess)
+
+    summary = summarize(run)
+    print_summary(summary)
+    if args.report != '':
+        metadata = {'config': os.path.abspath(args.config), 'geometry': os.path.abspath(args.geometry),
+                    'protocol': args.protocol, 'batch': args.batch, 'server_mode': config['Server_params']['mode'],
+                    'tcp_protocol': config['Server_params']['tcp_protocol'], 'transport': config['Server_params']['transport'],
+                    'image_dtype': config['Server_params']['image_dtype'], 'fake_server': args.fake_server,
+                    'resolution': [config['Camera_params']['sensor_size_x'], config['Camera_params']['sensor_size_y']],
+                    'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                    'timestamp': time.strftime('%Y-%m-%d %H:%M:%S')}
+        write_report(args.report, summary, run, metadata)
+        print('Report written in', args.report + '.json')
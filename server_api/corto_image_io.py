@@ -0,0 +1,73 @@
+import numpy as np
+
+# Image readback and transmission helpers for the CORTO GNC interfaces (run inside Blender).
+# Pixels are read with foreach_get into a preallocated float32 buffer, converted in place to the
+# wire dtype and transmitted through a memoryview: no Python float objects and no struct.pack copy.
+
+# Supported wire dtypes (native byte order). Integer dtypes map [0,1] float pixels to the full range
+WIRE_DTYPES = {'float64': np.float64, 'double': np.float64,
+               'float32': np.float32, 'single': np.float32,
+               'uint8': np.uint8,
+               'uint16': np.uint16}
+
+
+def get_wire_dtype(dtypeName: str):
+    if dtypeName not in WIRE_DTYPES:
+        raise Exception('Invalid image dtype ' + str(dtypeName) + '. Supported: ' + str(list(WIRE_DTYPES.keys())))
+    return np.dtype(WIRE_DTYPES[dtypeName])
+
+
+class ImageWireBuffer:
+    '''
+    Reusable buffers to read a Blender image (e.g. 'Viewer Node') and send it over a socket.
+    Buffers are allocated at the first read and reallocated only if the image size changes.
+
+    # Arguments
+        wireDtype: string, dtype of the transmitted pixels (see WIRE_DTYPES).
+    '''
+    def __init__(self, wireDtype: str = 'float64'):
+        self.wireDtype = get_wire_dtype(wireDtype)
+        self.pixels = None # float32 RGBA buffer, as read from Blender
+        self.scratch = None # float32 buffer for integer conversion
+        self.wire = None # Wire dtype buffer
+        self.packed = None # Last packed array (wire buffer, or the input itself if no conversion is needed)
+        self.size = (0, 0)
+
+    def read(self, image) -> np.ndarray:
+        # Read RGBA pixels of a bpy image into the float32 buffer. Returns the flat buffer
+        nValues = len(image.pixels)
+        if self.pixels is None or self.pixels.size != nValues:
+            self.pixels = np.empty(nValues, dtype=np.float32)
+        image.pixels.foreach_get(self.pixels)
+        self.size = tuple(image.size)
+        return self.pixels
+
+    def pack(self, pixels: np.ndarray = None) -> np.ndarray:
+        # Convert pixels (default: last read buffer) to the wire dtype, in the preallocated buffer
+        if pixels is None:
+            pixels = self.pixels
+        pixels = np.ravel(pixels)
+        if pixels.dtype == self.wireDtype:
+            self.packed = pixels # Already in wire dtype: sent as is
+            return self.packed
+        if self.wire is None or self.wire.size != pixels.size:
+            self.wire = np.empty(pixels.size, dtype=self.wireDtype)
+            self.scratch = np.empty(pixels.size, dtype=np.float32) if np.issubdtype(self.wireDtype, np.integer) else None
+        if np.issubdtype(self.wireDtype, np.integer):
+            maxValue = np.iinfo(self.wireDtype).max
+            np.multiply(pixels, maxValue, out=self.scratch)
+            np.add(self.scratch, 0.5, out=self.scratch) # Round to nearest
+            np.clip(self.scratch, 0, maxValue, out=self.scratch)
+            np.copyto(self.wire, self.scratch, casting='unsafe')
+        else:
+            np.copyto(self.wire, pixels, casting='same_kind')
+        self.packed = self.wire
+        return self.packed
+
+    def send(self, sock, wire: np.ndarray = None) -> int:
+        # Transmit the wire buffer (default: last packed) with sendall. Returns the number of bytes sent
+        if wire is None:
+            wire = self.packed
+        payload = memoryview(wire).cast('B')
+        sock.sendall(payload)
+        return payload.nbytes
@@ -0,0 +1,102 @@
+import numpy as np
+
+# Server-side shaping of the rendered image before transmission: channel selection or luminance, integer
+# binning and cropping to the bright-pixel bounding box. Runs on the float32 RGBA readback buffer with
+# vectorized NumPy, before the conversion to the wire dtype.
+# Rows are kept in the Blender order (first row = bottom of the image), hence the ROI row offset is counted
+# from the first transmitted row of the full image. Offsets and sizes of the ROI are in binned pixels.
+
+# Output channels: indices of the RGBA buffer, or 'luminance' (Rec. 709 weights, linear RGB)
+OUTPUT_CHANNELS = {'rgba': [0, 1, 2, 3], 'rgb': [0, 1, 2], 'r': [0], 'g': [1], 'b': [2], 'a': [3], 'luminance': None}
+N_CHANNELS_OUTPUT = {1: 'luminance', 3: 'rgb', 4: 'rgba'} # Camera_params.n_channels_output
+LUMINANCE_WEIGHTS = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+
+class ImageShaper:
+    '''
+    Channel reduction, binning and ROI cropping of RGBA images. Intermediate buffers are reused across frames.
+
+    # Arguments
+        channels: string, key of OUTPUT_CHANNELS.
+        binning: scalar, integer binning factor (mean of binning x binning pixels). 1: full resolution.
+        roiCrop: bool, if True the image is cropped to the bounding box of the pixels brighter than roiThreshold.
+        roiThreshold: scalar, brightness threshold of the ROI (on the output channels, max over channels).
+        roiMargin: scalar, margin around the bright pixels [binned pixels].
+    '''
+    def __init__(self, channels: str = 'rgba', binning: int = 1, roiCrop: bool = False, roiThreshold: float = 0.0, roiMargin: int = 0):
+        if channels not in OUTPUT_CHANNELS:
+            raise Exception('Invalid output channels ' + str(channels) + '. Supported: ' + str(list(OUTPUT_CHANNELS.keys())))
+        if int(binning) < 1:
+            raise Exception('Invalid binning factor ' + str(binning) + ': must be an integer >= 1.')
+        self.channels = channels
+        self.channelIndices = OUTPUT_CHANNELS[channels]
+        self.binning = int(binning)
+        self.roiCrop = bool(roiCrop)
+        self.roiThreshold = float(roiThreshold)
+        self.roiMargin = int(roiMargin)
+        self.reduced = None
+        self.binned = None
+        self.roi = (0, 0, 0, 0) # Last ROI: column offset, row offset, width, height [binned pixels]
+
+    def isIdentity(self) -> bool:
+        return self.channels == 'rgba' and self.binning == 1 and not(self.roiCrop)
+
+    def nChannels(self) -> int:
+        return 1 if self.channelIndices is None else len(self.channelIndices)
+
+    def apply(self, pixels: np.ndarray, width: int, height: int) -> np.ndarray:
+        '''
+        This function shapes a flat RGBA image as read from Blender. Returns a (rows, cols, channels) float32 array
+        (a view on internal buffers, valid until the next call); the ROI is stored in self.roi.
+
+        # Arguments
+            pixels: flat float32 array of width*height*4 values.
+            width, height: scalars, image size [pxl].
+        '''
+        image = np.reshape(pixels, (height, width, 4))
+        # Channel reduction
+        if self.channelIndices is None:
+            if self.reduced is None or self.reduced.shape != (height, width, 1):
+                self.reduced = np.empty((height, width, 1), dtype=np.float32)
+            np.matmul(image[:, :, 0:3], LUMINANCE_WEIGHTS, out=self.reduced[:, :, 0])
+            image = self.reduced
+        elif len(self.channelIndices) < 4:
+            if self.channelIndices == list(range(self.channelIndices[0], self.channelIndices[-1] + 1)):
+                image = image[:, :, self.channelIndices[0]:self.channelIndices[-1] + 1] # Contiguous channels: view
+            else:
+                image = image[:, :, self.channelIndices]
+        # Binning (trailing rows/columns not filling a bin are discarded)
+        if self.binning > 1:
+            b = self.binning
+            binnedShape = (height // b, width // b, image.shape[2])
+            if self.binned is None or self.binned.shape != binnedShape:
+                self.binned = np.empty(binnedShape, dtype=np.float32)
+            blocks = np.reshape(image[0:binnedShape[0]*b, 0:binnedShape[1]*b, :], (binnedShape[0], b, binnedShape[1], b, binnedShape[2]))
+            np.mean(blocks, axis=(1, 3), out=self.binned)
+            image = self.binned
+        # Bright-pixel bounding box
+        self.roi = (0, 0, image.shape[1], image.shape[0])
+        if self.roiCrop:
+            bright = image.max(axis=2) > self.roiThreshold
+            brightRows = np.flatnonzero(bright.any(axis=1))
+            if brightRows.size > 0: # Nothing bright: the full image is sent
+                brightCols = np.flatnonzero(bright.any(axis=0))
+                row0 = max(int(brightRows[0]) - self.roiMargin, 0)
+                row1 = min(int(brightRows[-1]) + 1 + self.roiMargin, image.shape[0])
+                col0 = max(int(brightCols[0]) - self.roiMargin, 0)
+                col1 = min(int(brightCols[-1]) + 1 + self.roiMargin, image.shape[1])
+                image = image[row0:row1, col0:col1, :]
+                self.roi = (col0, row0, col1 - col0, row1 - row0)
+        return image
+
+
+def shaper_from_config(cameraParams: dict) -> ImageShaper:
+    # ImageShaper of the Camera_params section of the server config
+    channels = cameraParams.get('output_channels')
+    if channels is None:
+        nChannelsOutput = int(cameraParams.get('n_channels_output', 4))
+        if nChannelsOutput not in N_CHANNELS_OUTPUT:
+            raise Exception('Invalid n_channels_output ' + str(nChannelsOutput) + '. Supported: ' + str(list(N_CHANNELS_OUTPUT.keys())))
+        channels = N_CHANNELS_OUTPUT[nChannelsOutput]
+    return ImageShaper(channels, cameraParams.get('binning', 1), cameraParams.get('roi_crop', False),
+                       cameraParams.get('roi_threshold', 0.0), cameraParams.get('roi_margin', 0))
@@ -0,0 +1,376 @@
+import struct
+import numpy as np
+
+# Framed, self-describing TCP reply protocol of the CORTO GNC interfaces.
+# Each reply is a fixed-layout header immediately followed by the payload (image pixels, row-major as
+# read from Blender, native byte order). All header fields are little-endian:
+#
+#   magic          4s   b'CRTO'
+#   version        H    PROTOCOL_VERSION
+#   header_size    H    size of the header in bytes (payload starts at this offset)
+#   frame_id       Q    step counter of the server
+#   width          I    [pxl]
+#   height         I    [pxl]
+#   channels       H    number of channels per pixel
+#   dtype          H    DTYPE_CODES
+#   payload_size   Q    payload length in bytes
+#   render_time    d    render time [s]
+#   step_time      d    time from pose reception to reply [s]
+#
+# Clients must read header_size bytes, check magic/version, then read exactly payload_size bytes.
+# Newer protocol versions only append fields: header_size lets older clients skip them.
+#
+# Pose requests sent over TCP (multi-client server, see corto_async_server.py) use the same scheme:
+#
+#   magic          4s   b'CRTQ'
+#   version        H    PROTOCOL_VERSION
+#   header_size    H    size of the header in bytes
+#   request_id     Q    client-side id, echoed as frame_id of the reply
+#   n_values       I    number of float64 pose values that follow
+#
+# followed by n_values little-endian doubles [PQ_Sun, PQ_SC, PQ_Body_1, ..., PQ_Body_N].
+# A reply without payload (dtype none) to a pose request means that the request was dropped by the server queue.
+#
+# Shared-memory transport (see corto_shm_transport.py): the reply header describes the frame as usual, but the
+# payload is in the shared memory ring instead of the stream. Such replies append SHM_EXTRA_FORMAT to the header:
+#
+#   tag            4s   b'SHM1'
+#   seq            Q    sequence number of the frame in the ring
+#
+# and no payload bytes follow on the stream.
+#
+# Shaped images (see corto_image_shaping.py) append ROI_EXTRA_FORMAT, with the position of the transmitted
+# image in the full (binned) image:
+#
+#   tag            4s   b'ROI1'
+#   col_offset     I    first transmitted column [binned pxl]
+#   row_offset     I    first transmitted row [binned pxl]
+#   full_width     I    width of the full binned image [pxl]
+#   full_height    I    height of the full binned image [pxl]
+#   binning        H    binning factor
+#
+# Replies to a batched request (see below) append BATCH_EXTRA_FORMAT:
+#
+#   tag            4s   b'BAT1'
+#   request_id     Q    id of the batched request
+#   index          I    index of the pose in the batch
+#   count          I    number of poses in the batch
+#
+# Frames rendered in real-time mode (RenderingEngine_params.target_frame_period, see corto_render_budget.py)
+# append RENDER_SETTINGS_EXTRA_FORMAT, with the settings actually used for the frame:
+#
+#   tag            4s   b'RTS1'
+#   samples        I    Cycles samples
+#   adaptive_thr   d    Cycles adaptive sampling threshold
+#   res_percentage H    resolution scale [%]
+#   quality_level  H    quality level of the controller (0: best)
+#
+# Appended blocks are concatenated after the fixed header; parse_extra() decodes the known ones.
+#
+# Batched requests carry K poses in one message, as UDP datagram to port_M2B (up to UDP_MAX_PAYLOAD bytes) or on
+# the TCP connection of corto_async_server.py (any size):
+#
+#   magic          4s   b'CRTB'
+#   version        H    PROTOCOL_VERSION
+#   header_size    H    size of the header in bytes
+#   request_id     Q    client-side id, echoed in the BAT1 block of the replies
+#   n_poses        I    number of poses K
+#   pose_values    I    float64 values per pose, 7*(num_bodies + 2)
+#
+# followed by K*pose_values little-endian doubles, one pose vector after the other. The server renders the poses
+# in order and sends one reply per pose as soon as it is rendered. Single-pose UDP datagrams (big-endian doubles,
+# no header) remain supported: a datagram is batched if and only if it starts with b'CRTB'.
+
+PROTOCOL_MAGIC = b'CRTO'
+PROTOCOL_VERSION = 1
+HEADER_FORMAT = '<4sHHQIIHHQdd'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+HEADER_FIELDS = ['magic', 'version', 'header_size', 'frame_id', 'width', 'height', 'channels', 'dtype',
+                 'payload_size', 'render_time', 'step_time']
+
+SHM_TAG = b'SHM1'
+SHM_EXTRA_FORMAT = '<4sQ'
+SHM_EXTRA_SIZE = struct.calcsize(SHM_EXTRA_FORMAT)
+ROI_TAG = b'ROI1'
+ROI_EXTRA_FORMAT = '<4sIIIIH'
+ROI_FIELDS = ['col_offset', 'row_offset', 'full_width', 'full_height', 'binning']
+BATCH_TAG = b'BAT1'
+BATCH_EXTRA_FORMAT = '<4sQII'
+BATCH_EXTRA_FIELDS = ['request_id', 'index', 'count']
+RENDER_SETTINGS_TAG = b'RTS1'
+RENDER_SETTINGS_EXTRA_FORMAT = '<4sIdHH'
+RENDER_SETTINGS_FIELDS = ['samples', 'adaptive_threshold', 'resolution_percentage', 'level']
+EXTRA_FORMATS = {SHM_TAG: SHM_EXTRA_FORMAT, ROI_TAG: ROI_EXTRA_FORMAT, BATCH_TAG: BATCH_EXTRA_FORMAT,
+                 RENDER_SETTINGS_TAG: RENDER_SETTINGS_EXTRA_FORMAT}
+
+REQUEST_MAGIC = b'CRTQ'
+REQUEST_FORMAT = '<4sHHQI'
+REQUEST_HEADER_SIZE = struct.calcsize(REQUEST_FORMAT)
+REQUEST_FIELDS = ['magic', 'version', 'header_size', 'request_id', 'n_values']
+POSE_SIZE = 7 # Position (3) + quaternion WXYZ (4), per object
+
+BATCH_MAGIC = b'CRTB'
+BATCH_FORMAT = '<4sHHQII'
+BATCH_HEADER_SIZE = struct.calcsize(BATCH_FORMAT)
+BATCH_FIELDS = ['magic', 'version', 'header_size', 'request_id', 'n_poses', 'pose_values']
+UDP_MAX_PAYLOAD = 65507 # Largest UDP datagram over IPv4 [bytes]
+
+# Payload dtype codes. DTYPE_NONE: no payload (acknowledge-only replies)
+DTYPE_CODES = {'float64': 0, 'float32': 1, 'uint8': 2, 'uint16': 3, 'none': 255}
+DTYPE_NAMES = {code: name for (name, code) in DTYPE_CODES.items()}
+DTYPE_NONE = DTYPE_CODES['none']
+
+
+def dtype_code(dtype) -> int:
+    # Protocol code of a numpy dtype (or dtype name)
+    if dtype is None:
+        return DTYPE_NONE
+    return DTYPE_CODES[np.dtype(dtype).name]
+
+
+def pack_header(frameID: int, width: int, height: int, channels: int, dtype, payloadSize: int,
+                renderTime: float = 0.0, stepTime: float = 0.0, extra: bytes = b'') -> bytes:
+    # extra: appended header fields (counted in header_size)
+    return struct.pack(HEADER_FORMAT, PROTOCOL_MAGIC, PROTOCOL_VERSION, HEADER_SIZE + len(extra), int(frameID),
+                       int(width), int(height), int(channels), dtype_code(dtype), int(payloadSize),
+                       float(renderTime), float(stepTime)) + extra
+
+
+def unpack_header(buffer: bytes) -> dict:
+    # Decode a reply header. Raises if the buffer is not a CORTO header (desynchronized stream)
+    if len(buffer) < HEADER_SIZE:
+        raise Exception('CORTO header too short: ' + str(len(buffer)) + ' bytes.')
+    header = dict(zip(HEADER_FIELDS, struct.unpack_from(HEADER_FORMAT, buffer)))
+    if header['magic'] != PROTOCOL_MAGIC:
+        raise Exception('Invalid CORTO header magic ' + str(header['magic']) + ': stream desynchronized.')
+    if header['version'] < 1:
+        raise Exception('Unsupported CORTO protocol version ' + str(header['version']))
+    header['dtype_name'] = DTYPE_NAMES.get(header['dtype'], 'unknown')
+    return header
+
+
+def send_frame(sock, frameID: int, payload: np.ndarray = None, width: int = 0, height: int = 0, channels: int = 0,
+               renderTime: float = 0.0, stepTime: float = 0.0, extra: bytes = b'') -> int:
+    '''
+    This function sends a framed reply (header + payload) with sendall. Returns the bytes sent.
+
+    # Arguments
+        sock: connected TCP socket.
+        frameID: scalar, step counter.
+        payload: contiguous numpy array (image pixels), or None for acknowledge-only replies.
+        width, height, channels: scalars, image layout.
+        renderTime, stepTime: scalars, timings [s].
+        extra: optional appended header blocks (e.g. pack_roi_extra).
+    '''
+    if payload is None:
+        header = pack_header(frameID, 0, 0, 0, None, 0, renderTime, stepTime, extra)
+        sock.sendall(header)
+        return len(header)
+    payloadView = memoryview(payload).cast('B')
+    header = pack_header(frameID, width, height, channels, payload.dtype, payloadView.nbytes, renderTime, stepTime, extra)
+    sock.sendall(header)
+    sock.sendall(payloadView)
+    return len(header) + payloadView.nbytes
+
+
+def pack_shm_notice(frameID: int, seq: int, pixels: np.ndarray, width: int, height: int, channels: int,
+                    renderTime: float = 0.0, stepTime: float = 0.0, extra: bytes = b'') -> bytes:
+    # Reply header of a frame published in the shared memory ring with sequence number seq
+    return pack_header(frameID, width, height, channels, pixels.dtype, pixels.nbytes, renderTime, stepTime,
+                       extra=struct.pack(SHM_EXTRA_FORMAT, SHM_TAG, int(seq)) + extra)
+
+
+def send_shm_notice(sock, frameID: int, seq: int, pixels: np.ndarray, width: int, height: int, channels: int,
+                    renderTime: float = 0.0, stepTime: float = 0.0, extra: bytes = b'') -> int:
+    header = pack_shm_notice(frameID, seq, pixels, width, height, channels, renderTime, stepTime, extra)
+    sock.sendall(header)
+    return len(header)
+
+
+def pack_roi_extra(colOffset: int, rowOffset: int, fullWidth: int, fullHeight: int, binning: int) -> bytes:
+    return struct.pack(ROI_EXTRA_FORMAT, ROI_TAG, int(colOffset), int(rowOffset), int(fullWidth), int(fullHeight), int(binning))
+
+
+def parse_extra(extra: bytes) -> dict:
+    # Decode the appended header blocks: tag -> tuple of values. Parsing stops at the first unknown tag
+    blocks = {}
+    offset = 0
+    while offset + 4 <= len(extra):
+        tag = extra[offset:offset + 4]
+        if tag not in EXTRA_FORMATS or offset + struct.calcsize(EXTRA_FORMATS[tag]) > len(extra):
+            break
+        blocks[tag] = struct.unpack_from(EXTRA_FORMATS[tag], extra, offset)[1:]
+        offset += struct.calcsize(EXTRA_FORMATS[tag])
+    return blocks
+
+
+def shm_seq(header: dict):
+    # Sequence number of a shared-memory reply, None if the payload is on the stream
+    blocks = parse_extra(header.get('extra', b''))
+    return blocks[SHM_TAG][0] if SHM_TAG in blocks else None
+
+
+def roi_info(header: dict):
+    # ROI of a shaped reply (dict of ROI_FIELDS), None if the full image was sent
+    blocks = parse_extra(header.get('extra', b''))
+    return dict(zip(ROI_FIELDS, blocks[ROI_TAG])) if ROI_TAG in blocks else None
+
+
+def pack_batch_extra(requestID: int, index: int, count: int) -> bytes:
+    return struct.pack(BATCH_EXTRA_FORMAT, BATCH_TAG, int(requestID), int(index), int(count))
+
+
+def batch_info(header: dict):
+    # Position of a reply in its batched request (dict of BATCH_EXTRA_FIELDS), None for single requests
+    blocks = parse_extra(header.get('extra', b''))
+    return dict(zip(BATCH_EXTRA_FIELDS, blocks[BATCH_TAG])) if BATCH_TAG in blocks else None
+
+
+def pack_render_settings_extra(samples: int, adaptiveThreshold: float, resolutionPercentage: int, level: int) -> bytes:
+    return struct.pack(RENDER_SETTINGS_EXTRA_FORMAT, RENDER_SETTINGS_TAG, int(samples), float(adaptiveThreshold),
+                       int(resolutionPercentage), int(level))
+
+
+def render_settings(header: dict):
+    # Render settings of a real-time frame (dict of RENDER_SETTINGS_FIELDS), None if not reported
+    blocks = parse_extra(header.get('extra', b''))
+    return dict(zip(RENDER_SETTINGS_FIELDS, blocks[RENDER_SETTINGS_TAG])) if RENDER_SETTINGS_TAG in blocks else None
+
+
+def recv_exact(sock, nBytes: int, out: bytearray = None) -> memoryview:
+    # Receive exactly nBytes, into out if given (preallocated receive buffer)
+    if out is None:
+        out = bytearray(nBytes)
+    view = memoryview(out)[:nBytes]
+    nRead = 0
+    while nRead < nBytes:
+        nChunk = sock.recv_into(view[nRead:], nBytes - nRead)
+        if nChunk == 0:
+            raise Exception('Connection closed by the peer after ' + str(nRead) + ' of ' + str(nBytes) + ' bytes.')
+        nRead += nChunk
+    return view
+
+
+def recv_frame(sock, out: bytearray = None):
+    '''
+    This function receives a framed reply. Returns the header dict and the payload as numpy array
+    (a view on out, if given and large enough, to avoid per-frame allocations).
+
+    # Arguments
+        sock: connected TCP socket.
+        out: optional preallocated receive buffer.
+    '''
+    fixedHeader = bytes(recv_exact(sock, HEADER_SIZE))
+    header = unpack_header(fixedHeader)
+    if header['header_size'] > HEADER_SIZE:
+        # Fields appended by newer protocol versions
+        header['extra'] = bytes(recv_exact(sock, header['header_size'] - HEADER_SIZE))
+    if header['payload_size'] == 0 or shm_seq(header) is not None:
+        # No payload on the stream (acknowledge-only, or frame in shared memory)
+        return header, None
+    if out is None or len(out) < header['payload_size']:
+        out = bytearray(header['payload_size'])
+    payload = recv_exact(sock, header['payload_size'], out)
+    if header['dtype'] == DTYPE_NONE:
+        return header, np.frombuffer(payload, dtype=np.uint8)
+    return header, np.frombuffer(payload, dtype=header['dtype_name'])
+
+
+def split_poses(values: np.ndarray, nBodies: int):
+    '''
+    This function splits a pose vector [PQ_Sun, PQ_SC, PQ_Body_1, ..., PQ_Body_N] (7 values each: position,
+    quaternion WXYZ). Returns PQ_Sun (7,), PQ_SC (7,), PQ_Bodies (nBodies, 7) as float64 views when possible.
+
+    # Arguments
+        values: 1D numpy array of pose values.
+        nBodies: scalar, number of bodies expected by the server.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    if values.size != POSE_SIZE*(nBodies + 2):
+        raise Exception('Invalid pose request: ' + str(values.size) + ' values received, ' +
+                        str(POSE_SIZE*(nBodies + 2)) + ' expected (Sun, SC and ' + str(nBodies) + ' bodies).')
+    return values[0:POSE_SIZE], values[POSE_SIZE:2*POSE_SIZE], np.reshape(values[2*POSE_SIZE:], (nBodies, POSE_SIZE))
+
+
+def pack_request(requestID: int, poses: np.ndarray) -> bytes:
+    # Pose request message: header + little-endian float64 pose values
+    values = np.ascontiguousarray(poses, dtype='<f8').ravel()
+    return struct.pack(REQUEST_FORMAT, REQUEST_MAGIC, PROTOCOL_VERSION, REQUEST_HEADER_SIZE,
+                       int(requestID), values.size) + values.tobytes()
+
+
+def unpack_request_header(buffer: bytes) -> dict:
+    if len(buffer) < REQUEST_HEADER_SIZE:
+        raise Exception('CORTO request header too short: ' + str(len(buffer)) + ' bytes.')
+    header = dict(zip(REQUEST_FIELDS, struct.unpack_from(REQUEST_FORMAT, buffer)))
+    if header['magic'] != REQUEST_MAGIC:
+        raise Exception('Invalid CORTO request magic ' + str(header['magic']) + ': stream desynchronized.')
+    if header['header_size'] < REQUEST_HEADER_SIZE:
+        raise Exception('Invalid CORTO request header size ' + str(header['header_size']))
+    return header
+
+
+def send_request(sock, requestID: int, poses: np.ndarray) -> int:
+    # Send a pose request over a connected TCP socket. Returns the bytes sent
+    message = pack_request(requestID, poses)
+    sock.sendall(message)
+    return len(message)
+
+
+def pack_batch_request(requestID: int, poses: np.ndarray) -> bytes:
+    # Batched request message: header + K pose vectors as little-endian float64, poses of shape (K, pose_values)
+    values = np.ascontiguousarray(np.atleast_2d(poses), dtype='<f8')
+    return struct.pack(BATCH_FORMAT, BATCH_MAGIC, PROTOCOL_VERSION, BATCH_HEADER_SIZE, int(requestID),
+                       values.shape[0], values.shape[1]) + values.tobytes()
+
+
+def unpack_batch_header(buffer: bytes) -> dict:
+    if len(buffer) < BATCH_HEADER_SIZE:
+        raise Exception('CORTO batch header too short: ' + str(len(buffer)) + ' bytes.')
+    header = dict(zip(BATCH_FIELDS, struct.unpack_from(BATCH_FORMAT, buffer)))
+    if header['magic'] != BATCH_MAGIC:
+        raise Exception('Invalid CORTO batch magic ' + str(header['magic']) + ': stream desynchronized.')
+    if header['header_size'] < BATCH_HEADER_SIZE:
+        raise Exception('Invalid CORTO batch header size ' + str(header['header_size']))
+    return header
+
+
+def send_batch_request(sock, requestID: int, poses: np.ndarray) -> int:
+    # Send a batched request over a connected TCP socket. Returns the bytes sent
+    message = pack_batch_request(requestID, poses)
+    sock.sendall(message)
+    return len(message)
+
+
+def max_batch_datagram(poseValues: int) -> int:
+    # Maximum number of poses of a batched request sent as a single UDP datagram
+    return (UDP_MAX_PAYLOAD - BATCH_HEADER_SIZE) // (8*poseValues)
+
+
+def decode_pose_datagram(data: bytes, nBodies: int):
+    '''
+    This function decodes a pose datagram, either batched (b'CRTB' header) or a single pose vector of big-endian
+    doubles. Returns (requestID, poses): requestID is None for single-pose datagrams, poses a (K, 7*(nBodies + 2))
+    float64 array (a view on data).
+
+    # Arguments
+        data: bytes received on port_M2B.
+        nBodies: scalar, number of bodies expected by the server.
+    '''
+    poseValues = POSE_SIZE*(nBodies + 2)
+    if data[0:4] != BATCH_MAGIC:
+        values = np.frombuffer(data, dtype='>f8')
+        if values.size != poseValues:
+            raise Exception('Invalid pose request: ' + str(values.size) + ' values received, ' + str(poseValues) +
+                            ' expected (Sun, SC and ' + str(nBodies) + ' bodies).')
+        return None, values.reshape(1, poseValues)
+    header = unpack_batch_header(data)
+    if header['pose_values'] != poseValues:
+        raise Exception('Invalid batched request: ' + str(header['pose_values']) + ' values per pose, ' +
+                        str(poseValues) + ' expected (Sun, SC and ' + str(nBodies) + ' bodies).')
+    nBytes = 8*header['n_poses']*poseValues
+    if len(data) != header['header_size'] + nBytes:
+        raise Exception('Invalid batched request: ' + str(len(data)) + ' bytes received, ' +
+                        str(header['header_size'] + nBytes) + ' expected.')
+    values = np.frombuffer(data, dtype='<f8', offset=header['header_size'])
+    return header['request_id'], values.reshape(header['n_poses'], poseValues)
@@ -0,0 +1,123 @@
+import math
+
+# Deadline-aware render quality control of the CORTO GNC servers (real-time mode, hardware-in-the-loop runs).
+# The render settings are ordered in a ladder of quality levels, from the configured maximum quality (level 0)
+# to the cheapest one. Each level costs roughly half of the previous one:
+#   1. samples halved, from max_samples down to min_samples;
+#   2. adaptive sampling threshold doubled, from adaptive_threshold_min up to adaptive_threshold_max;
+#   3. resolution scale divided by sqrt(2) (half the pixels), from 100% down to min_resolution_scale.
+# After each render, the level is lowered as much as needed when the render time exceeds the budget
+# (budget_margin * target_frame_period), and raised by one when the last up_frames renders would have fit
+# in the budget at twice their cost. A raise immediately followed by a budget overrun doubles the number of fast
+# renders required before the next raise (up to 64*up_frames), to avoid oscillating between two levels.
+
+
+def build_quality_levels(minSamples: int, maxSamples: int, thresholdMin: float, thresholdMax: float, minScale: int) -> list:
+    '''
+    This function returns the quality levels (samples, adaptive threshold, resolution percentage), best first.
+
+    # Arguments
+        minSamples, maxSamples: scalars, bounds of the Cycles samples.
+        thresholdMin, thresholdMax: scalars, bounds of the Cycles adaptive sampling threshold.
+        minScale: scalar, minimum resolution percentage [%].
+    '''
+    if minSamples < 1 or maxSamples < minSamples:
+        raise Exception('Invalid sample bounds: min_samples ' + str(minSamples) + ', max_samples ' + str(maxSamples))
+    if thresholdMin <= 0 or thresholdMax < thresholdMin:
+        raise Exception('Invalid adaptive threshold bounds: ' + str(thresholdMin) + ', ' + str(thresholdMax))
+    if not(1 <= minScale <= 100):
+        raise Exception('Invalid min_resolution_scale ' + str(minScale) + ': must be in [1, 100] %.')
+    levels = []
+    samples = int(maxSamples)
+    while True:
+        levels.append((samples, float(thresholdMin), 100))
+        if samples <= minSamples:
+            break
+        samples = max(int(minSamples), samples // 2)
+    threshold = float(thresholdMin)
+    while threshold < thresholdMax:
+        threshold = min(float(thresholdMax), 2*threshold)
+        levels.append((int(minSamples), threshold, 100))
+    scale = 100
+    while scale > minScale:
+        scale = max(int(minScale), int(round(scale / math.sqrt(2))))
+        levels.append((int(minSamples), float(thresholdMax), scale))
+    return levels
+
+
+class RenderBudgetController:
+    '''
+    Quality level controller keeping the render time of each frame within the budget of the target frame period.
+
+    # Arguments
+        targetPeriod: scalar, target frame period [s].
+        levels: list of (samples, adaptive threshold, resolution percentage), see build_quality_levels.
+        budgetMargin: scalar, fraction of the period available for rendering (readback and transmission use the rest).
+        upFrames: scalar, number of consecutive fast renders before the quality is raised.
+    '''
+    def __init__(self, targetPeriod: float, levels: list, budgetMargin: float = 0.8, upFrames: int = 5):
+        if targetPeriod <= 0 or len(levels) == 0:
+            raise Exception('Invalid real-time settings: target period ' + str(targetPeriod) + ' s, ' + str(len(levels)) + ' quality levels.')
+        self.targetPeriod = float(targetPeriod)
+        self.budget = float(budgetMargin)*self.targetPeriod
+        self.levels = levels
+        self.upFrames = int(upFrames)
+        self.level = 0
+        self.nFast = 0 # Consecutive renders fast enough to raise the quality
+        self.upHold = self.upFrames # Fast renders required before raising the quality
+        self.justRaised = False
+        self.nFrames = 0
+        self.nMissed = 0 # Renders longer than the target period
+        self.nChanges = 0
+
+    def settings(self) -> dict:
+        # Render settings of the current level
+        (samples, threshold, scale) = self.levels[self.level]
+        return {'samples': samples, 'adaptive_threshold': threshold, 'resolution_percentage': scale, 'level': self.level}
+
+    def update(self, renderTime: float) -> bool:
+        # Account for the render time of the last frame. Returns True if the level changed
+        self.nFrames += 1
+        if renderTime > self.targetPeriod:
+            self.nMissed += 1
+        previousLevel = self.level
+        if renderTime > self.budget:
+            if self.justRaised:
+                self.upHold = min(2*self.upHold, 64*self.upFrames)
+            # Each level halves the cost: skip as many levels as needed at once
+            nLevels = max(1, int(math.ceil(math.log2(renderTime / self.budget))))
+            self.level = min(len(self.levels) - 1, self.level + nLevels)
+            self.nFast = 0
+        elif 2*renderTime <= self.budget and self.level > 0:
+            if self.justRaised:
+                self.upHold = self.upFrames
+            self.nFast += 1
+            if self.nFast >= self.upHold:
+                self.level -= 1
+                self.nFast = 0
+        else:
+            if self.justRaised:
+                self.upHold = self.upFrames
+            self.nFast = 0
+        self.justRaised = self.level < previousLevel
+        if self.level != previousLevel:
+            self.nChanges += 1
+            return True
+        return False
+
+    def stats(self) -> dict:
+        stats = self.settings()
+        stats.update({'target_period': self.targetPeriod, 'frames': self.nFrames, 'missed': self.nMissed,
+                      'level_changes': self.nChanges, 'n_levels': len(self.levels)})
+        return stats
+
+
+def controller_from_config(engineParams: dict):
+    # RenderBudgetController of the RenderingEngine_params section, or None if the real-time mode is disabled
+    if float(engineParams['target_frame_period']) <= 0:
+        return None
+    maxSamples = engineParams['max_samples'] if engineParams['max_samples'] is not None else engineParams['samples']
+    levels = build_quality_levels(int(engineParams['min_samples']), int(maxSamples), float(engineParams['adaptive_threshold_min']),
+                                  float(engineParams['adaptive_threshold_max']), int(engineParams['min_resolution_scale']))
+    return RenderBudgetController(float(engineParams['target_frame_period']), levels, float(engineParams['budget_margin']),
+                                  int(engineParams['up_frames']))
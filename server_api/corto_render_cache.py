@@ -0,0 +1,89 @@
+import json
+import hashlib
+import collections
+import numpy as np
+
+import corto_protocol
+
+# In-memory cache of rendered replies of the CORTO GNC servers, keyed by the quantized pose vector
+# [PQ_Sun, PQ_SC, PQ_Body_1, ..., PQ_Body_N] and by the render settings.
+# Positions are quantized with positionTolerance [BU] and quaternions with quaternionTolerance, after mapping
+# q and -q to the same rotation (w >= 0). Poses within the same quantization cell share the cached image:
+# two poses closer than the tolerance may still fall in adjacent cells (miss), never the opposite.
+
+
+def settings_digest(settings) -> bytes:
+    # Stable digest of any JSON-serializable settings (e.g. the config sections that affect the image)
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).digest()
+
+
+class RenderCache:
+    '''
+    LRU cache of reply payloads (wire pixels + layout), bounded by the total bytes of the stored pixels.
+
+    # Arguments
+        maxBytes: scalar, memory budget of the stored images [bytes].
+        positionTolerance: scalar, quantization step of the positions [BU]. 0: exact match.
+        quaternionTolerance: scalar, quantization step of the quaternion components. 0: exact match.
+        settings: optional JSON-serializable render settings, part of every key.
+    '''
+    def __init__(self, maxBytes: int, positionTolerance: float = 0.0, quaternionTolerance: float = 0.0, settings=None):
+        self.maxBytes = int(maxBytes)
+        self.positionTolerance = float(positionTolerance)
+        self.quaternionTolerance = float(quaternionTolerance)
+        self.settingsDigest = settings_digest(settings)
+        self.entries = collections.OrderedDict() # key -> (pixels, width, height, channels), least recent first
+        self.nBytes = 0
+        self.nHits = 0
+        self.nMisses = 0
+        self.nEvictions = 0
+
+    def setSettings(self, settings):
+        # Render settings changed: cached images are not valid anymore
+        self.settingsDigest = settings_digest(settings)
+        self.clear()
+
+    def key(self, poses: np.ndarray) -> bytes:
+        # Quantized key of a pose vector (flat, 7 values per object: position, quaternion WXYZ)
+        PQ = np.array(poses, dtype=np.float64).reshape(-1, corto_protocol.POSE_SIZE)
+        # q and -q are the same rotation
+        PQ[PQ[:, 3] < 0, 3:7] *= -1
+        if self.positionTolerance > 0:
+            PQ[:, 0:3] = np.floor(PQ[:, 0:3] / self.positionTolerance)
+        if self.quaternionTolerance > 0:
+            PQ[:, 3:7] = np.floor(PQ[:, 3:7] / self.quaternionTolerance)
+        PQ += 0.0 # -0.0 -> 0.0, such that equal values have equal bytes
+        return self.settingsDigest + PQ.tobytes()
+
+    def get(self, key: bytes):
+        # Cached payload (pixels, width, height, channels, extra), or None. Counts hits and misses
+        entry = self.entries.get(key)
+        if entry is None:
+            self.nMisses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.nHits += 1
+        return entry
+
+    def put(self, key: bytes, pixels: np.ndarray, width: int, height: int, channels: int, extra: bytes = b''):
+        # Store a copy of pixels (the reply buffers are reused), evicting least recently used entries
+        if pixels.nbytes > self.maxBytes:
+            return
+        if key in self.entries:
+            self.nBytes -= self.entries.pop(key)[0].nbytes
+        while self.nBytes + pixels.nbytes > self.maxBytes:
+            (_, evicted) = self.entries.popitem(last=False)
+            self.nBytes -= evicted[0].nbytes
+            self.nEvictions += 1
+        self.entries[key] = (pixels.copy(), width, height, channels, extra)
+        self.nBytes += pixels.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.nBytes = 0
+
+    def stats(self) -> dict:
+        nRequests = self.nHits + self.nMisses
+        return {'entries': len(self.entries), 'bytes': self.nBytes, 'max_bytes': self.maxBytes,
+                'hits': self.nHits, 'misses': self.nMisses, 'evictions': self.nEvictions,
+                'hit_rate': (self.nHits / nRequests) if nRequests > 0 else 0.0}
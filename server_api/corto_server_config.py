@@ -0,0 +1,109 @@
+import os
+import json
+import copy
+
+# Loader of the CORTO GNC server configuration (BlenderPy_UDP_TCP_CONFIG.yml).
+# Pure Python: it can be used inside Blender and by the client-side tools alike.
+# Missing entries are filled with SERVER_CONFIG_DEFAULTS, unknown entries are kept as they are.
+
+# Server modes, named after the NAVCAM_HF_1 models they serve
+SERVER_MODES = ['ack', 'viewer', 'disk']
+SERVER_MODE_ALIASES = {'a': 'ack', 'b': 'viewer', 'c': 'disk', 'd': 'disk'}
+TCP_PROTOCOLS = ['raw', 'framed']
+# Image transports: 'tcp' (payload on the stream) or 'shm' (payload in a shared memory ring, local clients only)
+TRANSPORTS = ['tcp', 'shm']
+# Render queue policies of the multi-client server: 'fifo' serves every request in arrival order,
+# 'latest' keeps only the newest pending request of each client (real-time runs)
+QUEUE_POLICIES = ['fifo', 'latest']
+
+SERVER_CONFIG_DEFAULTS = {
+    'Camera_params': {'FOV_x': 21.0, 'FOV_y': 16.0,
+                      'sensor_size_x': 2048, 'sensor_size_y': 1536,
+                      'n_channels': 1, 'bit_encoding': 8, 'compression': 15,
+                      'clip_start': 0.5, 'clip_end': 100.0,
+                      'output_channels': None, 'binning': 1, 'roi_crop': False, 'roi_threshold': 0.0, 'roi_margin': 0},
+    'RenderingEngine_params': {'render_engine': 'CYCLES', 'device': 'CPU', 'samples': 4,
+                               'diffuse_bounces': 0, 'tile_size': 64,
+                               'target_frame_period': 0.0, 'budget_margin': 0.8, 'up_frames': 5,
+                               'min_samples': 1, 'max_samples': None,
+                               'adaptive_threshold_min': 0.01, 'adaptive_threshold_max': 0.01, 'min_resolution_scale': 100},
+    'BlenderModel_params': {'num_bodies': 1, 'light_names': ['Sun'], 'camera_name': 'Camera',
+                            'bodies_names': [], 'sun_energy': 2, 'specular_factor': 0},
+    'Server_params': {'output_path': '', 'address': '0.0.0.0', 'port_M2B': 51001, 'port_B2M': 30001,
+                      'DUMMY_OUTPUT': False, 'image_dtype': 'double', 'disable_caching': False,
+                      'mode': 'viewer', 'tcp_protocol': 'raw', 'log_images': False,
+                      'max_clients': 8, 'queue_policy': 'fifo', 'queue_size': 0, 'stats_period': 10.0,
+                      'render_cache_mb': 0, 'cache_position_tolerance': 0.0, 'cache_quaternion_tolerance': 0.0,
+                      'transport': 'tcp', 'shm_name': 'corto_frames', 'shm_slots': 4, 'pipeline': False},
+}
+
+
+def normalize_server_mode(mode: str) -> str:
+    # Accept both the mode names and the HF_1 model letters (a, b, c, d)
+    mode = SERVER_MODE_ALIASES.get(str(mode).lower(), str(mode).lower())
+    if mode not in SERVER_MODES:
+        raise Exception('Invalid server mode ' + str(mode) + '. Supported: ' + str(SERVER_MODES) +
+                        ' or ' + str(list(SERVER_MODE_ALIASES.keys())))
+    return mode
+
+
+def read_config_file(configFilePath: str) -> dict:
+    # Read a .yml/.yaml or .json file into a dict
+    if not(os.path.isfile(configFilePath)):
+        raise Exception('Server config file not found: ' + str(configFilePath))
+    (_, ext) = os.path.splitext(configFilePath)
+    with open(configFilePath, 'r') as configFile:
+        if ext.lower() == '.json':
+            return json.load(configFile)
+        try:
+            import yaml
+        except ImportError:
+            raise Exception('PyYAML is required to read ' + str(configFilePath) + '. Install it in the Python of Blender ' +
+                            '(e.g. <blender python> -m pip install pyyaml) or provide the same config as .json')
+        return yaml.safe_load(configFile)
+
+
+def load_server_config(configFilePath: str, overrides: dict = None) -> dict:
+    '''
+    This function loads and validates the GNC server configuration. Returns a dict with the same
+    sections of BlenderPy_UDP_TCP_CONFIG.yml, with defaults for the missing entries.
+
+    # Arguments
+        configFilePath: string, .yml/.yaml (requires PyYAML) or .json file.
+        overrides: optional dict {section: {key: value}} applied on top of the file (e.g. command line).
+    '''
+    fileConfig = read_config_file(configFilePath)
+    if fileConfig is None:
+        fileConfig = {}
+    if not(isinstance(fileConfig, dict)):
+        raise Exception('Invalid server config ' + str(configFilePath) + ': expected a mapping of sections.')
+    config = copy.deepcopy(SERVER_CONFIG_DEFAULTS)
+    for source in [fileConfig, overrides or {}]:
+        for (section, values) in source.items():
+            if isinstance(values, dict):
+                config.setdefault(section, {}).update(values)
+            else:
+                config[section] = values
+
+    model = config['BlenderModel_params']
+    server = config['Server_params']
+    if len(model['bodies_names']) != int(model['num_bodies']):
+        raise Exception('num_bodies (' + str(model['num_bodies']) + ') does not match bodies_names ' + str(model['bodies_names']))
+    if len(model['light_names']) < 1:
+        raise Exception('At least one light name is required in light_names')
+    server['mode'] = normalize_server_mode(server['mode'])
+    if server['tcp_protocol'] not in TCP_PROTOCOLS:
+        raise Exception('Invalid tcp_protocol ' + str(server['tcp_protocol']) + '. Supported: ' + str(TCP_PROTOCOLS))
+    if config['Camera_params']['roi_crop'] and server['tcp_protocol'] != 'framed':
+        raise Exception('roi_crop changes the image size at every step: set tcp_protocol to framed')
+    if float(config['RenderingEngine_params']['target_frame_period']) > 0 and server['tcp_protocol'] != 'framed':
+        raise Exception('The real-time mode (target_frame_period) reports the render settings in the reply header: set tcp_protocol to framed')
+    if server['transport'] not in TRANSPORTS:
+        raise Exception('Invalid transport ' + str(server['transport']) + '. Supported: ' + str(TRANSPORTS))
+    if server['transport'] == 'shm' and server['tcp_protocol'] != 'framed':
+        raise Exception('The shm transport sends the frame sequence numbers in framed replies: set tcp_protocol to framed')
+    if server['queue_policy'] not in QUEUE_POLICIES:
+        raise Exception('Invalid queue_policy ' + str(server['queue_policy']) + '. Supported: ' + str(QUEUE_POLICIES))
+    if server['mode'] in ['ack', 'disk'] and server['output_path'] == '':
+        raise Exception('Server mode ' + server['mode'] + ' saves the images: output_path is required')
+    return config
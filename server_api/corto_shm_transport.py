@@ -0,0 +1,156 @@
+import sys
+import struct
+import numpy as np
+
+from multiprocessing import shared_memory
+
+import corto_protocol
+
+# Shared-memory transport of the CORTO GNC servers, for clients running on the same machine as Blender.
+# Rendered frames are written in a ring of nSlots fixed-size slots of a named shared memory block; the TCP
+# connection only carries a small control message per frame (see corto_protocol.send_shm_notice) with the
+# sequence number of the frame. Clients map the block once and read the pixels in place, without copies.
+#
+# Layout (little-endian):
+#   ring header  '<4sHHIIQ'  magic b'CRSM', version, ring header size, nSlots, slot size [bytes], last sequence number
+#   slot k       at RING_HEADER_SIZE + k*slotStride: '<QQ' sequence number, payload size [bytes], then the payload
+#                at a 64-byte aligned offset.
+# Frame seq (>= 1) is written in slot (seq - 1) % nSlots. The writer zeroes the slot sequence number before
+# writing the payload and sets it after, hence a reader detects an overwritten slot by checking that the slot
+# still holds its sequence number after reading (isCurrent). With nSlots > 1, a client that processes each frame
+# before the next nSlots - 1 ones are rendered never sees an overwrite.
+
+SHM_MAGIC = b'CRSM'
+SHM_VERSION = 1
+RING_FORMAT = '<4sHHIIQ'
+RING_HEADER_SIZE = 64
+SLOT_FORMAT = '<QQ'
+SLOT_HEADER_SIZE = 64 # Payload offset within the slot (cache line aligned)
+LAST_SEQ_OFFSET = struct.calcsize('<4sHHII')
+
+
+class ShmFrameRing:
+    '''
+    Ring buffer of frames in a named shared memory block. The server creates it (create=True, slotBytes > 0),
+    clients attach to it by name.
+
+    # Arguments
+        name: string, name of the shared memory block.
+        nSlots: scalar, number of frame slots (create only).
+        slotBytes: scalar, maximum payload size of a frame [bytes] (create only).
+        create: bool, True for the server (owner of the block), False for clients.
+    '''
+    def __init__(self, name: str, nSlots: int = 4, slotBytes: int = 0, create: bool = False):
+        self.owner = create
+        if create:
+            if nSlots < 1 or slotBytes <= 0:
+                raise Exception('Invalid shared memory ring: ' + str(nSlots) + ' slots of ' + str(slotBytes) + ' bytes.')
+            self.nSlots = int(nSlots)
+            self.slotBytes = int(slotBytes)
+            self.slotStride = SLOT_HEADER_SIZE + 64*((self.slotBytes + 63) // 64)
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=RING_HEADER_SIZE + self.nSlots*self.slotStride)
+            except FileExistsError:
+                # Left over by a crashed server
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=RING_HEADER_SIZE + self.nSlots*self.slotStride)
+            struct.pack_into(RING_FORMAT, self.shm.buf, 0, SHM_MAGIC, SHM_VERSION, RING_HEADER_SIZE, self.nSlots, self.slotBytes, 0)
+            for slot in range(self.nSlots):
+                struct.pack_into(SLOT_FORMAT, self.shm.buf, self._slotOffset(slot), 0, 0)
+        else:
+            self.shm = attach_shared_memory(name)
+            (magic, version, headerSize, nSlots, slotBytes, _) = struct.unpack_from(RING_FORMAT, self.shm.buf, 0)
+            if magic != SHM_MAGIC:
+                raise Exception('Shared memory block ' + name + ' is not a CORTO frame ring.')
+            if version < 1 or headerSize != RING_HEADER_SIZE:
+                raise Exception('Unsupported CORTO frame ring version ' + str(version))
+            self.nSlots = nSlots
+            self.slotBytes = slotBytes
+            self.slotStride = SLOT_HEADER_SIZE + 64*((self.slotBytes + 63) // 64)
+        self.name = self.shm.name
+        self.writeSeq = 0 # Sequence number of the frame being written (server)
+
+    def _slotOffset(self, slot: int) -> int:
+        return RING_HEADER_SIZE + slot*self.slotStride
+
+    def _payloadView(self, seq: int, nBytes: int) -> np.ndarray:
+        offset = self._slotOffset((seq - 1) % self.nSlots) + SLOT_HEADER_SIZE
+        return np.frombuffer(self.shm.buf, dtype=np.uint8, count=nBytes, offset=offset)
+
+    def lastSeq(self) -> int:
+        return struct.unpack_from('<Q', self.shm.buf, LAST_SEQ_OFFSET)[0]
+
+    def beginWrite(self, nBytes: int) -> np.ndarray:
+        # Claim the next slot and return its payload as a writable uint8 view of nBytes (pack pixels directly in it)
+        if nBytes > self.slotBytes:
+            raise Exception('Frame of ' + str(nBytes) + ' bytes exceeds the shared memory slot size (' + str(self.slotBytes) + ' bytes).')
+        self.writeSeq += 1
+        struct.pack_into(SLOT_FORMAT, self.shm.buf, self._slotOffset((self.writeSeq - 1) % self.nSlots), 0, 0)
+        return self._payloadView(self.writeSeq, nBytes)
+
+    def commit(self, nBytes: int) -> int:
+        # Publish the frame written in the slot returned by beginWrite. Returns its sequence number
+        struct.pack_into(SLOT_FORMAT, self.shm.buf, self._slotOffset((self.writeSeq - 1) % self.nSlots), self.writeSeq, nBytes)
+        struct.pack_into('<Q', self.shm.buf, LAST_SEQ_OFFSET, self.writeSeq)
+        return self.writeSeq
+
+    def write(self, payload: np.ndarray) -> int:
+        # Copy payload in the next slot and publish it. Returns its sequence number
+        payloadBytes = memoryview(np.ascontiguousarray(payload)).cast('B')
+        slotView = self.beginWrite(payloadBytes.nbytes)
+        slotView[:] = payloadBytes
+        return self.commit(payloadBytes.nbytes)
+
+    def read(self, seq: int, dtype='uint8', shape=None) -> np.ndarray:
+        # Zero-copy view of frame seq (client). Check isCurrent(seq) after using it
+        (slotSeq, nBytes) = struct.unpack_from(SLOT_FORMAT, self.shm.buf, self._slotOffset((seq - 1) % self.nSlots))
+        if slotSeq != seq:
+            raise Exception('Frame ' + str(seq) + ' is not available in the shared memory ring (slot holds frame ' + str(slotSeq) + ').')
+        frame = self._payloadView(seq, nBytes).view(dtype)
+        if shape is not None:
+            frame = frame.reshape(shape)
+        return frame
+
+    def isCurrent(self, seq: int) -> bool:
+        # True if frame seq has not been overwritten
+        return struct.unpack_from('<Q', self.shm.buf, self._slotOffset((seq - 1) % self.nSlots))[0] == seq
+
+    def close(self):
+        # Clients: release the mapping. Server: also remove the block
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def attach_shared_memory(name: str):
+    # Attach to an existing block without letting the resource tracker of this process remove it at exit
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+def recv_shm_frame(sock, ring: ShmFrameRing, out: bytearray = None):
+    '''
+    This function receives a reply of a server using the shared-memory transport. Returns the header dict and
+    the pixels as a zero-copy view on the ring (or on the stream buffer, for replies sent over TCP).
+    The view must be consumed (or copied) before ring.nSlots - 1 further frames are requested.
+
+    # Arguments
+        sock: connected TCP socket (control channel).
+        ring: ShmFrameRing attached to the server ring (Server_params.shm_name).
+        out: optional preallocated receive buffer for TCP replies.
+    '''
+    header, payload = corto_protocol.recv_frame(sock, out)
+    seq = corto_protocol.shm_seq(header)
+    if seq is None:
+        return header, payload
+    header['shm_seq'] = seq
+    return header, ring.read(seq, header['dtype_name'])
@@ -0,0 +1,143 @@
+# Lightweight stand-in of the Blender Python API, for benchmarking the CORTO GNC servers without Blender
+# (e.g. on a CI machine). It implements only the attributes used by the servers. Rendering draws a lit disk
+# whose position follows the camera, with vectorized NumPy, so that the server overhead (decode, positioning,
+# readback, pack, send) can be measured with realistic image sizes.
+# Usage: put this folder first on sys.path before importing a server module (see corto_gnc_client.py --fake-server).
+# Environment variables:
+#   CORTO_FAKE_RENDER_DELAY: additional render time per frame [s] (default 0).
+#   CORTO_FAKE_SAMPLE_TIME: additional render time per sample and megapixel [s] (default 0), such that the
+#                           real-time mode of the servers (target_frame_period) can be exercised.
+
+import os
+import time
+import numpy as np
+
+FAKE_BPY = True
+
+
+class _Namespace:
+    # Plain attribute container: any attribute can be set, unknown ones read as None
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        return None
+
+
+class _PixelBuffer:
+    # bpy_prop_array-like view on a flat float32 array
+    def __init__(self, image):
+        self.image = image
+
+    def __len__(self):
+        return self.image.array.size
+
+    def foreach_get(self, buffer):
+        np.copyto(buffer, self.image.array, casting='same_kind')
+
+    def foreach_set(self, buffer):
+        np.copyto(self.image.array, np.asarray(buffer, dtype=np.float32).ravel())
+
+
+class _Image:
+    def __init__(self, name, width=0, height=0, filepath=''):
+        self.name = name
+        self.filepath = filepath
+        self.array = np.zeros(width*height*4, dtype=np.float32)
+        self.size = (width, height)
+
+    @property
+    def pixels(self):
+        return _PixelBuffer(self)
+
+    def reload(self):
+        _load_image_file(self)
+
+
+class _Object:
+    def __init__(self, name):
+        self.name = name
+        self.location = np.zeros(3)
+        self.rotation_mode = 'QUATERNION'
+        self.rotation_quaternion = np.array([1.0, 0.0, 0.0, 0.0])
+        self.data = _Namespace()
+
+    def __setattr__(self, name, value):
+        if name in ('location', 'rotation_quaternion'):
+            value = np.array(value, dtype=np.float64)
+        object.__setattr__(self, name, value)
+
+
+class _Collection(dict):
+    # bpy.data collection: items are created on first access, such that any .blend layout is accepted
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def __missing__(self, name):
+        item = self.factory(name)
+        self[name] = item
+        return item
+
+
+class _ImageCollection(_Collection):
+    def load(self, filepath, check_existing=False):
+        image = _Image(os.path.basename(filepath), filepath=filepath)
+        _load_image_file(image)
+        self[image.name] = image
+        return image
+
+    def remove(self, image):
+        self.pop(image.name, None)
+
+
+def _load_image_file(image):
+    # Images "saved" by the fake renderer are .npy files with the RGBA float32 pixels
+    pixels = np.load(image.filepath + '.npy')
+    image.array = pixels.ravel()
+    image.size = (pixels.shape[1], pixels.shape[0])
+
+
+def _world_factory(name):
+    background = _Namespace(inputs=[_Namespace(default_value=(0, 0, 0, 1))])
+    return _Namespace(node_tree=_Namespace(nodes=_Collection(lambda nodeName: background)))
+
+
+scene = _Namespace(render=_Namespace(engine='CYCLES', filepath='', resolution_x=1024, resolution_y=1024,
+                                     resolution_percentage=100, pixel_aspect_x=1, pixel_aspect_y=1,
+                                     image_settings=_Namespace(color_mode='RGBA', color_depth='8', compression=15)),
+                   cycles=_Namespace(device='CPU', samples=4, diffuse_bounces=0, tile_size=64))
+context = _Namespace(scene=scene)
+data = _Namespace(objects=_Collection(_Object),
+                  images=_ImageCollection(lambda name: _Image(name)),
+                  worlds=_Collection(_world_factory))
+
+
+def _render(write_still=False):
+    width = int(scene.render.resolution_x*scene.render.resolution_percentage/100)
+    height = int(scene.render.resolution_y*scene.render.resolution_percentage/100)
+    delay = float(os.environ.get('CORTO_FAKE_RENDER_DELAY', 0))
+    delay += float(os.environ.get('CORTO_FAKE_SAMPLE_TIME', 0))*scene.cycles.samples*width*height/1e6
+    if delay > 0:
+        time.sleep(delay)
+    viewer = data.images['Viewer Node']
+    if viewer.array.size != width*height*4:
+        viewer.array = np.empty(width*height*4, dtype=np.float32)
+        viewer.size = (width, height)
+    # Disk of radius ~1/(camera distance), moving with the camera position
+    camera = data.objects['Camera']
+    distance = max(float(np.linalg.norm(camera.location)), 1e-3)
+    radius = 0.25*min(width, height)/distance
+    center = np.array([width, height])*(0.5 + 0.1*np.tanh(camera.location[0:2]))
+    cols = (np.arange(width, dtype=np.float32) - center[0])**2
+    rows = (np.arange(height, dtype=np.float32) - center[1])**2
+    image = np.reshape(viewer.array, (height, width, 4))
+    np.less(rows[:, None] + cols[None, :], radius**2, out=image[:, :, 0], casting='unsafe')
+    image[:, :, 1] = image[:, :, 0]
+    image[:, :, 2] = image[:, :, 0]
+    image[:, :, 3] = 1.0
+    if write_still and scene.render.filepath != '':
+        np.save(scene.render.filepath + '.npy', image)
+
+
+ops = _Namespace(render=_Namespace(render=_render))